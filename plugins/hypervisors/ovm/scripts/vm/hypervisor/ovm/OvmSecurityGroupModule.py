@@ -18,6 +18,146 @@ from OvmCommonModule import *
 from ConfigFileOps import *
 import os
 import logging
+import fcntl
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+class RuleStateStore(object):
+    '''
+    Programmed rule state of every vm on the host, kept as an append-only
+    journal of "vm_name,vm_id,vm_ip,dom_id,signature,seqno,rule_hash"
+    records where a lone "vm_name" record removes the vm. The last record
+    of a vm wins and a torn trailing line is ignored. The journal is
+    rewritten through a rename once most of its records are superseded.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.states = {}
+        self.records = 0
+        if not os.path.exists(self.path):
+            lock_file = self.lock()
+            try:
+                if not os.path.exists(self.path):
+                    self.import_rule_logs()
+            finally:
+                self.unlock(lock_file)
+        self.load()
+
+    def lock(self):
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        lock_file = open(self.path + ".lock", 'a')
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        return lock_file
+
+    def unlock(self, lock_file):
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
+
+    def load(self):
+        self.states = {}
+        self.records = 0
+        if not os.path.exists(self.path):
+            return
+        journal = open(self.path)
+        try:
+            for line in journal:
+                if not line.endswith('\n'):
+                    break
+                fields = line.rstrip('\n').split(',')
+                self.records += 1
+                if len(fields) == 7:
+                    self.states[fields[0]] = fields[1:]
+                elif len(fields) == 1:
+                    self.states.pop(fields[0], None)
+        finally:
+            journal.close()
+
+    def import_rule_logs(self):
+        '''
+        picks up the per vm .log files written before the journal existed,
+        only "vm_name.log" files holding a rule log record are imported and
+        removed
+        '''
+        log_dir = os.path.dirname(self.path)
+        imported = []
+        for log in os.listdir(log_dir):
+            if not log.endswith(".log"):
+                continue
+            try:
+                log_file = open(os.path.join(log_dir, log))
+                try:
+                    fields = log_file.readline().rstrip().split(',')
+                finally:
+                    log_file.close()
+            except:
+                logging.debug("Ignoring unreadable rule log " + log)
+                continue
+            if len(fields) == 6 and fields[0] + ".log" == log:
+                self.states[fields[0]] = fields[1:] + ['_']
+                imported.append(log)
+        self.compact()
+        for log in imported:
+            try:
+                os.remove(os.path.join(log_dir, log))
+            except:
+                pass
+
+    def compact(self):
+        tmp_name = self.path + ".tmp"
+        tmp = open(tmp_name, 'w')
+        try:
+            vm_names = self.states.keys()
+            vm_names.sort()
+            for vm_name in vm_names:
+                tmp.write(','.join([vm_name] + self.states[vm_name]) + '\n')
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        finally:
+            tmp.close()
+        os.rename(tmp_name, self.path)
+        self.records = len(self.states)
+
+    def append(self, record):
+        lock_file = self.lock()
+        try:
+            journal = open(self.path, 'a+')
+            try:
+                journal.seek(0, 2)
+                if journal.tell() > 0:
+                    journal.seek(-1, 2)
+                    if journal.read(1) != '\n':
+                        record = '\n' + record
+                journal.write(record + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            finally:
+                journal.close()
+            self.records += 1
+            if self.records > 2 * len(self.states) + 64:
+                self.load()
+                self.compact()
+        finally:
+            self.unlock(lock_file)
+
+    def get(self, vm_name):
+        return self.states.get(vm_name)
+
+    def put(self, vm_name, vm_id, vm_ip, dom_id, signature, seqno, rule_hash='_'):
+        state = [vm_id, vm_ip, str(dom_id), signature, seqno, rule_hash]
+        self.states[vm_name] = state
+        self.append(','.join([vm_name] + state))
+
+    def remove(self, vm_name):
+        if not self.states.has_key(vm_name):
+            return False
+        del self.states[vm_name]
+        self.append(vm_name)
+        return True
+
+rule_state = RuleStateStore("/var/run/cloud/rules.journal")
 
 class OvmSecurityGroup(OvmObject):
 
@@ -233,6 +373,11 @@ class OvmSecurityGroup(OvmObject):
             if not 1 in changes:
                 logging.debug("Rules already programmed for vm " + vm_name)
                 return True
+
+            rule_hash = md5(rules or '').hexdigest()
+            if not 1 in changes[:5] and rule_state.get(vm_name)[5] == rule_hash:
+                logging.debug("Rules of vm " + vm_name + " unchanged, only recording seqno " + seqno)
+                return OvmSecurityGroup.write_rule_log_for_vm(vm_name, vm_id, vm_ip, dom_id, signature, seqno, rule_hash)
         
             if changes[0] or changes[1] or changes[2] or changes[3]:
                 if not OvmSecurityGroup.default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, bridge_name):
@@ -289,7 +434,7 @@ class OvmSecurityGroup(OvmObject):
             iptables =  "iptables -A " + vm_chain + " -j DROP"       
             execute(iptables)
             
-            return OvmSecurityGroup.write_rule_log_for_vm(vm_name, vm_id, vm_ip, dom_id, signature, seqno)        
+            return OvmSecurityGroup.write_rule_log_for_vm(vm_name, vm_id, vm_ip, dom_id, signature, seqno, rule_hash)
         except:
             logging.debug("Failed to network rule !: " + sys.exc_type)
             return False
@@ -389,59 +534,30 @@ class OvmSecurityGroup(OvmObject):
         return truncated_vm_name        
 
     @staticmethod
-    def write_rule_log_for_vm(vm_name, vm_id, vm_ip, dom_id, signature, seqno):
-        log_file_name = "/var/run/cloud/" + vm_name + ".log"
-        logging.debug("Writing log to " + log_file_name)
-        logf = open(log_file_name, 'w')
-        output = ','.join([vm_name, vm_id, vm_ip, dom_id, signature, seqno])
-
-        result = True        
+    def write_rule_log_for_vm(vm_name, vm_id, vm_ip, dom_id, signature, seqno, rule_hash='_'):
         try:
-            logf.write(output)
-            logf.write('\n')
+            rule_state.put(vm_name, vm_id, vm_ip, dom_id, signature, seqno, rule_hash)
         except:
-            logging.debug("Failed to write to rule log file " + log_file_name)
-            result = False
-            
-        logf.close()        
-        return result
+            logging.debug("Failed to record rule state of vm " + vm_name)
+            return False
+        return True
 
     @staticmethod
     def remove_rule_log_for_vm(vm_name):
-        log_file_name = "/var/run/cloud/" + vm_name +".log"
-
-        result = True
         try:
-            os.remove(log_file_name)
+            return rule_state.remove(vm_name)
         except:
-            logging.debug("Failed to delete rule log file " + log_file_name)
-            result = False
-        
-        return result
+            logging.debug("Failed to remove rule state of vm " + vm_name)
+            return False
 
     @staticmethod
     def check_rule_log_for_vm(vm_name, vm_id, vm_ip, dom_id, signature, seqno):
-        log_file_name = "/var/run/cloud/" + vm_name + ".log"
-        if not os.path.exists(log_file_name):
-            return [True, True, True, True, True, True]
-            
-        try:
-            lines = (line.rstrip() for line in open(log_file_name))
-        except:
-            logging.debug("failed to open " + log_file_name) 
+        state = rule_state.get(vm_name)
+        if state is None:
             return [True, True, True, True, True, True]
 
-        [_vm_name, _vm_id, _vm_ip, _dom_id, _signature, _seqno] = ['_', '-1', '_', '-1', '_', '-1']
-        try:
-            for line in lines:
-                [_vm_name, _vm_id, _vm_ip, _dom_id, _signature, _seqno] = line.split(',')
-                break
-        except:
-            logging.debug("Failed to parse log file for vm " + vm_name)
-            remove_rule_log_for_vm(vm_name)
-            return [True, True, True, True, True, True]
-        
-        return [(vm_name != _vm_name), (vm_id != _vm_id), (vm_ip != _vm_ip), (dom_id != _dom_id), (signature != _signature), (seqno != _seqno)]
+        [_vm_id, _vm_ip, _dom_id, _signature, _seqno, _rule_hash] = state
+        return [False, (vm_id != _vm_id), (vm_ip != _vm_ip), (str(dom_id) != _dom_id), (signature != _signature), (seqno != _seqno)]
 
     
 
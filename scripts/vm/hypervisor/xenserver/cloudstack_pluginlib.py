@@ -18,13 +18,21 @@
 # Common function for Cloudstack's XenAPI plugins
 
 import ConfigParser
+import atexit
 import logging
 import os
 import subprocess
+import tempfile
+import time
 import simplejson as json
 
 from time import localtime, asctime
 
+try:
+    import XenAPI
+except ImportError:
+    XenAPI = None
+
 DEFAULT_LOG_FORMAT = "%(asctime)s %(levelname)8s [%(name)s] %(message)s"
 DEFAULT_LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 DEFAULT_LOG_FILE = "/var/log/cloudstack_plugins.log"
@@ -37,6 +45,10 @@ OVS_DAEMON_PATH = "ovs-vswitchd"
 VSCTL_PATH = "/usr/bin/ovs-vsctl"
 OFCTL_PATH = "/usr/bin/ovs-ofctl"
 XE_PATH = "/opt/xensource/bin/xe"
+XAPI_CACHE_TTL = 30
+
+# nw_proto numbers of the protocol names used by network ACL items
+IP_PROTOCOLS = {'icmp': 1, 'tcp': 6, 'udp': 17}
 
 
 class PluginError(Exception):
@@ -177,14 +189,88 @@ def _build_flow_expr(**kwargs):
     dl_dst = 'dl_dst' in kwargs and ",dl_dst=%s" % kwargs['dl_dst'] or ''
     nw_src = 'nw_src' in kwargs and ",nw_src=%s" % kwargs['nw_src'] or ''
     nw_dst = 'nw_dst' in kwargs and ",nw_dst=%s" % kwargs['nw_dst'] or ''
+    nw_proto = 'nw_proto' in kwargs and ",nw_proto=%s" % kwargs['nw_proto'] or ''
+    tp_dst = 'tp_dst' in kwargs and ",tp_dst=%s" % kwargs['tp_dst'] or ''
     table = 'table' in kwargs and ",table=%s" % kwargs['table'] or ''
     proto = 'proto' in kwargs and ",%s" % kwargs['proto'] or ''
-    ip = ('nw_src' in kwargs or 'nw_dst' in kwargs) and ',ip' or ''
+    ip = ('nw_src' in kwargs or 'nw_dst' in kwargs or
+          'nw_proto' in kwargs) and ',ip' or ''
     flow = (flow + in_port + dl_type + dl_src + dl_dst +
-            (ip or proto) + nw_src + nw_dst + table)
+            (ip or proto) + nw_src + nw_dst + nw_proto + tp_dst + table)
     return flow
 
 
+def _port_range_masks(start, end):
+    """
+    Splits the inclusive port range start-end into the fewest value/mask
+    matches, e.g. 1-65535 takes 16 tp_dst matches instead of 65535 flows
+    """
+    matches = []
+    port = start
+    while port <= end:
+        size = 1
+        while (size < 0x10000 and port % (size * 2) == 0 and
+               port + size * 2 - 1 <= end):
+            size = size * 2
+        if size == 1:
+            matches.append("%d" % port)
+        else:
+            matches.append("0x%04x/0x%04x" % (port, ~(size - 1) & 0xffff))
+        port = port + size
+    return matches
+
+
+class FlowBatch(object):
+    """
+    Collects flow deletions and additions for a bridge and applies all of
+    them with one ovs-ofctl add-flows. Where the switch speaks OpenFlow 1.4
+    they go in as a single bundle, so the tables are swapped atomically;
+    otherwise the deletions are issued first and the flows added after.
+    """
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.deletes = []
+        self.flows = []
+
+    def del_flows(self, **kwargs):
+        self.deletes.append(_build_flow_expr(delete=True, **kwargs).lstrip(','))
+
+    def add_flow(self, **kwargs):
+        flow = _build_flow_expr(**kwargs)
+        actions = 'actions' in kwargs and ",actions=%s" % kwargs['actions'] or ''
+        self.flows.append(flow + actions)
+
+    def add_flow_expr(self, flow):
+        self.flows.append(flow)
+
+    def _add_flows(self, options, lines):
+        fd, path = tempfile.mkstemp(prefix="flows-")
+        try:
+            os.write(fd, "\n".join(lines) + "\n")
+            os.close(fd)
+            do_cmd([OFCTL_PATH] + options + ["add-flows", self.bridge, path])
+        finally:
+            os.remove(path)
+
+    def apply(self):
+        lines = (["delete %s" % flow for flow in self.deletes] +
+                 ["add %s" % flow for flow in self.flows])
+        if not lines:
+            return
+        logging.debug("Applying %d flow deletions and %d flows to %s" %
+                      (len(self.deletes), len(self.flows), self.bridge))
+        try:
+            self._add_flows(["-O", "OpenFlow14", "--bundle"], lines)
+            return
+        except PluginError:
+            logging.debug("Bundles not supported on %s, applying flows "
+                          "without them" % self.bridge)
+        for flow in self.deletes:
+            do_cmd([OFCTL_PATH, "del-flows", self.bridge, flow])
+        if self.flows:
+            self._add_flows([], self.flows)
+
+
 def add_flow(bridge, **kwargs):
     """
     Builds a flow expression for **kwargs and adds the flow entry
@@ -222,14 +308,173 @@ def del_port(bridge, port):
     delPort = [VSCTL_PATH, "del-port", bridge, port]
     do_cmd(delPort)
 
+class XapiRecordCache(object):
+    """
+    VM, VIF and network records of this host, looked up over a single
+    local XenAPI session instead of one xe fork (and XAPI session) per
+    attribute. Only the VMs resident on this host and their VIFs are
+    loaded, domids are unique per host only, and networks are fetched per
+    bridge rather than for the whole pool. Everything is dropped after ttl
+    seconds. A miss reloads the VIFs once per ttl since the VIF or VM may
+    just have been created, e.g. on a vif plug event, later misses of the
+    same burst fail without going back to XAPI.
+    """
+    def __init__(self, ttl=XAPI_CACHE_TTL):
+        self.ttl = ttl
+        self.session = None
+        self.host = None
+        self.reset()
+
+    def _xenapi(self):
+        if self.session is None:
+            session = XenAPI.xapi_local()
+            session.login_with_password("", "")
+            self.host = session.xenapi.session.get_this_host(session.handle)
+            self.session = session
+            atexit.register(self.close)
+        return self.session.xenapi
+
+    def _query(self, fetch):
+        try:
+            return fetch(self._xenapi())
+        except XenAPI.Failure:
+            # the session may have expired, retry once with a new one
+            self.session = None
+            return fetch(self._xenapi())
+
+    def close(self):
+        if self.session is not None:
+            try:
+                self.session.xenapi.session.logout()
+            except:
+                pass
+            self.session = None
+
+    def reset(self):
+        self.loaded_at = time.time()
+        self.vms_by_domid = None
+        self.vifs_by_name = {}
+        self.vifs_by_mac = {}
+        self.all_vifs = False
+        self.reloaded = False
+        self.networks_by_bridge = {}
+
+    def _expire(self):
+        if time.time() - self.loaded_at > self.ttl:
+            self.reset()
+
+    def _load_vms(self):
+        vms = self._query(lambda xenapi: xenapi.VM.get_all_records_where(
+            'field "resident_on" = "%s"' % self.host))
+        self.vms_by_domid = {}
+        for vm in vms.values():
+            if vm['domid'] != '-1':
+                self.vms_by_domid[vm['domid']] = vm
+
+    def _load_vifs(self, vm):
+        for vif_ref in vm['VIFs']:
+            vif = self._query(lambda xenapi: xenapi.VIF.get_record(vif_ref))
+            vif_name = "vif%s.%s" % (vm['domid'], vif['device'])
+            self.vifs_by_name[vif_name] = vif
+            self.vifs_by_mac[vif['MAC'].lower()] = vif_name
+
+    def _load_all_vifs(self):
+        self._load_vms()
+        self.vifs_by_name = {}
+        self.vifs_by_mac = {}
+        for vm in self.vms_by_domid.values():
+            self._load_vifs(vm)
+        self.all_vifs = True
+        logging.debug("Loaded %d vifs of %d vms from XenAPI" %
+                      (len(self.vifs_by_name), len(self.vms_by_domid)))
+
+    def _lookup(self, index, key):
+        self._expire()
+        loaded = False
+        if not self.all_vifs:
+            self._load_all_vifs()
+            loaded = True
+        record = getattr(self, index).get(key)
+        if record is None and not loaded and not self.reloaded:
+            self.reloaded = True
+            self._load_all_vifs()
+            record = getattr(self, index).get(key)
+        if record is None:
+            raise PluginError("No XenAPI record found for %s" % key)
+        return record
+
+    def vif(self, vif_name):
+        return self._lookup('vifs_by_name', vif_name)
+
+    def vif_name(self, macaddress):
+        return self._lookup('vifs_by_mac', macaddress.lower())
+
+    def network_for_bridge(self, bridge):
+        self._expire()
+        network = self.networks_by_bridge.get(bridge)
+        if network is None:
+            networks = self._query(lambda xenapi: xenapi.network.get_all_records_where(
+                'field "bridge" = "%s"' % bridge))
+            for network in networks.values():
+                self.networks_by_bridge[network['bridge']] = network
+            network = self.networks_by_bridge.get(bridge)
+        if network is None:
+            raise PluginError("No XenAPI record found for %s" % bridge)
+        return network
+
+    def vif_names_by_macaddress(self):
+        self._expire()
+        if not self.all_vifs:
+            self._load_all_vifs()
+        return dict(self.vifs_by_mac)
+
+def this_host_uuid():
+    """uuid of this host, read from the xensource inventory"""
+    inventory = open("/etc/xensource-inventory")
+    try:
+        for line in inventory:
+            if line.startswith("INSTALLATION_UUID="):
+                return line.split("=", 1)[1].strip().strip("'")
+    finally:
+        inventory.close()
+    raise PluginError("No INSTALLATION_UUID in /etc/xensource-inventory")
+
+_xapi_cache = None
+
+def xapi_cache():
+    """The process wide XapiRecordCache, None where XenAPI is unavailable"""
+    global _xapi_cache
+    if _xapi_cache is None and XenAPI is not None:
+        _xapi_cache = XapiRecordCache()
+    return _xapi_cache
+
 def get_network_id_for_vif(vif_name):
+    cache = xapi_cache()
+    if cache is not None:
+        other_config = cache.vif(vif_name)['other_config']
+        if 'cloudstack-network-id' not in other_config:
+            raise PluginError("%s has no cloudstack-network-id" % vif_name)
+        return other_config['cloudstack-network-id']
     domain_id, device_id = vif_name[3:len(vif_name)].split(".")
-    dom_uuid = do_cmd([XE_PATH, "vm-list", "dom-id=%s" % domain_id, "--minimal"])
+    dom_uuid = do_cmd([XE_PATH, "vm-list", "dom-id=%s" % domain_id,
+                       "resident-on=%s" % this_host_uuid(), "--minimal"])
     vif_uuid = do_cmd([XE_PATH, "vif-list", "vm-uuid=%s" % dom_uuid, "device=%s" % device_id, "--minimal"])
     vnet = do_cmd([XE_PATH, "vif-param-get", "uuid=%s" % vif_uuid,  "param-name=other-config",
                              "param-key=cloudstack-network-id"])
     return vnet
 
+def get_network_other_config(bridge, key):
+    """Value of key in the other-config of the XenServer network of bridge, None if unset"""
+    cache = xapi_cache()
+    if cache is not None:
+        return cache.network_for_bridge(bridge)['other_config'].get(key)
+    xs_nw_uuid = do_cmd([XE_PATH, "network-list", "bridge=%s" % bridge, "--minimal"])
+    try:
+        return do_cmd([XE_PATH, "network-param-get", "uuid=%s" % xs_nw_uuid,
+                       "param-name=other-config", "param-key=%s" % key, "--minimal"])
+    except PluginError:
+        return None
+
 def get_network_id_for_tunnel_port(tunnelif_name):
     vnet = do_cmd([VSCTL_PATH, "get", "interface", tunnelif_name, "options:cloudstack-network-id"])
     return vnet
@@ -245,19 +490,72 @@ def get_ofport_for_vif(vif_name):
     return do_cmd([VSCTL_PATH, "get", "interface", vif_name, "ofport"])
 
 def get_macaddress_of_vif(vif_name):
+    cache = xapi_cache()
+    if cache is not None:
+        return cache.vif(vif_name)['MAC']
     domain_id, device_id = vif_name[3:len(vif_name)].split(".")
-    dom_uuid = do_cmd([XE_PATH, "vm-list", "dom-id=%s" % domain_id, "--minimal"])
+    dom_uuid = do_cmd([XE_PATH, "vm-list", "dom-id=%s" % domain_id,
+                       "resident-on=%s" % this_host_uuid(), "--minimal"])
     vif_uuid = do_cmd([XE_PATH, "vif-list", "vm-uuid=%s" % dom_uuid, "device=%s" % device_id, "--minimal"])
     mac = do_cmd([XE_PATH, "vif-param-get", "uuid=%s" % vif_uuid,  "param-name=MAC"])
     return mac
 
 def get_vif_name_from_macaddress(macaddress):
+    cache = xapi_cache()
+    if cache is not None:
+        return cache.vif_name(macaddress)
     vif_uuid = do_cmd([XE_PATH, "vif-list", "MAC=%s" % macaddress, "--minimal"])
     vif_device_id = do_cmd([XE_PATH, "vif-param-get", "uuid=%s" % vif_uuid,  "param-name=device"])
     vm_uuid = do_cmd([XE_PATH, "vif-param-get", "uuid=%s" % vif_uuid,  "param-name=vm-uuid"])
     vm_domain_id = do_cmd([XE_PATH, "vm-param-get", "uuid=%s" % vm_uuid,  "param-name=dom-id"])
     return "vif"+vm_domain_id+"."+vif_device_id
 
+def _xe_records(*args):
+    """Parses the blank line separated records of an xe ...-list params=..."""
+    records = []
+    record = {}
+    for line in do_cmd([XE_PATH] + list(args)).split('\n'):
+        line = line.strip()
+        if not line:
+            if record:
+                records.append(record)
+                record = {}
+            continue
+        key, value = line.split(':', 1)
+        record[key.split('(')[0].strip()] = value.strip()
+    if record:
+        records.append(record)
+    return records
+
+def get_vif_names_by_macaddress():
+    """
+    Maps the MAC of every VIF of the running VMs to its vif name, looked
+    up at once instead of with four xe calls per MAC
+    """
+    cache = xapi_cache()
+    if cache is not None:
+        return cache.vif_names_by_macaddress()
+    dom_ids = {}
+    for vm in _xe_records("vm-list", "resident-on=%s" % this_host_uuid(), "params=uuid,dom-id"):
+        dom_ids[vm['uuid']] = vm['dom-id']
+    vif_names = {}
+    for vif in _xe_records("vif-list", "params=MAC,device,vm-uuid"):
+        dom_id = dom_ids.get(vif['vm-uuid'])
+        if dom_id is not None and dom_id != '-1':
+            vif_names[vif['MAC'].lower()] = "vif" + dom_id + "." + vif['device']
+    return vif_names
+
+def get_ofports():
+    """Maps every interface known to ovsdb to its ofport with one ovs-vsctl"""
+    ofports = {}
+    output = do_cmd([VSCTL_PATH, "--format=csv", "--data=bare", "--no-headings",
+                     "--columns=name,ofport", "list", "interface"])
+    for line in output.split('\n'):
+        if ',' in line:
+            name, ofport = line.split(',', 1)
+            ofports[name] = ofport
+    return ofports
+
 def add_mac_lookup_table_entry(bridge, mac_address, out_of_port):
     action = "output=%s" %out_of_port
     add_flow(bridge, priority=1100, dl_dst=mac_address, table=1, actions=action)
@@ -265,10 +563,12 @@ def add_mac_lookup_table_entry(bridge, mac_address, out_of_port):
 def delete_mac_lookup_table_entry(bridge, mac_address):
     del_flows(bridge, dl_dst=mac_address, table=1)
 
-def add_ip_lookup_table_entry(bridge, ip, dst_tier_gateway_mac, dst_vm_mac):
+def ip_lookup_table_entry(ip, dst_tier_gateway_mac, dst_vm_mac):
     action_str = "mod_dl_src:%s" % dst_tier_gateway_mac + ",mod_dl_dst:%s" % dst_vm_mac + ",resubmit(,5)"
-    action_str = "table=4, ip, nw_dst=%s" % ip + ",  actions=%s" %action_str
-    addflow = [OFCTL_PATH, "add-flow", bridge, action_str]
+    return "table=4, ip, nw_dst=%s" % ip + ",  actions=%s" %action_str
+
+def add_ip_lookup_table_entry(bridge, ip, dst_tier_gateway_mac, dst_vm_mac):
+    addflow = [OFCTL_PATH, "add-flow", bridge, ip_lookup_table_entry(ip, dst_tier_gateway_mac, dst_vm_mac)]
     do_cmd(addflow)
 
 def get_vms_on_host(vpc, host_id):
@@ -322,6 +622,10 @@ def configure_bridge_for_network_topology(bridge, this_host_id, json_config):
         return "FAILURE:IMPROPER_JSON_CONFG_FILE"
 
     try:
+        vif_names = get_vif_names_by_macaddress()
+        ofports = get_ofports()
+        flows = FlowBatch(bridge)
+
         # get the list of Vm's in the VPC from the JSON config
         this_host_vms = get_vms_on_host(vpconfig, this_host_id)
 
@@ -329,28 +633,27 @@ def configure_bridge_for_network_topology(bridge, this_host_id, json_config):
             for nic in vm.nics:
                 mac_addr = nic.macaddress
                 ip = nic.ipaddress
-                vif_name = get_vif_name_from_macaddress(mac_addr)
-                of_port = get_ofport_for_vif(vif_name)
+                vif_name = vif_names.get(mac_addr.lower())
+                if vif_name is None:
+                    vif_name = get_vif_name_from_macaddress(mac_addr)
+                of_port = ofports.get(vif_name) or get_ofport_for_vif(vif_name)
                 network = get_network_details(vpconfig, nic.networkuuid)
 
                 # Add flow rule in L2 look up table, if the destination mac = MAC of the nic send packet on the found OFPORT
-                add_mac_lookup_table_entry(bridge, mac_addr, of_port)
+                flows.add_flow(priority=1100, dl_dst=mac_addr, table=1, actions="output=%s" % of_port)
 
                 # Add flow rule in L3 look up table: if the destination IP = VM's IP then modify the packet
                 # to set DST MAC = VM's MAC, SRC MAC=tier gateway MAC and send to egress table
-                add_ip_lookup_table_entry(bridge, ip, network.gatewaymac, mac_addr)
+                flows.add_flow_expr(ip_lookup_table_entry(ip, network.gatewaymac, mac_addr))
 
                 # Add flow entry to send with intra tier traffic from the NIC to L2 lookup path)
                 action_str = "table=0, in_port=%s," %of_port + " ip, nw_dst=%s," %network.cidr + " actions=resubmit(,1)"
-                addflow = [OFCTL_PATH, "add-flow", bridge, action_str]
-                do_cmd(addflow)
+                flows.add_flow_expr(action_str)
 
                 #add flow entry to send inter-tier traffic from the NIC to egress ACL table(to L3 lookup path)
                 action_str = "table=0, in_port=%s," % of_port + " ip, dl_dst=%s," %network.gatewaymac +\
                              "nw_dst=%s," %vpconfig.cidr + "actions=resubmit(,3)"
-                addflow = [OFCTL_PATH, "add-flow", bridge, action_str]
-
-                do_cmd(addflow)
+                flows.add_flow_expr(action_str)
 
         # get the list of hosts on which VPC spans from the JSON config
         vpc_spanning_hosts = vpconfig.hosts
@@ -368,15 +671,16 @@ def configure_bridge_for_network_topology(bridge, this_host_id, json_config):
 
                     # generate tunnel name from tunnel naming convention
                     tunnel_name = "t%s-%s-%s" % (gre_key, this_host_id, host.hostid)
-                    of_port = get_ofport_for_vif(tunnel_name)
+                    of_port = ofports.get(tunnel_name) or get_ofport_for_vif(tunnel_name)
 
                     # Add flow rule in L2 look up table, if the destination mac = MAC of the nic send packet tunnel port
-                    add_mac_lookup_table_entry(bridge, mac_addr, of_port)
+                    flows.add_flow(priority=1100, dl_dst=mac_addr, table=1, actions="output=%s" % of_port)
 
                     # Add flow tule in L3 look up table: if the destination IP = VM's IP then modify the packet
                     # set DST MAC = VM's MAC, SRC MAC=tier gateway MAC and send to egress table
-                    add_ip_lookup_table_entry(bridge, ip, network.gatewaymac, mac_addr)
+                    flows.add_flow_expr(ip_lookup_table_entry(ip, network.gatewaymac, mac_addr))
 
+        flows.apply()
         return "SUCCESS: successfully configured bridge as per the VPC topology"
     except:
         logging.debug("An unexpected error occurred while configuring bridge as per VPC topology.")
@@ -397,9 +701,10 @@ def configure_ovs_bridge_for_routing_policies(bridge, json_config):
         return "FAILURE:IMPROPER_JSON_CONFG_FILE"
 
     try:
-        # First flush current ingress and egress ACL's before re-applying the ACL's
-        del_flows(bridge, table=3)
-        del_flows(bridge, table=5)
+        # Current ingress and egress ACL's get flushed and the ACL's re-applied in the same batch
+        flows = FlowBatch(bridge)
+        flows.del_flows(table=3)
+        flows.del_flows(table=5)
 
         egress_rules_added = False
         ingress_rules_added = False
@@ -419,93 +724,70 @@ def configure_ovs_bridge_for_routing_policies(bridge, json_config):
                 protocol = acl_item.protocol
                 source_cidrs = acl_item.sourcecidrs
                 acl_priority = 1000 + number
+
+                nw_proto = IP_PROTOCOLS.get(str(protocol).lower(), protocol)
+                if str(nw_proto).isdigit():
+                    nw_proto = int(nw_proto)
+                elif str(nw_proto).lower() == 'all':
+                    nw_proto = None
+
+                # a port range is matched by its minimal set of tp_dst value/mask pairs
+                tp_dsts = None
+                if (source_port_start is not None or source_port_end is not None) and nw_proto in [6, 17]:
+                    if source_port_start is None:
+                        source_port_start = source_port_end
+                    if source_port_end is None:
+                        source_port_end = source_port_start
+                    tp_dsts = _port_range_masks(int(source_port_start), int(source_port_end))
+
                 for source_cidr in source_cidrs:
                     if direction == "ingress":
                         ingress_rules_added = True
-                        if source_port_start is None and source_port_end is None:
-                            if source_cidr.startswith('0.0.0.0'):
-                                if action == "deny":
-                                    add_flow(bridge, priority= acl_priority, table=5, nw_dst=tier_cidr,
-                                         nw_proto=protocol, actions='drop')
-                                if action == "allow":
-                                    add_flow(bridge, priority= acl_priority,table=5, nw_dst=tier_cidr,
-                                         nw_proto=protocol, actions='resubmit(,1)')
-                            else:
-                                if action == "deny":
-                                    add_flow(bridge, priority= acl_priority, table=5, nw_src=source_cidr, nw_dst=tier_cidr,
-                                         nw_proto=protocol, actions='drop')
-                                if action == "allow":
-                                    add_flow(bridge, priority= acl_priority,table=5, nw_src=source_cidr, nw_dst=tier_cidr,
-                                         nw_proto=protocol, actions='resubmit(,1)')
-                            continue
-
-                        # add flow rule to do action (allow/deny) for flows where source IP of the packet is in
-                        # source_cidr and destination ip is in tier_cidr
-                        port = source_port_start
-                        while (port < source_port_end):
-                            if source_cidr.startswith('0.0.0.0'):
-                                if action == "deny":
-                                    add_flow(bridge, priority= acl_priority, table=5, nw_dst=tier_cidr, tp_dst=port,
-                                         nw_proto=protocol, actions='drop')
-                                if action == "allow":
-                                    add_flow(bridge, priority= acl_priority,table=5, nw_dst=tier_cidr, tp_dst=port,
-                                         nw_proto=protocol, actions='resubmit(,1)')
-                            else:
-                                if action == "deny":
-                                    add_flow(bridge, priority= acl_priority, table=5, nw_src=source_cidr, nw_dst=tier_cidr, tp_dst=port,
-                                         nw_proto=protocol, actions='drop')
-                                if action == "allow":
-                                    add_flow(bridge, priority= acl_priority,table=5, nw_src=source_cidr, nw_dst=tier_cidr, tp_dst=port,
-                                         nw_proto=protocol, actions='resubmit(,1)')
-                            port = port + 1
-
+                        table = 5
+                        allow = 'resubmit(,1)'
+                        # flows where source IP of the packet is in source_cidr and destination ip is in tier_cidr
+                        match = {'nw_dst': tier_cidr}
+                        if not source_cidr.startswith('0.0.0.0'):
+                            match['nw_src'] = source_cidr
                     elif direction == "egress":
                         egress_rules_added = True
-                        if source_port_start is None and source_port_end is None:
-                            if source_cidr.startswith('0.0.0.0'):
-                                if action == "deny":
-                                    add_flow(bridge, priority= acl_priority, table=3, nw_dst=tier_cidr,
-                                         nw_proto=protocol, actions='drop')
-                                if action == "allow":
-                                    add_flow(bridge, priority= acl_priority,table=3, nw_dst=tier_cidr,
-                                         nw_proto=protocol, actions='resubmit(,4)')
-                            else:
-                                if action == "deny":
-                                    add_flow(bridge, priority= acl_priority, table=3, nw_src=source_cidr, nw_dst=tier_cidr,
-                                         nw_proto=protocol, actions='drop')
-                                if action == "allow":
-                                    add_flow(bridge, priority= acl_priority,table=3, nw_src=source_cidr, nw_dst=tier_cidr,
-                                         nw_proto=protocol, actions='resubmit(,4)')
-                            continue
-
-                        # add flow rule to do action (allow/deny) for flows where destination IP of the packet is in
-                        # source_cidr and source ip is in tier_cidr
-                        port = source_port_start
-                        while (port < source_port_end):
-                            if source_cidr.startswith('0.0.0.0'):
-                                if action == "deny":
-                                    add_flow(bridge, priority= acl_priority, table=3, nw_dst=source_cidr, tp_dst=port,
-                                             nw_proto=protocol, actions='drop')
-                                if action == "allow":
-                                    add_flow(bridge, priority= acl_priority, table=3, nw_dst=source_cidr, tp_dst=port,
-                                             nw_proto=protocol, actions='resubmit(,4)')
-                            else:
-                                if action == "deny":
-                                    add_flow(bridge, priority= acl_priority, table=3, nw_src=tier_cidr, nw_dst=source_cidr, tp_dst=port,
-                                             nw_proto=protocol, actions='drop')
-                                if action == "allow":
-                                    add_flow(bridge, priority= acl_priority, table=3, nw_src=tier_cidr, nw_dst=source_cidr, tp_dst=port,
-                                             nw_proto=protocol, actions='resubmit(,4)')
-                            port = port + 1
+                        table = 3
+                        allow = 'resubmit(,4)'
+                        if tp_dsts is None:
+                            match = {'nw_dst': tier_cidr}
+                            if not source_cidr.startswith('0.0.0.0'):
+                                match['nw_src'] = source_cidr
+                        else:
+                            # flows where destination IP of the packet is in source_cidr and source ip is in tier_cidr
+                            match = {'nw_dst': source_cidr}
+                            if not source_cidr.startswith('0.0.0.0'):
+                                match['nw_src'] = tier_cidr
+                    else:
+                        continue
+
+                    if action == "deny":
+                        actions = 'drop'
+                    elif action == "allow":
+                        actions = allow
+                    else:
+                        continue
+
+                    if nw_proto is not None:
+                        match['nw_proto'] = nw_proto
+                    for tp_dst in tp_dsts or [None]:
+                        if tp_dst is not None:
+                            match['tp_dst'] = tp_dst
+                        flows.add_flow(priority=acl_priority, table=table, actions=actions, **match)
 
         if egress_rules_added is False:
             # add a default rule in egress table to forward packet to L3 lookup table
-            add_flow(bridge, priority=0, table=3, actions='resubmit(,4)')
+            flows.add_flow(priority=0, table=3, actions='resubmit(,4)')
 
         if ingress_rules_added is False:
             # add a default rule in ingress table drop packets
-            add_flow(bridge, priority=0, table=5, actions='drop')
+            flows.add_flow(priority=0, table=5, actions='drop')
 
+        flows.apply()
         return "SUCCESS: successfully configured bridge as per the later routing policies of the VPC"
 
     except:
@@ -86,23 +86,16 @@ def main(command, vif_raw):
     bridge = pluginlib.do_cmd([pluginlib.VSCTL_PATH, 'iface-to-br', this_vif])
     
     # find xs network for this bridge, verify is used for ovs tunnel network
-    xs_nw_uuid = pluginlib.do_cmd([pluginlib.XE_PATH, "network-list",
-								   "bridge=%s" % bridge, "--minimal"])
     ovs_tunnel_network = False
     try:
-        ovs_tunnel_network = pluginlib.do_cmd([pluginlib.XE_PATH,"network-param-get",
-						       "uuid=%s" % xs_nw_uuid,
-						       "param-name=other-config",
-						       "param-key=is-ovs-tun-network", "--minimal"])
+        ovs_tunnel_network = pluginlib.get_network_other_config(bridge, "is-ovs-tun-network")
     except:
         pass
 
     ovs_vpc_distributed_vr_network = False
     try:
-        ovs_vpc_distributed_vr_network = pluginlib.do_cmd([pluginlib.XE_PATH,"network-param-get",
-						       "uuid=%s" % xs_nw_uuid,
-						       "param-name=other-config",
-						       "param-key=is-ovs-vpc-distributed-vr-network", "--minimal"])
+        ovs_vpc_distributed_vr_network = pluginlib.get_network_other_config(bridge,
+                                                   "is-ovs-vpc-distributed-vr-network")
     except:
         pass
 
@@ -115,10 +108,10 @@ def main(command, vif_raw):
         vsctl_output = pluginlib.do_cmd([pluginlib.VSCTL_PATH,
                                          'list-ports', bridge])
         vifs = vsctl_output.split('\n')
+        ofports = pluginlib.get_ofports()
         vif_ofports = []
         for vif in vifs:
-            vif_ofport = pluginlib.do_cmd([pluginlib.VSCTL_PATH, 'get',
-                                           'Interface', vif, 'ofport'])
+            vif_ofport = ofports.get(vif) or pluginlib.get_ofport_for_vif(vif)
             if this_vif == vif:
                 this_vif_ofport = vif_ofport
             if vif.startswith('vif'):
@@ -146,8 +139,9 @@ def main(command, vif_raw):
         vnet_all_ofports = []
 
         ports = vsctl_output.split('\n')
+        ofports = pluginlib.get_ofports()
         for port in ports:
-            if_ofport = pluginlib.do_cmd([pluginlib.VSCTL_PATH, 'get', 'Interface', port, 'ofport'])
+            if_ofport = ofports.get(port) or pluginlib.get_ofport_for_vif(port)
             if port.startswith('vif'):
                 # check VIF is in same network as that of plugged vif
                 if vif_network_id != pluginlib.get_network_id_for_vif(port):
@@ -179,7 +173,7 @@ def main(command, vif_raw):
 
             #learn that MAC is reachable through the VIF port
             mac = pluginlib.get_macaddress_of_vif(this_vif)
-            this_vif_ofport = pluginlib.do_cmd([pluginlib.VSCTL_PATH, 'get', 'Interface', this_vif, 'ofport'])
+            this_vif_ofport = ofports.get(this_vif) or pluginlib.get_ofport_for_vif(this_vif)
             pluginlib.add_mac_lookup_table_entry(bridge, mac, this_vif_ofport)
 
         if command == 'offline':
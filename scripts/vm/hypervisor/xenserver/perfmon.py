@@ -19,11 +19,20 @@
 import pprint
 import XenAPI
 import urllib
-from xml.dom import minidom
+import xml.sax
+import xml.sax.handler
+from array import array
+import cPickle
+import fcntl
+import logging
+import os
 import time
-import commands
 
-# Per VM dictionary (used by RRDUpdates to look up column numbers by variable names)
+PERFMON_STATE_PATH = "/var/run/cloud/perfmon.state"
+# history kept by the 60 seconds archive of xapi's RRDs
+MAX_RETENTION = 7200
+
+# Per VM dictionary (used by RRDUpdates to look up the samples of a variable by name)
 class VMReport(dict):
     """Used internally by RRDUpdates"""
     def __init__(self, uuid):
@@ -31,7 +40,7 @@ class VMReport(dict):
         super(dict, self).__init__()
 
 
-# Per Host dictionary (used by RRDUpdates to look up column numbers by variable names)
+# Per Host dictionary (used by RRDUpdates to look up the samples of a variable by name)
 class HostReport(dict):
     """Used internally by RRDUpdates"""
     def __init__(self, uuid):
@@ -51,6 +60,50 @@ class UsageException(Exception):
     pass
 
 
+class RRDUpdatesHandler(xml.sax.handler.ContentHandler):
+    """
+    Streams an rrd_updates document into one array of doubles per column,
+    without building a DOM of the whole download
+    """
+    def __init__(self):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.meta = {}
+        self.legend = []
+        self.timestamps = array('l')
+        self.columns = []
+        self.text = []
+        self.col = 0
+
+    def startElement(self, name, attrs):
+        self.text = []
+        if name == 'row':
+            self.col = 0
+        elif name == 'data':
+            self.columns = [array('d') for entry in self.legend]
+
+    def characters(self, content):
+        self.text.append(content)
+
+    def endElement(self, name):
+        text = "".join(self.text).strip()
+        self.text = []
+        if name == 'v':
+            self.columns[self.col].append(float(text))
+            self.col += 1
+        elif name == 't':
+            self.timestamps.append(int(text))
+        elif name == 'entry':
+            self.legend.append(text)
+        elif name in ('rows', 'columns', 'start', 'step', 'end'):
+            self.meta[name] = int(text)
+
+    def endDocument(self):
+        # the rows come in reverse chronological order
+        self.timestamps.reverse()
+        for column in self.columns:
+            column.reverse()
+
+
 class RRDUpdates:
     """ Object used to get and parse the output the http://localhost/rrd_udpates?...
     """
@@ -61,6 +114,12 @@ class RRDUpdates:
         self.params['host'] = 'false'   # include data for host (as well as for VMs)
         self.params['cf'] = 'AVERAGE'  # consolidation function, each sample averages 12 from the 5 second RRD
         self.params['interval'] = '60'
+        # vm_reports matches uuid to per VM report
+        self.vm_reports = {}
+        # There is just one host_report and its uuid should not change!
+        self.host_report = None
+        self.timestamps = array('l')
+        self.rows = 0
 
     def get_nrows(self):
         return self.rows
@@ -75,7 +134,7 @@ class RRDUpdates:
         return report.keys()
 
     def get_total_cpu_core(self, uuid):
-	report = self.vm_reports[uuid]
+        report = self.vm_reports[uuid]
         if not report:
             return 0
         else:
@@ -87,11 +146,11 @@ class RRDUpdates:
             return result
 
     def get_vm_data(self, uuid, param, row):
-	#pp = pprint.PrettyPrinter(indent=4) 
-	#pp.pprint(self.vm_reports)
-        report = self.vm_reports[uuid]
-        col = report[param]
-        return self.__lookup_data(col, row)
+        return self.vm_reports[uuid][param][row]
+
+    def get_vm_samples(self, uuid, param, count):
+        """The last count samples of param of the VM, oldest first"""
+        return self.vm_reports[uuid][param][-count:]
 
     def get_host_uuid(self):
         report = self.host_report
@@ -106,115 +165,277 @@ class RRDUpdates:
         return report.keys()
 
     def get_host_data(self, param, row):
-        report = self.host_report
-        col = report[param]
-        return self.__lookup_data(col, row)
+        return self.host_report[param][row]
 
     def get_row_time(self, row):
-        return self.__lookup_timestamp(row)
-
-    # extract float from value (<v>) node by col,row
-    def __lookup_data(self, col, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[col + 1]
-        return float(node.firstChild.toxml())  # node.firstChild should have nodeType TEXT_NODE
-
-    # extract int from value (<t>) node by row
-    def __lookup_timestamp(self, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[0]
-        return int(node.firstChild.toxml())  # node.firstChild should have nodeType TEXT_NODE
-
-    def refresh(self, login, starttime, session, override_params):
+        return self.timestamps[row]
+
+    def refresh(self, login, starttime, session, override_params, hosts=None):
+        """
+        Fetches the updates of the given hosts, of this host when none are
+        given
+        """
         self.params['start'] = starttime
         params = override_params
         params['session_id'] = session
         params.update(self.params)
         paramstr = "&".join(["%s=%s" % (k, params[k]) for k in params])
-        # this is better than urllib.urlopen() as it raises an Exception on http 401 'Unauthorised' error
-        # rather than drop into interactive mode
-	for host in login.host.get_all():
-		#print "http://" + str(login.host.get_address(host)) + "/rrd_updates?%s" % paramstr
-        	sock = urllib.URLopener().open("http://" + str(login.host.get_address(host)) + "/rrd_updates?%s" % paramstr)
-	        xmlsource = sock.read()
-        	sock.close()
-        	xmldoc = minidom.parseString(xmlsource)
-        	self.__parse_xmldoc(xmldoc)
-        	# Update the time used on the next run
-        	self.params['start'] = self.end_time + 1  # avoid retrieving same data twice
-
-    def __parse_xmldoc(self, xmldoc):
-        # The 1st node contains meta data (description of the data)
-        # The 2nd node contains the data
-        self.meta_node = xmldoc.firstChild.childNodes[0]
-        self.data_node = xmldoc.firstChild.childNodes[1]
-
-        def lookup_metadata_bytag(name):
-            return int(self.meta_node.getElementsByTagName(name)[0].firstChild.toxml())
-            # rows = number of samples per variable
+        if hosts is None:
+            hosts = [login.session.get_this_host(session)]
+        end_time = None
+        for host in hosts:
+            # this is better than urllib.urlopen() as it raises an Exception on http 401 'Unauthorised' error
+            # rather than drop into interactive mode
+            sock = urllib.URLopener().open("http://" + str(login.host.get_address(host)) + "/rrd_updates?%s" % paramstr)
+            try:
+                handler = RRDUpdatesHandler()
+                xml.sax.parse(sock, handler)
+            finally:
+                sock.close()
+            self.__add_updates(handler)
+            end_time = max(end_time, handler.meta['end'])
+        # Update the time used on the next run
+        if end_time is not None:
+            self.params['start'] = end_time + 1  # avoid retrieving same data twice
+
+    def __add_updates(self, handler):
+        # rows = number of samples per variable
         # columns = number of variables
-        self.rows = lookup_metadata_bytag('rows')
-        self.columns = lookup_metadata_bytag('columns')
+        self.rows = handler.meta['rows']
+        self.columns = handler.meta['columns']
         # These indicate the period covered by the data
-        self.start_time = lookup_metadata_bytag('start')
-        self.step_time = lookup_metadata_bytag('step')
-        self.end_time = lookup_metadata_bytag('end')
-        # the <legend> Node describes the variables
-        self.legend = self.meta_node.getElementsByTagName('legend')[0]
-        # vm_reports matches uuid to per VM report
-        if not hasattr(self,'vm_reports'):
-		self.vm_reports = {}
-        # There is just one host_report and its uuid should not change!
-        self.host_report = None
+        self.start_time = handler.meta['start']
+        self.step_time = handler.meta['step']
+        self.end_time = handler.meta['end']
+        self.timestamps = handler.timestamps
         # Handle each column.  (I.e. each variable)
-        for col in range(self.columns):
-            self.__handle_col(col)
+        for col in range(len(handler.legend)):
+            self.__handle_col(handler.legend[col], handler.columns[col])
 
-    def __handle_col(self, col):
-        # work out how to interpret col from the legend
-        col_meta_data = self.legend.childNodes[col].firstChild.toxml()
+    def __handle_col(self, col_meta_data, samples):
         # vm_or_host will be 'vm' or 'host'.  Note that the Control domain counts as a VM!
         (cf, vm_or_host, uuid, param) = col_meta_data.split(':')
         if vm_or_host == 'vm':
             # Create a report for this VM if it doesn't exist
             if not uuid in self.vm_reports:
                 self.vm_reports[uuid] = VMReport(uuid)
-                # Update the VMReport with the col data and meta data
-            vm_report = self.vm_reports[uuid]
-            vm_report[param] = col
+            # Update the VMReport with the samples of the variable
+            self.vm_reports[uuid][param] = samples
         elif vm_or_host == 'host':
             # Create a report for the host if it doesn't exist
             if not self.host_report:
                 self.host_report = HostReport(uuid)
             elif self.host_report.uuid != uuid:
                 raise PerfMonException("Host UUID changed: (was %s, is %s)" % (self.host_report.uuid, uuid))
-                # Update the HostReport with the col data and meta data
-            self.host_report[param] = col
+            # Update the HostReport with the samples of the variable
+            self.host_report[param] = samples
         else:
             raise PerfMonException("Invalid string in <legend>: %s" % col_meta_data)
 
-def getuuid(vm_name):
-    status, output = commands.getstatusoutput("xe vm-list | grep "+vm_name+" -B 1 | head -n 1 | awk -F':' '{print $2}' | tr -d ' '")
-    if (status != 0):
-	raise PerfMonException("Invalid vm name: %s" % vm_name)
-    return output
+class SampleWindow(object):
+    """
+    Prefix sums of the samples of one variable, the sum of the last n
+    samples takes one subtraction whatever n is. Up to twice the capacity
+    is kept so the array is only rebuilt every capacity samples.
+    """
+    def __init__(self):
+        self.sums = array('d', [0.0])
+        self.capacity = None
 
-def get_vm_group_perfmon(args={}):
+    def __getstate__(self):
+        return (self.capacity, self.sums.tostring())
+
+    def __setstate__(self, state):
+        self.capacity, sums = state
+        self.sums = array('d')
+        self.sums.fromstring(sums)
+
+    def extend(self, samples):
+        total = self.sums[-1]
+        for sample in samples:
+            total += sample
+            self.sums.append(total)
+
+    def trim(self, capacity):
+        self.capacity = capacity
+        if len(self.sums) > 2 * capacity + 1:
+            base = self.sums[-capacity - 1]
+            self.sums = array('d', [total - base for total in self.sums[-capacity - 1:]])
+
+    def count(self, n):
+        if self.capacity is not None:
+            n = min(n, self.capacity)
+        return min(n, len(self.sums) - 1)
+
+    def sum(self, n):
+        return self.sums[-1] - self.sums[-1 - self.count(n)]
+
+
+class PerfMonSampler(object):
+    """
+    Rolling per VM sample windows of each host, kept across plugin calls
+    in a pickled state file. Every refresh only pulls the rows of a host
+    newer than the cursor of the previous refresh of that host, and
+    averages over any window come from the prefix sums of the
+    SampleWindows.
+    """
+    def __init__(self):
+        self.since = None
+        self.retention = 0
+        self.ends = {}
+        self.windows = {}
+        self.uuids = {}
+
+    def refresh(self, login, session, duration, hosts):
+        """
+        hosts maps each host to the uuids of the vms asked about that run
+        on it, only the windows of those vms are kept
+        """
+        now = int(time.time())
+        retention = min(max(self.retention, duration), MAX_RETENTION)
+        if self.since is None or self.since > now - retention:
+            # the windows can't be extended to what is asked, start over
+            self.ends = {}
+            self.windows = {}
+            self.since = now - retention
+        self.retention = retention
+
+        for host, uuids in hosts.items():
+            end = self.ends.get(host)
+            windows = self.windows.get(host, {})
+            missing = [uuid for uuid in uuids if uuid not in windows]
+            if end is None or now - end > retention or missing:
+                # not fetched from this host lately, or the history of a
+                # vm newly asked about was not kept, start it over
+                windows = {}
+                start = now - retention
+            else:
+                start = end + 1
+
+            rrd_updates = RRDUpdates()
+            rrd_updates.refresh(login, start, session, {}, [host])
+            self.ends[host] = rrd_updates.params['start'] - 1
+            if rrd_updates.get_nrows() == 0:
+                self.windows[host] = windows
+                continue
+
+            host_windows = {}
+            for uuid in rrd_updates.get_vm_list():
+                if uuid not in uuids:
+                    continue
+                host_windows[uuid] = windows.get(uuid, {})
+                for param in rrd_updates.get_vm_param_list(uuid):
+                    if param not in host_windows[uuid]:
+                        host_windows[uuid][param] = SampleWindow()
+                    window = host_windows[uuid][param]
+                    window.extend(rrd_updates.vm_reports[uuid][param])
+                    window.trim(retention / 60)
+            # vms gone from the updates of the host or no longer asked
+            # about are dropped
+            self.windows[host] = host_windows
+
+        for host in self.windows.keys():
+            if host not in hosts:
+                del self.windows[host]
+                del self.ends[host]
+
+    def vm_uuid(self, login, vm_name):
+        if vm_name not in self.uuids:
+            self.uuids = get_vm_uuids(login)
+        if vm_name not in self.uuids:
+            raise PerfMonException("Invalid vm name: %s" % vm_name)
+        return self.uuids[vm_name]
+
+    def vm_location(self, login, vm_name):
+        """The uuid of the VM and the host it is resident on"""
+        uuid = self.vm_uuid(login, vm_name)
+        try:
+            vm = login.VM.get_by_uuid(uuid)
+        except XenAPI.Failure:
+            # the VM was recreated under the same name since the lookup
+            self.uuids = {}
+            uuid = self.vm_uuid(login, vm_name)
+            vm = login.VM.get_by_uuid(uuid)
+        return uuid, login.VM.get_resident_on(vm)
+
+    def has_samples(self, uuid, host):
+        return uuid in self.windows.get(host, {})
+
+    def average_cpu(self, uuid, host, rows):
+        windows = self.windows[host][uuid]
+        samples = 0
+        total = 0.0
+        for param in windows:
+            if param.startswith("cpu") and param[3:].isdigit():
+                window = windows[param]
+                samples += window.count(rows)
+                total += window.sum(rows)
+        if samples == 0:
+            return 0
+        return total / samples
+
+    def average_memory(self, uuid, host, rows):
+        windows = self.windows[host][uuid]
+        if "memory_target" not in windows or "memory_internal_free" not in windows:
+            return 0
+        target = windows["memory_target"]
+        samples = target.count(rows)
+        if samples == 0:
+            return 0
+        return (target.sum(rows) / 1048576 - windows["memory_internal_free"].sum(rows) / 1024) / samples
+
+def load_sampler(path=PERFMON_STATE_PATH):
+    try:
+        state = open(path, 'rb')
+        try:
+            sampler = cPickle.load(state)
+        finally:
+            state.close()
+    except:
+        return PerfMonSampler()
+    if not hasattr(sampler, 'ends'):
+        # state written by a version keeping a single cursor
+        return PerfMonSampler()
+    return sampler
+
+def save_sampler(sampler, path=PERFMON_STATE_PATH):
+    tmp = path + ".tmp"
+    state = open(tmp, 'wb')
+    try:
+        cPickle.dump(sampler, state, 2)
+    finally:
+        state.close()
+    os.rename(tmp, path)
+
+def get_vm_uuids(login):
+    """Maps the name of every VM to its uuid, with one XenAPI call"""
+    uuids = {}
+    for record in login.VM.get_all_records().values():
+        if record['is_a_template'] or record['is_a_snapshot']:
+            continue
+        uuids[record['name_label']] = record['uuid']
+    return uuids
+
+def get_vm_group_perfmon(args={}, login=None):
+    """
+    Averages of the requested counters of a group of VMs. login is the
+    session of the calling plugin, a local one is opened when not given.
+    """
+    if login is not None:
+        return _get_vm_group_perfmon(login, args)
     login = XenAPI.xapi_local()
     login.login_with_password("","")
-    result = ""
+    try:
+        return _get_vm_group_perfmon(login, args)
+    finally:
+        login.xenapi.session.logout()
+
+def _get_vm_group_perfmon(login, args):
+    result = []
 
     total_vm = int(args['total_vm'])
     total_counter = int(args['total_counter'])
-    now = int(time.time()) / 60
 
-    # Get pool's info of this host
-    #pool = login.xenapi.pool.get_all()[0]
-    # Get master node's address of pool
-    #master = login.xenapi.pool.get_master(pool)
-    #master_address = login.xenapi.host.get_address(master)
     session = login._session
 
     max_duration = 0
@@ -223,39 +444,40 @@ def get_vm_group_perfmon(args={}):
         if duration > max_duration:
             max_duration = duration
 
-    rrd_updates = RRDUpdates()
-    rrd_updates.refresh(login.xenapi, now * 60 - max_duration, session, {})
-
-    #for uuid in rrd_updates.get_vm_list():
-    for vm_count in xrange(1, total_vm + 1):
-	vm_name = args['vmname' + str(vm_count)]
-        vm_uuid = getuuid(vm_name)
-        #print "Got values for VM: " + str(vm_count) + " " + vm_uuid
-        for counter_count in xrange(1, total_counter + 1):
-	    #refresh average
-	    average_cpu = 0
-	    average_memory = 0
-            counter = args['counter' + str(counter_count)]
-            total_row = rrd_updates.get_nrows()
-            duration = int(args['duration' + str(counter_count)]) / 60
-            duration_diff = total_row - duration
-            if counter == "cpu":
-		total_cpu = rrd_updates.get_total_cpu_core(vm_uuid)
-                for row in xrange(duration_diff, total_row):
-                    for cpu in xrange(0, total_cpu):
-                        average_cpu += rrd_updates.get_vm_data(vm_uuid, "cpu" + str(cpu), row)
-                average_cpu /= (duration * total_cpu)
-                if result == "":
-                    result += str(vm_count) + '.' +  str(counter_count) + ':' + str(average_cpu)
+    if not os.path.exists(os.path.dirname(PERFMON_STATE_PATH)):
+        os.makedirs(os.path.dirname(PERFMON_STATE_PATH))
+    lock = open(PERFMON_STATE_PATH + ".lock", 'a')
+    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    try:
+        sampler = load_sampler()
+        # the updates are fetched from the hosts the vms are running on
+        vms = []
+        hosts = {}
+        for vm_count in xrange(1, total_vm + 1):
+            vm_name = args['vmname' + str(vm_count)]
+            vm_uuid, vm_host = sampler.vm_location(login.xenapi, vm_name)
+            vms.append((vm_count, vm_name, vm_uuid, vm_host))
+            if vm_host != "OpaqueRef:NULL":
+                hosts.setdefault(vm_host, {})[vm_uuid] = True
+        sampler.refresh(login.xenapi, session, max_duration, hosts)
+
+        for (vm_count, vm_name, vm_uuid, vm_host) in vms:
+            if not sampler.has_samples(vm_uuid, vm_host):
+                logging.warning("No performance samples of vm %s, it is not running or its host has no updates yet" % vm_name)
+                continue
+            for counter_count in xrange(1, total_counter + 1):
+                counter = args['counter' + str(counter_count)]
+                rows = int(args['duration' + str(counter_count)]) / 60
+                if counter == "cpu":
+                    average = sampler.average_cpu(vm_uuid, vm_host, rows)
+                elif counter == "memory":
+                    average = sampler.average_memory(vm_uuid, vm_host, rows)
                 else:
-                    result += ',' + str(vm_count) +  '.' + str(counter_count) + ':' + str(average_cpu)
-            elif counter == "memory":
-                for row in xrange(duration_diff, total_row):
-                    average_memory += rrd_updates.get_vm_data(vm_uuid, "memory_target", row) / 1048576 - rrd_updates.get_vm_data(vm_uuid, "memory_internal_free", row) / 1024
-                average_memory /= duration
-                if result == "":
-                    result += str(vm_count) +  '.' +  str(counter_count) + ':' + str(average_memory)
-                else:
-                    result += ',' + str(vm_count) +  '.' +  str(counter_count) + ':' + str(average_memory)
-    return result
-
+                    continue
+                result.append(str(vm_count) + '.' + str(counter_count) + ':' + str(average))
+
+        save_sampler(sampler)
+    finally:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        lock.close()
+    return ','.join(result)
@@ -27,6 +27,10 @@ from optparse import OptionParser, OptionGroup, OptParseError, BadOptionError, O
 import re
 import traceback
 import libvirt
+import subprocess
+import time
+import hashlib
+import fcntl
 
 logpath = "/var/run/cloud/"        # FIXME: Logs should reside in /var/log/cloud
 iptables = Command("iptables")
@@ -36,6 +40,304 @@ ebtables = Command("ebtables")
 def execute(cmd):
     logging.debug(cmd)
     return bash("-c", cmd).stdout
+def restore(cmd, payload):
+    logging.debug(' '.join(cmd) + " <<\n" + payload)
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (stdout, stderr) = proc.communicate(payload)
+    if proc.returncode != 0:
+        raise Exception("%s failed with %d: %s" % (' '.join(cmd), proc.returncode, stderr.strip()))
+    return stdout
+
+class IptablesRuleset(object):
+    '''
+    Filter table changes applied in one iptables-restore --noflush
+    transaction. Declared chains are created, or flushed if they exist,
+    then the rules (any -A/-D/-I command line) are applied in order. The
+    whole set applies atomically and takes a single process spawn.
+    '''
+    def __init__(self):
+        self.chains = []
+        self.rules = []
+
+    def chain(self, name):
+        if name not in self.chains:
+            self.chains.append(name)
+
+    def add(self, rule):
+        self.rules.append(rule)
+
+    def render(self):
+        lines = ["*filter"]
+        lines += [":" + chain + " - [0:0]" for chain in self.chains]
+        lines += self.rules
+        lines.append("COMMIT")
+        return '\n'.join(lines) + '\n'
+
+    def apply(self):
+        if len(self.chains) == 0 and len(self.rules) == 0:
+            return
+        restore(["iptables-restore", "--noflush"], self.render())
+
+def lock_ebtables():
+    '''
+    Serializes the ebtables nat changes of concurrent agent calls, a
+    save/restore cycle would otherwise drop the chains another call added
+    between the save and the restore
+    '''
+    if not os.path.exists(logpath):
+        os.makedirs(logpath)
+    lockf = open(logpath + "ebtables.lock", 'a')
+    fcntl.flock(lockf.fileno(), fcntl.LOCK_EX)
+    return lockf
+
+def unlock_ebtables(lockf):
+    fcntl.flock(lockf.fileno(), fcntl.LOCK_UN)
+    lockf.close()
+
+class EbtablesNatRuleset(object):
+    '''
+    The ebtables nat table as read by one ebtables-save. It is edited in
+    memory and written back with one ebtables-restore, which swaps in the
+    whole table at once. The ebtables lock is held from the save until
+    apply() or release(), so callers must release() on failure.
+    '''
+    def __init__(self):
+        self.chains = []
+        self.rules = []
+        self.lockf = lock_ebtables()
+        try:
+            self.load()
+        except:
+            self.release()
+            raise
+
+    def load(self):
+        table = None
+        for line in execute("ebtables-save").split('\n'):
+            line = line.strip()
+            if line == "" or line.startswith('#'):
+                continue
+            if line.startswith('*'):
+                table = line[1:]
+            elif table != "nat":
+                continue
+            elif line.startswith(':'):
+                self.chains.append(line[1:].split())
+            else:
+                self.rules.append(line)
+        if len(self.chains) == 0:
+            self.chains = [["PREROUTING", "ACCEPT"], ["OUTPUT", "ACCEPT"], ["POSTROUTING", "ACCEPT"]]
+
+    def remove_vm(self, vm_name):
+        vmchains = ebtables_chains_for_vm(vm_name)
+        self.chains = [chain for chain in self.chains if chain[0] not in vmchains]
+        rules = []
+        for rule in self.rules:
+            chain = rule.split()[1]
+            if chain in vmchains:
+                continue
+            if chain in ["PREROUTING", "POSTROUTING"] and vm_name in rule:
+                continue
+            rules.append(rule)
+        self.rules = rules
+
+    def chain(self, name):
+        self.chains.append([name, "ACCEPT"])
+
+    def add(self, rule):
+        self.rules.append(rule)
+
+    def render(self):
+        lines = ["*nat"]
+        lines += [":" + ' '.join(chain) for chain in self.chains]
+        lines += self.rules
+        return '\n'.join(lines) + '\n'
+
+    def apply(self):
+        try:
+            restore(["ebtables-restore"], self.render())
+        finally:
+            self.release()
+
+    def release(self):
+        if self.lockf is not None:
+            unlock_ebtables(self.lockf)
+            self.lockf = None
+
+class ChainIndex(object):
+    '''
+    Chains and rules of one table, parsed from a single iptables-save or
+    ebtables-save snapshot so lookups don't need a save per query
+    '''
+    def __init__(self, save, table):
+        self.chains = []
+        self.rules = {}
+        current = None
+        for line in save.split('\n'):
+            line = line.strip()
+            if line == "" or line.startswith('#'):
+                continue
+            if line.startswith('*'):
+                current = line[1:]
+            elif current != table:
+                continue
+            elif line.startswith(':'):
+                chain = line[1:].split()[0]
+                self.chains.append(chain)
+                self.rules[chain] = []
+            elif line.startswith('-A '):
+                chain = line.split()[1]
+                if chain not in self.rules:
+                    self.chains.append(chain)
+                    self.rules[chain] = []
+                self.rules[chain].append(line)
+
+    def grep(self, pattern, chain=None):
+        if chain is not None:
+            chains = [chain]
+        else:
+            chains = self.chains
+        return [rule for c in chains for rule in self.rules.get(c, []) if re.search(pattern, rule)]
+
+def iptables_index():
+    return ChainIndex(execute("iptables-save -t filter"), "filter")
+
+def ebtables_index():
+    return ChainIndex(execute("ebtables-save"), "nat")
+
+class RuleStateStore(object):
+    '''
+    Programmed rule state of every vm of the host, kept as an append-only
+    journal of "vmName,vmID,vmIP,domID,signature,seqno,rulehash" records
+    where a lone "vmName" record removes the vm. The last record of a vm
+    wins and a torn trailing line is ignored, so a crash never loses more
+    than the write in flight. The journal is rewritten through a rename
+    once it holds too many superseded records.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.states = {}
+        self.records = 0
+        if not os.path.exists(self.path):
+            lock = self.lock()
+            try:
+                if not os.path.exists(self.path):
+                    self.import_rule_logs()
+            finally:
+                self.unlock(lock)
+        self.load()
+
+    def lock(self):
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        lockf = open(self.path + ".lock", 'a')
+        fcntl.flock(lockf.fileno(), fcntl.LOCK_EX)
+        return lockf
+
+    def unlock(self, lockf):
+        fcntl.flock(lockf.fileno(), fcntl.LOCK_UN)
+        lockf.close()
+
+    def load(self):
+        self.states = {}
+        self.records = 0
+        if not os.path.exists(self.path):
+            return
+        journal = open(self.path)
+        try:
+            for line in journal:
+                if not line.endswith('\n'):
+                    break
+                fields = line.rstrip('\n').split(',')
+                self.records += 1
+                if len(fields) == 7:
+                    self.states[fields[0]] = fields[1:]
+                elif len(fields) == 1:
+                    self.states.pop(fields[0], None)
+        finally:
+            journal.close()
+
+    def import_rule_logs(self):
+        '''
+        picks up the per vm .log files written before the journal existed,
+        only "vmName.log" files holding a rule log record are imported and
+        removed, other logs in the directory are left alone
+        '''
+        imported = []
+        logs = [f for f in os.listdir(os.path.dirname(self.path)) if f.endswith(".log")]
+        for log in logs:
+            try:
+                fields = open(os.path.join(os.path.dirname(self.path), log)).readline().rstrip().split(',')
+                if len(fields) == 6 and fields[0] + ".log" == log:
+                    self.states[fields[0]] = fields[1:] + ['_']
+                    imported.append(log)
+            except:
+                logging.debug("Ignoring unreadable rule log " + log)
+        self.compact()
+        for log in imported:
+            try:
+                os.remove(os.path.join(os.path.dirname(self.path), log))
+            except:
+                pass
+
+    def compact(self):
+        tmpname = self.path + ".tmp"
+        tmp = open(tmpname, 'w')
+        try:
+            for vm_name in sorted(self.states.keys()):
+                tmp.write(','.join([vm_name] + self.states[vm_name]) + '\n')
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        finally:
+            tmp.close()
+        os.rename(tmpname, self.path)
+        self.records = len(self.states)
+
+    def append(self, record):
+        lock = self.lock()
+        try:
+            journal = open(self.path, 'a+')
+            try:
+                journal.seek(0, 2)
+                if journal.tell() > 0:
+                    journal.seek(-1, 2)
+                    if journal.read(1) != '\n':
+                        record = '\n' + record
+                journal.write(record + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            finally:
+                journal.close()
+            self.records += 1
+            if self.records > 2 * len(self.states) + 64:
+                # other processes may have appended since we loaded
+                self.load()
+                self.compact()
+        finally:
+            self.unlock(lock)
+
+    def get(self, vm_name):
+        return self.states.get(vm_name)
+
+    def put(self, vm_name, vmID, vmIP, domID, signature, seqno, rulehash='_'):
+        state = [vmID, vmIP, str(domID), signature, seqno, rulehash]
+        self.states[vm_name] = state
+        self.append(','.join([vm_name] + state))
+
+    def remove(self, vm_name):
+        if vm_name not in self.states:
+            return False
+        del self.states[vm_name]
+        self.append(vm_name)
+        return True
+
+rule_state_store = None
+def rule_state():
+    global rule_state_store
+    if rule_state_store == None:
+        rule_state_store = RuleStateStore(logpath + "rules.journal")
+    return rule_state_store
+
 def can_bridge_firewall(privnic):
     try:
         execute("which iptables")
@@ -83,6 +385,37 @@ def ipset(ipsetname, proto, start, end, ips):
 
     return result
 '''
+libvirt_conn = None
+def libvirt_connection():
+    global libvirt_conn
+    if libvirt_conn == None:
+        libvirt_conn = libvirt.openReadOnly('qemu:///system')
+        if libvirt_conn == None:
+           print 'Failed to open connection to the hypervisor'
+           sys.exit(3)
+    return libvirt_conn
+
+def list_domains(*states):
+    '''
+    {name: id} of the domains in any of the given states ('running',
+    'paused' or 'shutoff'), fetched with a single listAllDomains call
+    '''
+    conn = libvirt_connection()
+    try:
+        listall_flags = { 'running' : libvirt.VIR_CONNECT_LIST_DOMAINS_RUNNING,
+                          'paused'  : libvirt.VIR_CONNECT_LIST_DOMAINS_PAUSED,
+                          'shutoff' : libvirt.VIR_CONNECT_LIST_DOMAINS_SHUTOFF,
+        }
+        flags = 0
+        for state in states:
+            flags |= listall_flags[state]
+        domains = conn.listAllDomains(flags)
+    except AttributeError:
+        # libvirt older than 0.9.13
+        domains = map(conn.lookupByName, virshlist(*states))
+
+    return dict((domain.name(), domain.ID()) for domain in domains)
+
 def virshlist(*states):
 
     libvirt_states={ 'running'  : libvirt.VIR_DOMAIN_RUNNING,
@@ -96,10 +429,7 @@ def virshlist(*states):
 
     searchstates = list(libvirt_states[state] for state in states)
 
-    conn = libvirt.openReadOnly('qemu:///system')
-    if conn == None:
-       print 'Failed to open connection to the hypervisor'
-       sys.exit(3)
+    conn = libvirt_connection()
 
     alldomains = map(conn.lookupByID, conn.listDomainsID())
     alldomains += map(conn.lookupByName, conn.listDefinedDomains())
@@ -109,8 +439,6 @@ def virshlist(*states):
         if domain.info()[0] in searchstates:
             domains.append(domain.name())
 
-    conn.close()
-
     return domains
 
 def virshdomstate(domain):
@@ -124,10 +452,7 @@ def virshdomstate(domain):
                      libvirt.VIR_DOMAIN_CRASHED  : 'crashed',
     }
 
-    conn = libvirt.openReadOnly('qemu:///system')
-    if conn == None:
-       print 'Failed to open connection to the hypervisor'
-       sys.exit(3)
+    conn = libvirt_connection()
 
     try:
         dom = (conn.lookupByName (domain))
@@ -135,16 +460,12 @@ def virshdomstate(domain):
         return None
 
     state = libvirt_states[dom.info()[0]]
-    conn.close()
 
     return state
 
 def virshdumpxml(domain):
 
-    conn = libvirt.openReadOnly('qemu:///system')
-    if conn == None:
-       print 'Failed to open connection to the hypervisor'
-       sys.exit(3)
+    conn = libvirt_connection()
 
     try:
         dom = (conn.lookupByName (domain))
@@ -152,7 +473,6 @@ def virshdumpxml(domain):
         return None
 
     xml = dom.XMLDesc(0)
-    conn.close()
 
     return xml
 
@@ -201,10 +521,11 @@ def destroy_network_rules_for_vm(vm_name, vif=None):
         logging.debug("Ignoring failure to delete chain " + vmchain_egress)
 
     try:
-        execute("ipset -F " + vm_name)
-        execute("ipset -X " + vm_name)
+        execute("ipset flush " + vm_ipset_name(vm_name))
+        execute("ipset destroy " + vm_ipset_name(vm_name))
     except:
-        logging.debug("Ignoring failure to delete ipset " + vmchain)
+        logging.debug("Ignoring failure to delete ipset " + vm_ipset_name(vm_name))
+    destroy_rule_ipsets(vm_name)
 
     if vif is not None:
         try:
@@ -224,88 +545,77 @@ def destroy_network_rules_for_vm(vm_name, vif=None):
 
     return 'true'
 
-def destroy_ebtables_rules(vm_name, vif):
+def ebtables_chains_for_vm(vm_name):
+    return [vm_name + "-in", vm_name + "-out", vm_name + "-in-ips", vm_name + "-out-ips"]
 
-    delcmd = "ebtables -t nat -L PREROUTING | grep " + vm_name
-    delcmds = []
-    try:
-        delcmds = execute(delcmd).split('\n')
-        delcmds.pop()
-        delcmds = ["-D PREROUTING " + x for x in delcmds ]
-    except:
-        pass
-    postcmds = []
+def destroy_ebtables_rules(vm_name, vif):
+    ruleset = None
     try:
-        postcmd = "ebtables -t nat -L POSTROUTING | grep " + vm_name
-        postcmds = execute(postcmd).split('\n')
-        postcmds.pop()
-        postcmds = ["-D POSTROUTING " + x for x in postcmds]
+        ruleset = EbtablesNatRuleset()
+        ruleset.remove_vm(vm_name)
+        ruleset.apply()
     except:
-        pass
-
-    delcmds += postcmds
-
-    for cmd in delcmds:
-        try:
-            execute("ebtables -t nat " + cmd)
-        except:
-            logging.debug("Ignoring failure to delete ebtables rules for vm " + vm_name)
-    chains = [vm_name+"-in", vm_name+"-out", vm_name+"-in-ips", vm_name+"-out-ips"]
-    for chain in chains:
-        try:
-            execute("ebtables -t nat -F " + chain)
-            execute("ebtables -t nat -X " + chain)
-        except:
-            logging.debug("Ignoring failure to delete ebtables chain for vm " + vm_name)
+        if ruleset is not None:
+            ruleset.release()
+        logging.debug("Ignoring failure to delete ebtables rules for vm " + vm_name)
 
-def default_ebtables_rules(vm_name, vm_ip, vm_mac, vif):
+def default_ebtables_rules(vm_name, vm_ip, vm_mac, vif, sec_ips=[]):
     vmchain_in = vm_name + "-in"
     vmchain_out = vm_name + "-out"
     vmchain_in_ips = vm_name + "-in-ips"
     vmchain_out_ips = vm_name + "-out-ips"
 
-    for chain in [vmchain_in, vmchain_out, vmchain_in_ips, vmchain_out_ips]:
-        try:
-            execute("ebtables -t nat -N " + chain)
-        except:
-            execute("ebtables -t nat -F " + chain)
-
+    start = time.time()
+    ruleset = None
     try:
+        ruleset = EbtablesNatRuleset()
+        ruleset.remove_vm(vm_name)
+        for chain in ebtables_chains_for_vm(vm_name):
+            ruleset.chain(chain)
+
         # -s ! 52:54:0:56:44:32 -j DROP
-        execute("ebtables -t nat -A PREROUTING -i " + vif + " -j " + vmchain_in)
-        execute("ebtables -t nat -A POSTROUTING -o " + vif + " -j " + vmchain_out)
-        execute("ebtables -t nat -A " + vmchain_in_ips + " -j DROP")
-        execute("ebtables -t nat -A " + vmchain_out_ips + " -j DROP")
-    except:
-        logging.debug("Failed to program default rules")
-        return 'false'
+        ruleset.add("-A PREROUTING -i " + vif + " -j " + vmchain_in)
+        ruleset.add("-A POSTROUTING -o " + vif + " -j " + vmchain_out)
 
-    try:
-        execute("ebtables -t nat -A " + vmchain_in + " -s ! " + vm_mac + " -j DROP")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP -s ! " + vm_mac + " -j DROP")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP --arp-mac-src ! " + vm_mac + " -j DROP")
+        ruleset.add("-A " + vmchain_in + " -s ! " + vm_mac + " -j DROP")
+        ruleset.add("-A " + vmchain_in + " -p ARP -s ! " + vm_mac + " -j DROP")
+        ruleset.add("-A " + vmchain_in + " -p ARP --arp-mac-src ! " + vm_mac + " -j DROP")
         if vm_ip is not None:
-            execute("ebtables -t nat -A " + vmchain_in + " -p ARP -j " + vmchain_in_ips)
-            execute("ebtables -t nat -I " + vmchain_in_ips + " -p ARP --arp-ip-src " + vm_ip + " -j RETURN")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP --arp-op Request -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP --arp-op Reply -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP -j DROP")
-    except:
-        logging.exception("Failed to program default ebtables IN rules")
-        return 'false'
+            ruleset.add("-A " + vmchain_in + " -p ARP -j " + vmchain_in_ips)
+        ruleset.add("-A " + vmchain_in + " -p ARP --arp-op Request -j ACCEPT")
+        ruleset.add("-A " + vmchain_in + " -p ARP --arp-op Reply -j ACCEPT")
+        ruleset.add("-A " + vmchain_in + " -p ARP -j DROP")
 
-    try:
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP --arp-op Reply --arp-mac-dst ! " + vm_mac + " -j DROP")
+        ruleset.add("-A " + vmchain_out + " -p ARP --arp-op Reply --arp-mac-dst ! " + vm_mac + " -j DROP")
+        if vm_ip is not None:
+            ruleset.add("-A " + vmchain_out + " -p ARP -j " + vmchain_out_ips)
+        ruleset.add("-A " + vmchain_out + " -p ARP --arp-op Request -j ACCEPT")
+        ruleset.add("-A " + vmchain_out + " -p ARP --arp-op Reply -j ACCEPT")
+        ruleset.add("-A " + vmchain_out + " -p ARP -j DROP")
+
+        # the primary ip, then the secondary ips, used to be inserted one
+        # by one at the head of the ips chains
+        ips = list(sec_ips)
         if vm_ip is not None:
-            execute("ebtables -t nat -A " + vmchain_out + " -p ARP -j " + vmchain_out_ips )
-            execute("ebtables -t nat -I " + vmchain_out_ips + " -p ARP --arp-ip-dst " + vm_ip + " -j RETURN")
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP --arp-op Request -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP --arp-op Reply -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP -j DROP")
+            ips.insert(0, vm_ip)
+        ips.reverse()
+        for ip in ips:
+            ruleset.add("-A " + vmchain_in_ips + " -p ARP --arp-ip-src " + ip + " -j RETURN")
+        ruleset.add("-A " + vmchain_in_ips + " -j DROP")
+        for ip in ips:
+            ruleset.add("-A " + vmchain_out_ips + " -p ARP --arp-ip-dst " + ip + " -j RETURN")
+        ruleset.add("-A " + vmchain_out_ips + " -j DROP")
+
+        ruleset.apply()
     except:
-        logging.debug("Failed to program default ebtables OUT rules")
+        if ruleset is not None:
+            ruleset.release()
+        logging.exception("Failed to program default ebtables rules for vm " + vm_name)
         return 'false'
 
+    logging.debug("Programmed default ebtables rules for vm %s in %.3fs" % (vm_name, time.time() - start))
+    return 'true'
+
 
 def default_network_rules_systemvm(vm_name, localbrname):
     bridges = getBridges(vm_name)
@@ -372,16 +682,17 @@ def write_secip_log_for_vm (vmName, secIps, vmId):
 
     return result
 
-def create_ipset_forvm (ipsetname):
+def create_ipset_forvm (ipsetname, ips):
+    # the set is still referenced by the vm's rules, so it is refilled
+    # through a swap rather than flushed, which would let spoofed
+    # traffic through until the ips are added back
     result = True
     try:
-        logging.debug("Creating ipset chain .... " + ipsetname)
-        execute("ipset -F " + ipsetname)
-        execute("ipset -X " + ipsetname)
-        execute("ipset -N " + ipsetname + " iphash")
+        logging.debug("Programming ipset .... " + ipsetname)
+        ipset_restore(ipset_swap_commands(ipsetname, "hash:ip", ips))
     except:
-        logging.debug("ipset chain not exists creating.... " + ipsetname)
-        execute("ipset -N " + ipsetname + " iphash")
+        logging.exception("Failed to program ipset " + ipsetname)
+        result = False
 
     return result
 
@@ -390,21 +701,60 @@ def add_to_ipset(ipsetname, ips, action):
     for ip in ips:
         try:
             logging.debug("vm ip " + ip)
-            execute("ipset " + action + " " + ipsetname + " " + ip)
+            if action == "-D":
+                execute("ipset del " + ipsetname + " " + ip + " -exist")
+            else:
+                execute("ipset add " + ipsetname + " " + ip + " -exist")
         except:
             logging.debug("vm ip already in ip set " + ip)
             continue
 
     return result
 
+def ipset_restore(cmds):
+    if len(cmds) == 0:
+        return
+    restore(["ipset", "restore"], '\n'.join(cmds) + '\n')
+
+def ipset_swap_commands(setname, settype, members):
+    '''
+    ipset restore commands filling a temporary set with members and
+    swapping it with setname, so setname never matches a partial list
+    '''
+    tmpname = setname + "-t"
+    cmds = ["create " + tmpname + " " + settype + " -exist", "flush " + tmpname]
+    cmds += ["add " + tmpname + " " + member + " -exist" for member in members]
+    cmds += ["create " + setname + " " + settype + " -exist", "swap " + tmpname + " " + setname, "destroy " + tmpname]
+    return cmds
+
+def vm_ipset_name(vm_name):
+    '''
+    ipset names are limited to 31 characters, and rule sets append "_" and
+    8 hex digits and swaps another "-t" to this name, so long vm names are
+    cut and made unique again with a hash
+    '''
+    if len(vm_name) <= 20:
+        return vm_name
+    return vm_name[:11] + "-" + hashlib.md5(vm_name).hexdigest()[:8]
+
+def rule_ipset_name(vm_name, vmchain, match):
+    return vm_ipset_name(vm_name) + "_" + hashlib.md5(vmchain + " " + match).hexdigest()[:8]
+
+def destroy_rule_ipsets(vm_name, keep=[]):
+    try:
+        setnames = execute("ipset list -n").split('\n')
+        ipset_restore(["destroy " + setname for setname in setnames
+                       if setname.startswith(vm_ipset_name(vm_name) + "_") and setname not in keep])
+    except:
+        logging.debug("Ignoring failure to delete rule ipsets of vm " + vm_name)
+
 def network_rules_vmSecondaryIp(vm_name, ip_secondary, action):
     logging.debug("vmName = "+ vm_name)
     logging.debug("action = "+ action)
 
     domid = getvmId(vm_name)
 
-    vmchain = vm_name
-    add_to_ipset(vmchain, [ip_secondary], action)
+    add_to_ipset(vm_ipset_name(vm_name), [ip_secondary], action)
 
     #add ebtables rules for the secondary ip
     ebtables_rules_vmip(vm_name, [ip_secondary], action)
@@ -415,96 +765,87 @@ def ebtables_rules_vmip (vmname, ips, action):
     vmchain_inips = vmname + "-in-ips"
     vmchain_outips = vmname + "-out-ips"
 
-    for ip in ips:
-        logging.debug("ip = "+ip)
-        try:
-            execute("ebtables -t nat -I " + vmchain_inips + " -p ARP --arp-ip-src " + ip + " -j RETURN")
-            execute("ebtables -t nat -I " + vmchain_outips + " -p ARP --arp-ip-dst " + ip + " -j RETURN")
-        except:
-            logging.debug("Failed to program ebtables rules for secondary ip "+ ip)
-        continue
+    lockf = lock_ebtables()
+    try:
+        for ip in ips:
+            logging.debug("ip = "+ip)
+            try:
+                execute("ebtables -t nat -I " + vmchain_inips + " -p ARP --arp-ip-src " + ip + " -j RETURN")
+                execute("ebtables -t nat -I " + vmchain_outips + " -p ARP --arp-ip-dst " + ip + " -j RETURN")
+            except:
+                logging.debug("Failed to program ebtables rules for secondary ip "+ ip)
+            continue
+    finally:
+        unlock_ebtables(lockf)
 
 def default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, brname, sec_ips):
+    start = time.time()
     if not addFWFramework(brname):
         return False
 
     vmName = vm_name
     brfw = getBrfw(brname)
     domID = getvmId(vm_name)
-    delete_rules_for_vm_in_bridge_firewall_chain(vmName)
     vmchain = vm_name
     vmchain_egress = egress_chain_name(vm_name)
     vmchain_default = '-'.join(vmchain.split('-')[:-1]) + "-def"
 
-    destroy_ebtables_rules(vmName, vif)
-
-    try:
-        execute("iptables -N " + vmchain)
-    except:
-        execute("iptables -F " + vmchain)
-
-    try:
-        execute("iptables -N " + vmchain_egress)
-    except:
-        execute("iptables -F " + vmchain_egress)
-
-    try:
-        execute("iptables -N " + vmchain_default)
-    except:
-        execute("iptables -F " + vmchain_default)
-
-    action = "-A"
-    vmipsetName = vm_name
-    #create ipset and add vm ips to that ip set
-    if create_ipset_forvm(vmipsetName) == False:
-       logging.debug(" failed to create ipset for rule " + str(tokens))
-       return 'false'
-
-    #add primary nic ip to ipset
-    if add_to_ipset(vmipsetName, [vm_ip], action ) == False:
-       logging.debug(" failed to add vm " + vm_ip + " ip to set ")
-       return 'false'
-
-    #add secodnary nic ips to ipset
+    vmipsetName = vm_ipset_name(vm_name)
     secIpSet = "1"
     ips = sec_ips.split(':')
     ips.pop()
     if ips[0] == "0":
         secIpSet = "0";
 
+    #create ipset holding the primary and secondary nic ips of the vm
+    setips = []
+    if vm_ip is not None:
+        setips.append(vm_ip)
+    if secIpSet == "1":
+        setips += ips
+    if create_ipset_forvm(vmipsetName, setips) == False:
+       logging.debug(" failed to create ipset for vm " + vm_name)
+       return 'false'
+
     if secIpSet == "1":
-        logging.debug("Adding ipset for secondary ips")
-        add_to_ipset(vmipsetName, ips, action)
         if write_secip_log_for_vm(vm_name, sec_ips, vm_id) == False:
             logging.debug("Failed to log default network rules, ignoring")
 
+    ruleset = IptablesRuleset()
+    for cmd in bridge_firewall_rules_for_vm(vmName):
+        ruleset.add(cmd)
+    ruleset.chain(vmchain)
+    ruleset.chain(vmchain_egress)
+    ruleset.chain(vmchain_default)
+
+    ruleset.add("-A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain_default)
+    ruleset.add("-A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain_default)
+    ruleset.add("-A " + vmchain_default + " -m state --state RELATED,ESTABLISHED -j ACCEPT")
+    #allow dhcp
+    ruleset.add("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -p udp --dport 67 --sport 68 -j ACCEPT")
+    ruleset.add("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -p udp --dport 68 --sport 67  -j ACCEPT")
+
+    #don't let vm spoof its ip address
+    if vm_ip is not None:
+        ruleset.add("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -p udp --dport 53  -j RETURN ")
+        ruleset.add("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -j " + vmchain_egress)
+    ruleset.add("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain)
+    ruleset.add("-A " + vmchain + " -j DROP")
+
     try:
-        execute("iptables -A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain_default)
-        execute("iptables -A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain_default)
-        execute("iptables -A " + vmchain_default + " -m state --state RELATED,ESTABLISHED -j ACCEPT")
-        #allow dhcp
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -p udp --dport 67 --sport 68 -j ACCEPT")
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -p udp --dport 68 --sport 67  -j ACCEPT")
-
-        #don't let vm spoof its ip address
-        if vm_ip is not None:
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -p udp --dport 53  -j RETURN ")
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -j " + vmchain_egress)
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain)
-        execute("iptables -A " + vmchain + " -j DROP")
+        ruleset.apply()
     except:
-        logging.debug("Failed to program default rules for vm " + vm_name)
+        logging.exception("Failed to program default rules for vm " + vm_name)
         return 'false'
 
-    default_ebtables_rules(vmchain, vm_ip, vm_mac, vif)
-    #default ebtables rules for vm secondary ips
-    ebtables_rules_vmip(vm_name, ips, "-I")
+    #default ebtables rules for vm and its secondary ips
+    default_ebtables_rules(vmchain, vm_ip, vm_mac, vif, ips)
 
     if vm_ip is not None:
         if write_rule_log_for_vm(vmName, vm_id, vm_ip, domID, '_initial_', '-1') == False:
             logging.debug("Failed to log default network rules, ignoring")
 
-    logging.debug("Programmed default rules for vm " + vm_name)
+    logging.debug("Programmed default rules for vm %s in %.3fs" % (vm_name, time.time() - start))
     return 'true'
 
 def post_default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, brname, dhcpSvr, hostIp, hostMacAddr):
@@ -521,105 +862,69 @@ def post_default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, brname, dhcpS
     except:
         pass
 
+    lockf = lock_ebtables()
     try:
-        execute("ebtables -t nat -I " + vmchain_in + " -p IPv4 --ip-protocol tcp --ip-destination-port 80 --ip-dst " + dhcpSvr + " -j dnat --to-destination " + hostMacAddr)
-    except:
-        pass
+        try:
+            execute("ebtables -t nat -I " + vmchain_in + " -p IPv4 --ip-protocol tcp --ip-destination-port 80 --ip-dst " + dhcpSvr + " -j dnat --to-destination " + hostMacAddr)
+        except:
+            pass
 
-    try:
-        execute("ebtables -t nat -I " + vmchain_in + " 4 -p ARP --arp-ip-src ! " + vm_ip + " -j DROP")
-    except:
-        pass
-    try:
-        execute("ebtables -t nat -I " + vmchain_out + " 2 -p ARP --arp-ip-dst ! " + vm_ip + " -j DROP")
-    except:
-        pass
+        try:
+            execute("ebtables -t nat -I " + vmchain_in + " 4 -p ARP --arp-ip-src ! " + vm_ip + " -j DROP")
+        except:
+            pass
+        try:
+            execute("ebtables -t nat -I " + vmchain_out + " 2 -p ARP --arp-ip-dst ! " + vm_ip + " -j DROP")
+        except:
+            pass
+    finally:
+        unlock_ebtables(lockf)
     if write_rule_log_for_vm(vm_name, vm_id, vm_ip, domID, '_initial_', '-1') == False:
             logging.debug("Failed to log default network rules, ignoring")
-def delete_rules_for_vm_in_bridge_firewall_chain(vmName):
+def bridge_firewall_rules_for_vm(vmName, index=None):
     vm_name = vmName
     if vm_name.startswith('i-') or vm_name.startswith('r-'):
-	vm_name = '-'.join(vm_name.split('-')[:-1]) + "-def"
+        vm_name = '-'.join(vm_name.split('-')[:-1]) + "-def"
 
     vmchain = vm_name
 
-    delcmd = """iptables-save | awk '/BF(.*)physdev-is-bridged(.*)%s/ { sub(/-A/, "-D", $1) ; print }'""" % vmchain
-    delcmds = execute(delcmd).split('\n')
-    delcmds.pop()
-    for cmd in delcmds:
-        try:
-            execute("iptables " + cmd)
-        except:
-              logging.exception("Ignoring failure to delete rules for vm " + vmName)
+    if index is None:
+        index = iptables_index()
+    return ["-D" + rule[2:] for rule in index.grep("BF(.*)physdev-is-bridged(.*)" + vmchain)]
+
+def delete_rules_for_vm_in_bridge_firewall_chain(vmName):
+    ruleset = IptablesRuleset()
+    for cmd in bridge_firewall_rules_for_vm(vmName):
+        ruleset.add(cmd)
+    try:
+        ruleset.apply()
+    except:
+        logging.exception("Ignoring failure to delete rules for vm " + vmName)
 
 def rewrite_rule_log_for_vm(vm_name, new_domid):
-    logfilename = logpath + vm_name + ".log"
-    if not os.path.exists(logfilename):
+    state = rule_state().get(vm_name)
+    if state is None:
         return
-    lines = (line.rstrip() for line in open(logfilename))
-
-    [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = ['_', '-1', '_', '-1', '_', '-1']
-    for line in lines:
-        [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = line.split(',')
-        break
 
-    write_rule_log_for_vm(_vmName, _vmID, '0.0.0.0', new_domid, _signature, '-1')
+    [_vmID,_vmIP,_domID,_signature,_seqno,_rulehash] = state
+    write_rule_log_for_vm(vm_name, _vmID, '0.0.0.0', new_domid, _signature, '-1', _rulehash)
 
 def get_rule_log_for_vm(vmName):
-    vm_name = vmName;
-    logfilename = logpath + vm_name + ".log"
-    if not os.path.exists(logfilename):
+    state = rule_state().get(vmName)
+    if state is None:
         return ''
 
-    lines = (line.rstrip() for line in open(logfilename))
+    return ','.join([vmName] + state[:5])
 
-    [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = ['_', '-1', '_', '-1', '_', '-1']
-    for line in lines:
-        [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = line.split(',')
-        break
-
-    return ','.join([_vmName, _vmID, _vmIP, _domID, _signature, _seqno])
-
-def check_domid_changed(vmName):
-    curr_domid = getvmId(vmName)
-    if (curr_domid is None) or (not curr_domid.isdigit()):
-        curr_domid = '-1'
-
-    vm_name = vmName;
-    logfilename = logpath + vm_name + ".log"
-    if not os.path.exists(logfilename):
-        return ['-1', curr_domid]
-
-    lines = (line.rstrip() for line in open(logfilename))
-
-    [_vmName,_vmID,_vmIP,old_domid,_signature,_seqno] = ['_', '-1', '_', '-1', '_', '-1']
-    for line in lines:
-        [_vmName,_vmID,_vmIP,old_domid,_signature,_seqno] = line.split(',')
-        break
-
-    return [curr_domid, old_domid]
-def network_rules_for_rebooted_vm(vmName):
+def network_rules_for_rebooted_vm(vmName, curr_domid, index):
     vm_name = vmName
-    [curr_domid, old_domid] = check_domid_changed(vm_name)
-
-    if curr_domid == old_domid:
-        return True
-
-    if old_domid == '-1':
-        return True
-
-    if curr_domid == '-1':
-        return True
 
     logging.debug("Found a rebooted VM -- reprogramming rules for " + vm_name)
 
-    delete_rules_for_vm_in_bridge_firewall_chain(vm_name)
-
-    brName = execute("iptables-save | awk -F '-j ' '/FORWARD -o(.*)physdev-is-bridged(.*)BF/ {print $2}'").strip()
-    if brName is None or brName is "":
-        brName = "cloudbr0"
-    else:
-        brName = execute("iptables-save |grep physdev-is-bridged |grep FORWARD |grep BF |grep '\-o' |awk '{print $4}' | head -1").strip()
+    brName = "cloudbr0"
+    for rule in index.grep("-o(.*)physdev-is-bridged(.*)BF", "FORWARD"):
+        brName = rule.split()[3]
+        break
 
     if 1 in [ vm_name.startswith(c) for c in ['r-', 's-', 'v-'] ]:
 
@@ -628,49 +933,54 @@ def network_rules_for_rebooted_vm(vmName):
 
     vmchain = vm_name
     vmchain_default = '-'.join(vmchain.split('-')[:-1]) + "-def"
+    brfw = getBrfw(brName, index)
 
     vifs = getVifs(vmName)
-    logging.debug(vifs, brName)
+    logging.debug("vifs of %s on %s: %s" % (vm_name, brName, vifs))
+
+    ruleset = IptablesRuleset()
+    for cmd in bridge_firewall_rules_for_vm(vm_name, index):
+        ruleset.add(cmd)
     for v in vifs:
-        execute("iptables -A " + getBrfw(brName) + "-IN " + " -m physdev --physdev-is-bridged --physdev-in " + v + " -j "+ vmchain_default)
-        execute("iptables -A " + getBrfw(brName) + "-OUT " + " -m physdev --physdev-is-bridged --physdev-out " + v + " -j "+ vmchain_default)
+        ruleset.add("-A " + brfw + "-IN " + " -m physdev --physdev-is-bridged --physdev-in " + v + " -j "+ vmchain_default)
+        ruleset.add("-A " + brfw + "-OUT " + " -m physdev --physdev-is-bridged --physdev-out " + v + " -j "+ vmchain_default)
+
+    #change antispoof rule in vmchain, the vifs got renamed by the reboot
+    if len(vifs) > 0:
+        antispoof = index.grep("physdev", vmchain_default)
+        for rule in antispoof:
+            ruleset.add("-D" + rule[2:])
+        for rule in antispoof:
+            ruleset.add(re.sub("vnet[0-9]+", vifs[0], rule))
 
-    #change antispoof rule in vmchain
     try:
-        delcmd = """iptables-save | awk '/-A %s(.*)physdev/ { sub(/-A/, "-D", $1) ; print }'""" % vmchain_default
-        inscmd = """iptables-save | awk '/-A %s(.*)physdev/ { gsub(/vnet[0-9]+/, "%s") ; sub(/-A/, "-D", $1) ; print }'""" % ( vmchain_default,vifs[0] )
-        ipts = []
-        for cmd in [delcmd, inscmd]:
-            logging.debug(cmd)
-            cmds = execute(cmd).split('\n')
-            cmds.pop()
-            for c in cmds:
-                    ipt = "iptables " + c
-                    ipts.append(ipt)
-
-        for ipt in ipts:
-            try:
-                execute(ipt)
-            except:
-                logging.debug("Failed to rewrite antispoofing rules for vm " + vm_name)
+        ruleset.apply()
     except:
-        logging.debug("No rules found for vm " + vm_name)
+        logging.exception("Failed to rewrite rules for vm " + vm_name)
 
     rewrite_rule_log_for_vm(vm_name, curr_domid)
     return True
 
 def get_rule_logs_for_vms():
-    vms = virshlist('running')
-
     result = []
     try:
-        for name in vms:
-            name = name.rstrip()
+        vms = list_domains('running')
+        index = None
+        for name in sorted(vms.keys()):
             if 1 not in [ name.startswith(c) for c in ['r-', 's-', 'v-', 'i-'] ]:
                 continue
-            network_rules_for_rebooted_vm(name)
+            log = get_rule_log_for_vm(name)
+            if log != '':
+                old_domid = log.split(',')[3]
+                curr_domid = str(vms[name])
+                if old_domid != '-1' and curr_domid != '-1' and curr_domid != old_domid:
+                    # one snapshot serves every rebooted vm, the rules each
+                    # one rewrites don't overlap with the others
+                    if index is None:
+                        index = iptables_index()
+                    network_rules_for_rebooted_vm(name, curr_domid, index)
+                    log = get_rule_log_for_vm(name)
             if name.startswith('i-'):
-                log = get_rule_log_for_vm(name)
                 result.append(log)
     except:
         logging.debug("Failed to get rule logs, better luck next time!")
@@ -683,40 +993,28 @@ def cleanup_rules_for_dead_vms():
 
 def cleanup_rules():
     try:
-        chainscmd = """iptables-save | grep -P '^:(?!.*-(def|eg))' | awk '{sub(/^:/, "", $1) ; print $1}'"""
-        chains = execute(chainscmd).split('\n')
-        cleanup = []
-        for chain in chains:
-            if 1 in [ chain.startswith(c) for c in ['r-', 'i-', 's-', 'v-'] ]:
-                vm_name = chain
-
-                result = virshdomstate(vm_name)
-
-                if result == None or len(result) == 0:
-                    logging.debug("chain " + chain + " does not correspond to a vm, cleaning up iptable rules")
-                    cleanup.append(vm_name)
-                    continue
-                if not (result == "running" or result == "paused"):
-                    logging.debug("vm " + vm_name + " is not running or paused, cleaning up iptable rules")
-                    cleanup.append(vm_name)
-
-        chainscmd = """ebtables-save | awk '/:i/ { gsub(/(^:|-(in|out|ips))/, "") ; print $1}'"""
-        chains = execute(chainscmd).split('\n')
-        for chain in chains:
-            if 1 in [ chain.startswith(c) for c in ['r-', 'i-', 's-', 'v-'] ]:
-                vm_name = chain
-
-                result = virshdomstate(vm_name)
-
-                if result == None or len(result) == 0:
-                    logging.debug("chain " + chain + " does not correspond to a vm, cleaning up ebtable rules")
-                    cleanup.append(vm_name)
-                    continue
-                if not (result == "running" or result == "paused"):
-                    logging.debug("vm " + vm_name + " is not running or paused, cleaning up ebtable rules")
-                    cleanup.append(vm_name)
-
-        for vmname in cleanup:
+        alive = set(list_domains('running', 'paused').keys())
+        prefixes = ['r-', 'i-', 's-', 'v-']
+
+        iptables_vms = set()
+        for chain in iptables_index().chains:
+            if re.search("-(def|eg)", chain):
+                continue
+            if 1 in [ chain.startswith(c) for c in prefixes ]:
+                iptables_vms.add(chain)
+
+        ebtables_vms = set()
+        for chain in ebtables_index().chains:
+            if 1 in [ chain.startswith(c) for c in prefixes ]:
+                ebtables_vms.add(re.sub("-(in|out|ips)", "", chain))
+
+        for vm_name in iptables_vms - alive:
+            logging.debug("vm " + vm_name + " is not running or paused, cleaning up iptable rules")
+        for vm_name in ebtables_vms - alive:
+            logging.debug("vm " + vm_name + " is not running or paused, cleaning up ebtable rules")
+
+        cleanup = (iptables_vms | ebtables_vms) - alive
+        for vmname in sorted(cleanup):
             destroy_network_rules_for_vm(vmname)
 
         logging.debug("Cleaned up rules for " + str(len(cleanup)) + " chains")
@@ -724,59 +1022,27 @@ def cleanup_rules():
         logging.debug("Failed to cleanup rules !")
 
 def check_rule_log_for_vm(vmName, vmId, vmIP, domID, signature, seqno):
-    vm_name = vmName;
-    logfilename = logpath + vm_name + ".log"
-    if not os.path.exists(logfilename):
-        return [True, True, True, True, True, True]
-
-    try:
-        lines = (line.rstrip() for line in open(logfilename))
-    except:
-        logging.debug("failed to open " + logfilename)
-        return [True, True, True, True, True, True]
-
-    [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = ['_', '-1', '_', '-1', '_', '-1']
-    try:
-        for line in lines:
-            [_vmName,_vmID,_vmIP,_domID,_signature,_seqno] = line.split(',')
-            break
-    except:
-        logging.debug("Failed to parse log file for vm " + vm_name)
-        remove_rule_log_for_vm(vm_name)
+    state = rule_state().get(vmName)
+    if state is None:
         return [True, True, True, True, True, True]
 
-    return [(vm_name != _vmName), (vmId != _vmID), (vmIP != _vmIP), (domID != _domID), (signature != _signature),(seqno != _seqno)]
+    [_vmID,_vmIP,_domID,_signature,_seqno,_rulehash] = state
+    return [False, (vmId != _vmID), (vmIP != _vmIP), (str(domID) != _domID), (signature != _signature),(seqno != _seqno)]
 
-def write_rule_log_for_vm(vmName, vmID, vmIP, domID, signature, seqno):
-    vm_name = vmName
-    logfilename = logpath + vm_name + ".log"
-    logging.debug("Writing log to " + logfilename)
-    logf = open(logfilename, 'w')
-    output = ','.join([vmName, vmID, vmIP, str(domID), signature, seqno])
-    result = True
+def write_rule_log_for_vm(vmName, vmID, vmIP, domID, signature, seqno, rulehash='_'):
     try:
-        logf.write(output)
-        logf.write('\n')
+        rule_state().put(vmName, vmID, vmIP, domID, signature, seqno, rulehash)
     except:
-        logging.debug("Failed to write to rule log file " + logfilename)
-        result = False
-
-    logf.close()
-
-    return result
+        logging.exception("Failed to record rule state of vm " + vmName)
+        return False
+    return True
 
 def remove_rule_log_for_vm(vmName):
-    vm_name = vmName
-    logfilename = logpath + vm_name + ".log"
-
-    result = True
     try:
-        os.remove(logfilename)
+        return rule_state().remove(vmName)
     except:
-        logging.debug("Failed to delete rule log file " + logfilename)
-        result = False
-
-    return result
+        logging.exception("Failed to remove rule state of vm " + vmName)
+        return False
 
 def egress_chain_name(vm_name):
     return vm_name + "-eg"
@@ -793,6 +1059,14 @@ def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif
         logging.debug("Rules already programmed for vm " + vm_name)
         return 'true'
 
+    rulehash = hashlib.md5(rules or '').hexdigest()
+    state = rule_state().get(vmName)
+    if not 1 in changes[:5] and state[5] == rulehash:
+        logging.debug("Rules of vm " + vm_name + " unchanged, only recording seqno " + seqno)
+        if write_rule_log_for_vm(vmName, vm_id, vm_ip, domId, signature, seqno, rulehash) == False:
+            return 'false'
+        return 'true'
+
     if changes[0] or changes[1] or changes[2] or changes[3]:
         default_network_rules(vmName, vm_id, vm_ip, vmMac, vif, brname, sec_ips)
 
@@ -802,14 +1076,14 @@ def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif
         lines = rules.split(';')[:-1]
 
     logging.debug("    programming network rules for IP: " + vm_ip + " vmname=" + vm_name)
-    try:
-      vmchain = vm_name
-      execute("iptables -F " + vmchain)
-      egress_vmchain = egress_chain_name(vm_name)
-      execute("iptables -F " + egress_vmchain)
-    except:
-      logging.debug("Error flushing iptables rules for " + vmchain + ". Presuming firewall rules deleted, re-initializing." )
-      default_network_rules(vm_name, vm_id, vm_ip, vmMac, vif, brname)
+    started = time.time()
+    ingress_vmchain = vm_name
+    egress_vmchain = egress_chain_name(vm_name)
+    chainrules = {ingress_vmchain: [], egress_vmchain: []}
+    # cidrs allowed by each (chain, protocol, port range), matched through
+    # one hash:net set instead of one rule per cidr
+    setnames = []
+    setcidrs = {}
     egressrule = 0
     for line in lines:
 
@@ -825,55 +1099,60 @@ def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif
         ips.pop()
         allow_any = False
         if ruletype == 'E':
-            vmchain = egress_chain_name(vm_name)
-            direction = "-d"
+            vmchain = egress_vmchain
+            direction = "dst"
             action = "RETURN"
             egressrule = egressrule + 1
         else:
-            vmchain = vm_name
+            vmchain = ingress_vmchain
             action = "ACCEPT"
-            direction = "-s"
+            direction = "src"
         if '0.0.0.0/0' in ips:
             i = ips.index('0.0.0.0/0')
             del ips[i]
             allow_any = True
-        range = start + ":" + end
+        if protocol == 'all':
+            match = "-m state --state NEW"
+        elif protocol != 'icmp':
+            match = "-p " + protocol + " -m " + protocol + " --dport " + start + ":" + end + " -m state --state NEW"
+        else:
+            range = start + "/" + end
+            if start == "-1":
+                range = "any"
+            match = "-p icmp --icmp-type " + range
         if ips:
-            if protocol == 'all':
-                for ip in ips:
-                    execute("iptables -I " + vmchain + " -m state --state NEW " + direction + " " + ip + " -j "+action)
-            elif protocol != 'icmp':
-                for ip in ips:
-                    execute("iptables -I " + vmchain + " -p " + protocol + " -m " + protocol + " --dport " + range + " -m state --state NEW " + direction + " " + ip + " -j "+ action)
-            else:
-                range = start + "/" + end
-                if start == "-1":
-                    range = "any"
-                for ip in ips:
-                    execute("iptables -I " + vmchain + " -p icmp --icmp-type " + range + " " + direction + " " + ip + " -j "+ action)
+            setname = rule_ipset_name(vm_name, vmchain, match)
+            if setname not in setcidrs:
+                setnames.append(setname)
+                setcidrs[setname] = []
+                chainrules[vmchain].append(match + " -m set --set " + setname + " " + direction + " -j " + action)
+            setcidrs[setname] += ips
 
         if allow_any and protocol != 'all':
-            if protocol != 'icmp':
-                execute("iptables -I " + vmchain + " -p " + protocol + " -m " + protocol + " --dport " + range + " -m state --state NEW -j "+ action)
-            else:
-                range = start + "/" + end
-                if start == "-1":
-                    range = "any"
-                execute("iptables -I " + vmchain + " -p icmp --icmp-type " + range + " -j "+action)
+            chainrules[vmchain].append(match + " -j " + action)
+
+    setcmds = []
+    for setname in setnames:
+        setcmds += ipset_swap_commands(setname, "hash:net", setcidrs[setname])
+    ipset_restore(setcmds)
+
+    ruleset = IptablesRuleset()
+    for vmchain in [ingress_vmchain, egress_vmchain]:
+        ruleset.chain(vmchain)
+        for rule in chainrules[vmchain]:
+            ruleset.add("-A " + vmchain + " " + rule)
 
-    egress_vmchain = egress_chain_name(vm_name)
     if egressrule == 0 :
-        iptables = "iptables -A " + egress_vmchain + " -j RETURN"
-        execute(iptables)
+        ruleset.add("-A " + egress_vmchain + " -j RETURN")
     else:
-        iptables = "iptables -A " + egress_vmchain + " -j DROP"
-        execute(iptables)
+        ruleset.add("-A " + egress_vmchain + " -j DROP")
 
-    vmchain = vm_name
-    iptables = "iptables -A " + vmchain + " -j DROP"
-    execute(iptables)
+    ruleset.add("-A " + ingress_vmchain + " -j DROP")
+    ruleset.apply()
+    destroy_rule_ipsets(vm_name, setnames)
+    logging.debug("Programmed %d rules with %d ipsets for vm %s in %.3fs" % (len(ruleset.rules), len(setnames), vm_name, time.time() - started))
 
-    if write_rule_log_for_vm(vmName, vm_id, vm_ip, domId, signature, seqno) == False:
+    if write_rule_log_for_vm(vmName, vm_id, vm_ip, domId, signature, seqno, rulehash) == False:
         return 'false'
 
     return 'true'
@@ -925,23 +1204,24 @@ def getBridges(vmName):
 
 def getvmId(vmName):
 
-    conn = libvirt.openReadOnly('qemu:///system')
-    if conn == None:
-       print 'Failed to open connection to the hypervisor'
-       sys.exit(3)
+    conn = libvirt_connection()
 
     try:
         dom = (conn.lookupByName (vmName))
     except libvirt.libvirtError:
         return None
 
-    conn.close()
-
     return dom.ID()
 
-def getBrfw(brname):
-    cmd = "iptables-save |grep physdev-is-bridged |grep FORWARD |grep BF |grep '\-o' | grep -w " + brname  + "|awk '{print $9}' | head -1"
-    brfwname = bash("-c", cmd).stdout.strip()
+def getBrfw(brname, index=None):
+    if index is None:
+        index = iptables_index()
+    brfwname = ""
+    for rule in index.grep("FORWARD(.*)-o(.*)physdev-is-bridged(.*)BF"):
+        fields = rule.split()
+        if brname in fields and len(fields) > 8:
+            brfwname = fields[8]
+            break
     if brfwname == "":
         brfwname = "BF-" + brname
     return brfwname
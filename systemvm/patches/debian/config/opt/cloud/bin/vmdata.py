@@ -16,9 +16,24 @@
 # specific language governing permissions and limitations
 # under the License.
 
-import sys, getopt, json, os, base64
+import sys, getopt, json, os, base64, hashlib
 from fcntl import flock, LOCK_EX, LOCK_UN
 
+LOCKFILE = "/var/lock/vmdata.lock"
+DOCROOT = "/var/www/html/"
+
+# /latest is answered from the directory of the requesting address, a fixed
+# rule set whatever the number of VMs and of files served
+HTACCESS = """Options +FollowSymLinks
+RewriteEngine On
+
+RewriteRule ^meta-data/?$  ../metadata/%{REMOTE_ADDR}/meta-data [L,NC,QSA]
+RewriteRule ^meta-data/(.+)$  ../metadata/%{REMOTE_ADDR}/$1 [L,NC,QSA]
+RewriteCond %{DOCUMENT_ROOT}/userdata/%{REMOTE_ADDR}/$1 -f
+RewriteRule ^([^/]+)$  ../userdata/%{REMOTE_ADDR}/$1 [L,NC,QSA]
+RewriteRule ^([^/]+)$  ../metadata/%{REMOTE_ADDR}/$1 [L,NC,QSA]
+"""
+
 
 def main(argv):
     fpath =  ''
@@ -45,144 +60,115 @@ def main(argv):
         print '-f <filename> or -d <b64jsondata> required'
         sys.exit(2)
 
+    vmdata = VmDataBatch()
     for ip in json_data:
         for item in json_data[ip]:
-            folder = item[0]
-            file   = item[1]
-            data   = item[2]
-
-            # process only valid data
-            if folder != "userdata" and folder != "metadata":
-                continue
+            vmdata.add(ip, item[0], item[1], item[2])
+    vmdata.write()
 
-            if file == "":
-                continue
-
-            htaccess(ip, folder, file)
-
-            if data == "":
-                deletefile(ip, folder, file)
-            else:
-                createfile(ip, folder, file, data)
-    
     if fpath != '':
         fh.close()
         os.remove(fpath)
 
-def deletefile(ip, folder, file):
-    datafile = "/var/www/html/" + folder + "/" + ip + "/" + file
-
-    if os.path.exists(datafile):
-        os.remove(datafile)
-
-def createfile(ip, folder, file, data):
-    dest = "/var/www/html/" + folder + "/" + ip + "/" + file
-    metamanifestdir = "/var/www/html/" + folder + "/" + ip 
-    metamanifest =  metamanifestdir + "/meta-data"
-
-    # base64 decode userdata
-    if folder == "userdata" or folder == "user-data":
-        if data is not None:
-            data = base64.b64decode(data)
-
-    fh = open(dest, "w")
-    exflock(fh)
-    if data is not None:
-        fh.write(data)
-    else:
-        fh.write("")
-    unflock(fh)
-    fh.close()
-    os.chmod(dest, 0644)
-
-    if folder == "metadata" or folder == "meta-data":
+class VmDataBatch:
+    """
+    Collects the items of a whole vmdata payload and writes the .htaccess
+    of each ip and the meta-data manifests once each, instead of rereading
+    and rewriting them for every item.
+    """
+    def __init__(self):
+        self.folders = {}
+        self.manifests = {}
+        self.files = {}
+
+    def add(self, ip, folder, file, data):
+        # process only valid data
+        if folder != "userdata" and folder != "metadata":
+            return
+
+        if file == "":
+            return
+
+        self.folders[(folder, ip)] = True
+
+        dest = DOCROOT + folder + "/" + ip + "/" + file
+        if data == "":
+            self.files[dest] = None
+            return
+
+        # base64 decode userdata
+        if folder == "userdata":
+            if data is not None:
+                data = base64.b64decode(data)
+        if data is None:
+            data = ""
+        self.files[dest] = data
+
+        if folder == "metadata":
+            manifest = self.manifests.setdefault(DOCROOT + folder + "/" + ip + "/meta-data", [])
+            if not file in manifest:
+                manifest.append(file)
+
+    def write(self):
+        lock = open(LOCKFILE, "w")
+        exflock(lock)
         try:
-            os.makedirs(metamanifestdir, 0755)
-        except OSError as e:
-            # error 17 is already exists, we do it this way for concurrency
-            if e.errno != 17:
-                print "failed to make directories " + metamanifestdir + " due to :" +e.strerror
-                sys.exit(1)
-        if os.path.exists(metamanifest):
-            fh = open(metamanifest, "r+a")
-            exflock(fh) 
-            if not file in fh.read():
-                fh.write(file + '\n')
-            unflock(fh)
-            fh.close()
-        else:
-            fh = open(metamanifest, "w")
-            exflock(fh)
-            fh.write(file + '\n')
-            unflock(fh)
-            fh.close()
-
-    if os.path.exists(metamanifest):
-        os.chmod(metamanifest, 0644)
-
-def htaccess(ip, folder, file):
-    entry = "RewriteRule ^" + file + "$  ../" + folder + "/%{REMOTE_ADDR}/" + file + " [L,NC,QSA]"
-    htaccessFolder = "/var/www/html/latest"
-    htaccessFile = htaccessFolder + "/.htaccess"
-
+            makedirs(DOCROOT + "latest")
+            for (folder, ip) in self.folders:
+                htaccessFolder = DOCROOT + folder + "/" + ip
+                makedirs(htaccessFolder)
+                writefile(htaccessFolder + "/.htaccess",
+                          "Options -Indexes\nOrder Deny,Allow\nDeny from all\nAllow from " + ip + "\n")
+
+            # also replaces the per file rules written by older versions
+            writefile(DOCROOT + "latest/.htaccess", HTACCESS)
+
+            for dest, data in self.files.iteritems():
+                if data is None:
+                    if os.path.exists(dest):
+                        os.remove(dest)
+                else:
+                    writefile(dest, data)
+
+            for metamanifest, files in self.manifests.iteritems():
+                content = ""
+                if os.path.exists(metamanifest):
+                    content = readfile(metamanifest)
+                writefile(metamanifest, content + "".join([file + "\n" for file in files if not file in content.splitlines()]))
+        finally:
+            unflock(lock)
+            lock.close()
+
+def makedirs(folder):
     try:
-        os.mkdir(htaccessFolder,0755)
+        os.makedirs(folder, 0755)
     except OSError as e:
         # error 17 is already exists, we do it this way for concurrency
         if e.errno != 17:
-            print "failed to make directories " + htaccessFolder + " due to :" +e.strerror
+            print "failed to make directories " + folder + " due to :" +e.strerror
             sys.exit(1)
 
-    if os.path.exists(htaccessFile):
-        fh = open(htaccessFile, "r+a")
-        exflock(fh)
-        if not entry in fh.read():
-            fh.write(entry + '\n')
-        unflock(fh) 
-        fh.close()
-    else:
-        fh = open(htaccessFile, "w")
-        exflock(fh)
-        fh.write("Options +FollowSymLinks\nRewriteEngine On\n\n")  
-        fh.write(entry + '\n')
-        unflock(fh)
+def readfile(path):
+    fh = open(path, "r")
+    try:
+        return fh.read()
+    finally:
         fh.close()
 
-    entry="Options -Indexes\nOrder Deny,Allow\nDeny from all\nAllow from " + ip
-    htaccessFolder = "/var/www/html/" + folder + "/" + ip
-    htaccessFile = htaccessFolder+"/.htaccess"
-
+def writefile(path, data):
+    """Replaces path with data through a temp file, unless it already holds data"""
+    if os.path.exists(path) and hashlib.md5(readfile(path)).digest() == hashlib.md5(data).digest():
+        return
+    tmp = path + ".tmp"
+    fh = open(tmp, "w")
     try:
-        os.makedirs(htaccessFolder,0755)
-    except OSError as e:
-        # error 17 is already exists, we do it this way for sake of concurrency
-        if e.errno != 17:
-            print "failed to make directories " + htaccessFolder + " due to :" +e.strerror
-            sys.exit(1)
-
-    fh = open(htaccessFile, "w")
-    exflock(fh)
-    fh.write(entry + '\n')
-    unflock(fh)
-    fh.close()
-
-    if folder == "metadata" or folder == "meta-data":
-        entry = "RewriteRule ^meta-data/(.+)$  ../" + folder + "/%{REMOTE_ADDR}/$1 [L,NC,QSA]"
-        htaccessFolder = "/var/www/html/latest"
-        htaccessFile = htaccessFolder + "/.htaccess"
-
-        fh = open(htaccessFile, "r+a")
-        exflock(fh)
-        if not entry in fh.read():
-            fh.write(entry + '\n')
-
-        entry = "RewriteRule ^meta-data/$  ../" + folder + "/%{REMOTE_ADDR}/meta-data [L,NC,QSA]"
-
-        fh.seek(0)
-        if not entry in fh.read():
-            fh.write(entry + '\n')
-        unflock(fh)
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+    finally:
         fh.close()
+    os.chmod(tmp, 0644)
+    os.rename(tmp, path)
 
 def exflock(file):
     try:
@@ -0,0 +1,157 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Drives add_network_rules of the KVM security_group.py in a throw-away
+network namespace: a bridge with one veth per VM, security group rules
+with many CIDRs each. Prints the install time of the rules of each VM,
+the time of a rule change, and the resulting iptables, ipset and
+ebtables rule counts.
+
+Run as root on a KVM host (iptables, ipset, ebtables, brctl and the
+libvirt python bindings installed):
+
+    python test/scripts/kvm/security_group_bench.py [-n vms] [-r rules] [-c cidrs]
+
+The namespace gets its own /etc/sysctl.conf through /etc/netns, so the
+bridge netfilter settings security_group.py writes stay out of the host.
+"""
+import imp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..")
+NETNS = "sgbench"
+BRIDGE = "cloudbr0"
+
+
+def sh(cmd):
+    return subprocess.Popen(["/bin/bash", "-c", cmd], stdout=subprocess.PIPE).communicate()[0]
+
+
+def run_in_netns(argv):
+    etc = "/etc/netns/" + NETNS
+    if not os.path.exists(etc):
+        os.makedirs(etc)
+    open(etc + "/sysctl.conf", "w").close()
+    subprocess.check_call(["ip", "netns", "add", NETNS])
+    try:
+        env = dict(os.environ)
+        env["SG_BENCH_NETNS"] = NETNS
+        return subprocess.call(["ip", "netns", "exec", NETNS, sys.executable,
+                                os.path.abspath(__file__)] + argv, env=env)
+    finally:
+        subprocess.call(["ip", "netns", "del", NETNS])
+        shutil.rmtree(etc)
+
+
+def load_security_group(logpath):
+    sys.path.insert(0, os.path.join(TOP, "python", "lib"))
+    sg = imp.load_source("security_group", os.path.join(TOP, "scripts", "vm", "network", "security_group.py"))
+    sg.logpath = logpath
+    # no libvirt domains behind the veths
+    sg.getvmId = lambda vmName: 1
+    return sg
+
+
+def setup_bridge(vms):
+    sh("ip link set lo up")
+    sh("ip link add %s type bridge && ip link set %s up" % (BRIDGE, BRIDGE))
+    sh("ip link add eth0 type dummy && ip link set eth0 master %s up" % BRIDGE)
+    for i in range(vms):
+        sh("ip link add vnet%d type veth peer name vm%d && ip link set vnet%d master %s up"
+           % (i, i, i, BRIDGE))
+
+
+def vm_rules(rules, cidrs, port_base):
+    """Ingress and egress rules in the format of the agent, cidrs per rule"""
+    lines = []
+    for r in range(rules):
+        ruletype = "I"
+        if r % 4 == 3:
+            ruletype = "E"
+        port = str(port_base + r)
+        ips = "".join(["10.%d.%d.0/24," % ((r * cidrs + c) / 256 % 256, (r * cidrs + c) % 256)
+                       for c in range(cidrs)])
+        lines.append("%s:tcp:%s:%s:%s" % (ruletype, port, port, ips))
+    return "".join([line + ";" for line in lines])
+
+
+def program(sg, vms, rules, cidrs, port_base, seqno):
+    times = []
+    failed = 0
+    for i in range(vms):
+        vm_name = "i-2-%d-VM" % (i + 1)
+        start = time.time()
+        result = sg.add_network_rules(vm_name, str(i + 1), "192.168.%d.%d" % (i / 250, i % 250 + 2),
+                                      "sig", str(seqno), "06:00:00:00:%02x:%02x" % (i / 256, i % 256),
+                                      vm_rules(rules, cidrs, port_base), "vnet%d" % i, BRIDGE, "0:")
+        times.append(time.time() - start)
+        if result != 'true':
+            failed = failed + 1
+    return times, failed
+
+
+def report(what, times, failed):
+    times.sort()
+    print "%-8s %4d vms in %6.2fs, per vm: avg %.1fms p50 %.1fms p99 %.1fms max %.1fms, %d failed" % (
+        what, len(times), sum(times), sum(times) / len(times) * 1000, times[len(times) / 2] * 1000,
+        times[min(len(times) - 1, int(len(times) * 0.99))] * 1000, times[-1] * 1000, failed)
+
+
+def count_rules():
+    iptables = len([l for l in sh("iptables-save -t filter").split("\n") if l.startswith("-A ")])
+    ipsets = len([l for l in sh("ipset list -n").split("\n") if l])
+    members = len([l for l in sh("ipset list").split("\n") if l and l[0].isdigit()])
+    ebtables = len([l for l in sh("ebtables-save").split("\n") if l.startswith("-A ")])
+    print "iptables filter rules %d, ipsets %d with %d members, ebtables rules %d" % (
+        iptables, ipsets, members, ebtables)
+
+
+def bench(options):
+    logpath = tempfile.mkdtemp()
+    try:
+        sg = load_security_group(logpath + "/")
+        setup_bridge(options.vms)
+        times, failed = program(sg, options.vms, options.rules, options.cidrs, 1000, 1)
+        report("install", times, failed)
+        times, failed = program(sg, options.vms, options.rules, options.cidrs, 2000, 2)
+        report("change", times, failed)
+        # same rules under a new seqno, only the seqno gets recorded
+        times, failed = program(sg, options.vms, options.rules, options.cidrs, 2000, 3)
+        report("resend", times, failed)
+        count_rules()
+    finally:
+        shutil.rmtree(logpath)
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--vms", dest="vms", type="int", default=100,
+                      help="number of VMs, default 100")
+    parser.add_option("-r", "--rules", dest="rules", type="int", default=20,
+                      help="security group rules per VM, default 20")
+    parser.add_option("-c", "--cidrs", dest="cidrs", type="int", default=50,
+                      help="CIDRs per rule, default 50")
+    (options, args) = parser.parse_args()
+    if os.environ.get("SG_BENCH_NETNS") != NETNS:
+        sys.exit(run_in_netns(sys.argv[1:]))
+    bench(options)
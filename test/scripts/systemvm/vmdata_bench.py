@@ -0,0 +1,155 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Builds the metadata docroot of a router serving many VMs with the
+systemvm vmdata.py, then times /latest lookups by evaluating the rules of
+latest/.htaccess the way mod_rewrite does: each rule is matched in order,
+its conditions checked, and the first matching rule with the L flag ends
+the lookup on the file it points to.
+
+    python test/scripts/systemvm/vmdata_bench.py [-n vms] [-l lookups]
+"""
+import getopt
+import imp
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+VMDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..",
+                      "systemvm", "patches", "debian", "config", "opt", "cloud", "bin", "vmdata.py")
+
+METADATA = ["service-offering", "availability-zone", "local-ipv4", "local-hostname",
+            "public-ipv4", "public-hostname", "instance-id", "vm-id", "public-keys",
+            "cloud-identifier"]
+
+
+def load_vmdata(docroot):
+    vmdata = imp.load_source("vmdata", VMDATA)
+    vmdata.DOCROOT = docroot + "/"
+    vmdata.LOCKFILE = os.path.join(docroot, "vmdata.lock")
+    return vmdata
+
+
+def address(i):
+    return "10.%d.%d.%d" % (i / 65536, (i / 256) % 256, i % 256)
+
+
+def build(vmdata, vms):
+    batch = vmdata.VmDataBatch()
+    for i in range(vms):
+        ip = address(i)
+        for name in METADATA:
+            batch.add(ip, "metadata", name, "%s of vm %d" % (name, i))
+        batch.add(ip, "userdata", "user-data", "I2Nsb3VkLWNvbmZpZwo=")
+    batch.write()
+
+
+class Rules(object):
+    """The RewriteCond/RewriteRule lines of an .htaccess"""
+
+    def __init__(self, path):
+        self.dir = os.path.dirname(path)
+        self.rules = []
+        conds = []
+        for line in open(path):
+            words = line.split()
+            if not words:
+                continue
+            flags = []
+            if words[-1].startswith("["):
+                flags = words[-1].strip("[]").split(",")
+            if words[0] == "RewriteCond":
+                conds.append((words[1], words[2]))
+            elif words[0] == "RewriteRule":
+                pattern = re.compile(words[1], "NC" in flags and re.I or 0)
+                self.rules.append((pattern, words[2], conds, "L" in flags))
+                conds = []
+
+    def expand(self, s, match, env):
+        for name, value in env.items():
+            s = s.replace("%%{%s}" % name, value)
+        return re.sub(r"\$(\d)", lambda m: match.group(int(m.group(1))), s)
+
+    def lookup(self, path, env):
+        """The file answering path, None when no rule matches"""
+        for pattern, substitution, conds, last in self.rules:
+            match = pattern.match(path)
+            if match is None:
+                continue
+            ok = True
+            for test, cond in conds:
+                if cond == "-f" and not os.path.isfile(self.expand(test, match, env)):
+                    ok = False
+                    break
+            if not ok:
+                continue
+            target = os.path.normpath(os.path.join(self.dir, self.expand(substitution, match, env)))
+            if last:
+                return target
+        return None
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main(argv):
+    vms = 5000
+    lookups = 20000
+    opts, args = getopt.getopt(argv, "n:l:")
+    for opt, arg in opts:
+        if opt == "-n":
+            vms = int(arg)
+        elif opt == "-l":
+            lookups = int(arg)
+
+    docroot = tempfile.mkdtemp()
+    try:
+        vmdata = load_vmdata(docroot)
+        start = time.time()
+        build(vmdata, vms)
+        print "built the docroot of %d vms in %.2fs" % (vms, time.time() - start)
+
+        rules = Rules(os.path.join(docroot, "latest", ".htaccess"))
+        print "%d rewrite rules in latest/.htaccess" % len(rules.rules)
+
+        paths = ["meta-data", "meta-data/", "user-data"] + METADATA + \
+                ["meta-data/" + name for name in METADATA]
+        times = []
+        for i in range(lookups):
+            env = {"REMOTE_ADDR": address(random.randrange(vms)), "DOCUMENT_ROOT": docroot}
+            path = random.choice(paths)
+            start = time.time()
+            target = rules.lookup(path, env)
+            if target is not None:
+                data = open(target).read()
+            times.append(time.time() - start)
+            if target is None or not data:
+                raise Exception("%s of %s not answered" % (path, env["REMOTE_ADDR"]))
+        times.sort()
+        print "%d lookups: %.0f/s, p50 %.3fms, p99 %.3fms" % (
+            lookups, lookups / sum(times), percentile(times, 0.5) * 1000, percentile(times, 0.99) * 1000)
+    finally:
+        shutil.rmtree(docroot)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
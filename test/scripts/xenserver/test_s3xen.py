@@ -0,0 +1,280 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Runs the S3Client of the s3xen XenServer plugin against a local S3
+stand-in: single and multipart uploads, resuming an interrupted multipart
+upload, ranged downloads and the ETag check of single part uploads.
+
+    python test/scripts/xenserver/test_s3xen.py
+"""
+import BaseHTTPServer
+import SocketServer
+import base64
+import imp
+import md5
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import types
+import unittest
+import urlparse
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "..", "..", "..", "scripts", "vm", "hypervisor", "xenserver")
+
+
+def load_s3xen():
+    # dom0 only modules the plugin imports
+    for name in ["XenAPIPlugin", "util", "cloudstack_pluginlib"]:
+        if name not in sys.modules:
+            sys.modules[name] = types.ModuleType(name)
+    sys.modules["XenAPIPlugin"].dispatch = lambda fns: None
+    sys.modules["cloudstack_pluginlib"].setup_logging = lambda log_file=None: None
+    return imp.load_source("s3xen", os.path.join(PLUGIN_DIR, "s3xen"))
+
+s3xen = load_s3xen()
+
+
+class S3StandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Objects and multipart uploads kept in memory. Content-MD5 headers are
+    verified like S3 does, and failures can be injected per part.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), S3Handler)
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self.fail_parts = {}
+        self.etag = None
+
+
+class S3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body="", headers={}):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.getheader("Content-Length", "0"))
+        body = self.rfile.read(length)
+        expected = self.headers.getheader("Content-MD5")
+        if expected is not None and base64.b64encode(md5.new(body).digest()) != expected:
+            return None
+        return body
+
+    def parse(self):
+        url = urlparse.urlparse(self.path)
+        bucket, key = url.path.lstrip("/").split("/", 1)
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        server = self.server
+        server.lock.acquire()
+        try:
+            server.requests.append((self.command, key, query))
+        finally:
+            server.lock.release()
+        return (bucket, key), query
+
+    def do_PUT(self):
+        name, query = self.parse()
+        server = self.server
+        if "partNumber" in query:
+            part = int(query["partNumber"])
+            server.lock.acquire()
+            try:
+                failures = server.fail_parts.get(part, 0)
+                if failures:
+                    server.fail_parts[part] = failures - 1
+            finally:
+                server.lock.release()
+            body = self.read_body()
+            if failures:
+                return self.reply(500, "<Error>InternalError</Error>")
+            if body is None:
+                return self.reply(400, "<Error>BadDigest</Error>")
+            if query["uploadId"] not in server.uploads:
+                return self.reply(404, "<Error>NoSuchUpload</Error>")
+            server.uploads[query["uploadId"]][part] = body
+            return self.reply(200, headers={"ETag": '"%s"' % md5.new(body).hexdigest()})
+        body = self.read_body()
+        if body is None:
+            return self.reply(400, "<Error>BadDigest</Error>")
+        server.objects[name] = body
+        etag = server.etag or md5.new(body).hexdigest()
+        self.reply(200, headers={"ETag": '"%s"' % etag})
+
+    def do_POST(self):
+        name, query = self.parse()
+        server = self.server
+        body = self.read_body()
+        if "uploads" in query:
+            upload_id = "upload%d" % len(server.uploads)
+            server.uploads[upload_id] = {}
+            return self.reply(200, "<InitiateMultipartUploadResult><UploadId>%s</UploadId>"
+                              "</InitiateMultipartUploadResult>" % upload_id)
+        parts = server.uploads.pop(query["uploadId"])
+        numbers = parts.keys()
+        numbers.sort()
+        if body.count("<PartNumber>") != len(numbers):
+            return self.reply(200, "<Error>InvalidPart</Error>")
+        server.objects[name] = "".join([parts[n] for n in numbers])
+        self.reply(200, "<CompleteMultipartUploadResult/>")
+
+    def do_HEAD(self):
+        name, query = self.parse()
+        if name not in self.server.objects:
+            return self.reply(404)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.server.objects[name])))
+        self.end_headers()
+
+    def do_GET(self):
+        name, query = self.parse()
+        data = self.server.objects[name]
+        start, end = self.headers.getheader("Range")[len("bytes="):].split("-")
+        self.reply(206, data[int(start):int(end) + 1])
+
+    def do_DELETE(self):
+        name, query = self.parse()
+        self.server.objects.pop(name, None)
+        self.reply(204)
+
+
+class S3ClientTest(unittest.TestCase):
+
+    MB = 1024 * 1024
+
+    def setUp(self):
+        self.server = S3StandIn()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.dir = tempfile.mkdtemp()
+        self.client = s3xen.S3Client("access", "secret", "127.0.0.1:%d" % self.server.server_address[1])
+        self.client.MULTIPART_STATE_DIR = os.path.join(self.dir, "state")
+        self.client.RANGED_GET_SIZE = self.MB
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def source(self, size):
+        path = os.path.join(self.dir, "src.vhd")
+        f = open(path, "wb")
+        try:
+            for i in range(0, size, 4096):
+                f.write(md5.new(str(i)).digest() * 256)
+            f.truncate(size)
+        finally:
+            f.close()
+        return path
+
+    def content(self, path):
+        f = open(path, "rb")
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def part_requests(self):
+        return [int(q["partNumber"]) for (method, key, q) in self.server.requests
+                if method == "PUT" and "partNumber" in q]
+
+    def test_single_put(self):
+        src = self.source(3 * self.MB + 17)
+        self.client.put("bucket", "key", src, 10 * self.MB)
+        self.assertEqual(self.content(src), self.server.objects[("bucket", "key")])
+
+    def test_multipart_put(self):
+        src = self.source(12 * self.MB + 5)
+        self.client.put("bucket", "key", src, self.MB)
+        self.assertEqual(self.content(src), self.server.objects[("bucket", "key")])
+        parts = self.part_requests()
+        parts.sort()
+        self.assertEqual([1, 2, 3], parts)
+        self.assertEqual([], os.listdir(self.client.MULTIPART_STATE_DIR))
+
+    def test_multipart_put_streams_parts(self):
+        src = self.source(11 * self.MB)
+        sends = []
+        connect = self.client.connect
+        def recording_connect():
+            connection = connect()
+            send = connection.send
+            def recording_send(data):
+                sends.append(len(data))
+                send(data)
+            connection.send = recording_send
+            return connection
+        self.client.connect = recording_connect
+        self.client.BLOCK_SIZE = 64 * 1024
+        self.client.put("bucket", "key", src, self.MB)
+        self.assertEqual(self.content(src), self.server.objects[("bucket", "key")])
+        self.assertTrue(max(sends) <= 64 * 1024)
+
+    def test_multipart_put_resumes(self):
+        src = self.source(16 * self.MB)
+        # more failures than the client retries
+        self.server.fail_parts[2] = self.client.max_error_retry
+        self.assertRaises(s3xen.S3Error, self.client.put, "bucket", "key", src, self.MB)
+        self.assertFalse(("bucket", "key") in self.server.objects)
+        self.server.requests = []
+        self.client.put("bucket", "key", src, self.MB)
+        self.assertEqual([2], self.part_requests())
+        self.assertEqual(self.content(src), self.server.objects[("bucket", "key")])
+
+    def test_ranged_get(self):
+        data = self.content(self.source(5 * self.MB + 3))
+        self.server.objects[("bucket", "key")] = data
+        target = os.path.join(self.dir, "target.vhd")
+        self.client.get("bucket", "key", target)
+        self.assertEqual(data, self.content(target))
+        gets = [m for (m, key, q) in self.server.requests if m == "GET"]
+        self.assertEqual(6, len(gets))
+
+    def test_put_md5_mismatch_keeps_object(self):
+        src = self.source(self.MB)
+        self.server.etag = "0" * 32
+        self.assertRaises(Exception, self.client.put, "bucket", "key", src, 10 * self.MB)
+        self.assertTrue(("bucket", "key") in self.server.objects)
+
+    def test_put_non_md5_etag_is_not_checked(self):
+        src = self.source(self.MB)
+        self.server.etag = "kms-etag-1"
+        self.client.put("bucket", "key", src, 10 * self.MB)
+        self.assertEqual(self.content(src), self.server.objects[("bucket", "key")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,198 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Checks the VHD block allocation table reader and the sparse copy of the
+vmopsSnapshot XenServer plugin on generated dynamic VHD files, the copies
+have to be byte for byte equal to their source.
+
+    python test/scripts/xenserver/test_vmopsSnapshot.py
+"""
+import imp
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import types
+import unittest
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "..", "..", "..", "scripts", "vm", "hypervisor", "xenserver")
+
+
+def load_vmopsSnapshot():
+    # dom0 only modules the plugin imports
+    for name in ["XenAPIPlugin", "SR", "VDI", "SRCommand", "util", "lvutil", "vhdutil",
+                 "lvhdutil", "xs_errors", "cleanup", "cloudstack_pluginlib"]:
+        if name not in sys.modules:
+            sys.modules[name] = types.ModuleType(name)
+    sys.modules["XenAPIPlugin"].dispatch = lambda fns: None
+    sys.modules["util"].CommandException = Exception
+    sys.modules["cloudstack_pluginlib"].setup_logging = lambda log_file=None: None
+    return imp.load_source("vmopsSnapshot", os.path.join(PLUGIN_DIR, "vmopsSnapshot"))
+
+vmopsSnapshot = load_vmopsSnapshot()
+
+SECTOR = 512
+UNUSED = 0xFFFFFFFFL
+
+
+def checksum(data):
+    return ~sum([ord(c) for c in data]) & 0xFFFFFFFFL
+
+
+def vhd_footer(size):
+    footer = struct.pack('>8sIIQI4sI4sQQIII16sB', 'conectix', 2, 0x00010000, SECTOR, 0,
+                         'tap\0', 0x00010000, 'Wi2k', size, size, 0, 3, 0,
+                         '0123456789abcdef', 0)
+    footer = footer + '\0' * (SECTOR - len(footer))
+    return footer[:64] + struct.pack('>I', checksum(footer)) + footer[68:]
+
+
+def vhd_header(table_offset, entries, block_size):
+    header = struct.pack('>8sQQIIII', 'cxsparse', 0xFFFFFFFFFFFFFFFFL, table_offset,
+                         0x00010000, entries, block_size, 0)
+    header = header + '\0' * (1024 - len(header))
+    return header[:36] + struct.pack('>I', checksum(header)) + header[40:]
+
+
+def make_vhd(path, blocks, block_size=64 * 1024, padding=0):
+    """
+    Writes a dynamic VHD with one BAT entry per item of blocks: None leaves
+    the block unallocated, otherwise the item is the data of the block.
+    padding zero bytes follow the trailing footer, as in an LV larger than
+    the VHD it holds.
+    """
+    entries = len(blocks)
+    table_offset = 3 * SECTOR
+    table_size = (entries * 4 + SECTOR - 1) / SECTOR * SECTOR
+    bitmap_size = (block_size / SECTOR / 8 + SECTOR - 1) / SECTOR * SECTOR
+    footer = vhd_footer(entries * block_size)
+
+    bat = []
+    data = []
+    offset = table_offset + table_size
+    for block in blocks:
+        if block is None:
+            bat.append(UNUSED)
+            continue
+        bat.append(offset / SECTOR)
+        data.append('\xff' * bitmap_size + block + '\0' * (block_size - len(block)))
+        offset = offset + bitmap_size + block_size
+
+    table = struct.pack('>%dI' % entries, *bat)
+    table = table + '\xff' * (table_size - len(table))
+    vhd = open(path, 'wb')
+    try:
+        vhd.write(footer)
+        vhd.write(vhd_header(table_offset, entries, block_size))
+        vhd.write(table)
+        vhd.write(''.join(data))
+        vhd.write(footer)
+        vhd.write('\0' * padding)
+    finally:
+        vhd.close()
+
+
+class SparseVhdCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, "src.vhd")
+        self.dst = os.path.join(self.dir, "dst.vhd")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def content(self, path):
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def block(self, seed, size=64 * 1024):
+        return (chr(seed) * 4096 + '\0' * 4096) * (size / 8192)
+
+    def copy(self):
+        ranges, footer_offset = vmopsSnapshot.getVhdDataRanges(self.src)
+        vmopsSnapshot.sparseCopyVhd(self.src, self.dst, ranges, footer_offset,
+                                    progressFile=os.path.join(self.dir, "progress"))
+        return ranges
+
+    def test_contiguous_blocks(self):
+        make_vhd(self.src, [self.block(i + 1) for i in range(8)])
+        ranges = self.copy()
+        self.assertEqual(1, len(ranges))
+        self.assertEqual(self.content(self.src), self.content(self.dst))
+
+    def test_unallocated_blocks(self):
+        make_vhd(self.src, [self.block(1), None, None, self.block(2), None, self.block(3), None])
+        self.copy()
+        self.assertEqual(self.content(self.src), self.content(self.dst))
+        copied, total = [int(n) for n in self.content(os.path.join(self.dir, "progress")).split()]
+        self.assertEqual(copied, total)
+        self.assertEqual(os.path.getsize(self.src) - SECTOR, total)
+
+    def test_zero_chunks_are_holes(self):
+        # a block of zeros stays unwritten in the copy yet reads back equal
+        zero = '\0' * (64 * 1024)
+        make_vhd(self.src, [self.block(1), zero, self.block(2)])
+        self.copy()
+        self.assertEqual(self.content(self.src), self.content(self.dst))
+        if hasattr(os.stat(self.dst), 'st_blocks'):
+            self.assertTrue(os.stat(self.dst).st_blocks * 512 <= os.path.getsize(self.dst))
+
+    def test_empty_bat_is_copied_whole(self):
+        make_vhd(self.src, [None] * 16)
+        self.assertEqual(None, vmopsSnapshot.getVhdDataRanges(self.src))
+
+    def test_lv_padding_is_dropped(self):
+        unpadded = os.path.join(self.dir, "unpadded.vhd")
+        blocks = [self.block(1), None, self.block(2)]
+        make_vhd(unpadded, blocks)
+        make_vhd(self.src, blocks, padding=4 * 1024 * 1024)
+        self.copy()
+        self.assertEqual(self.content(unpadded), self.content(self.dst))
+
+    def test_lv_without_trailing_footer(self):
+        # the footer copy at the start of the VHD ends the target
+        blocks = [self.block(1), self.block(2)]
+        make_vhd(self.src, blocks, padding=1024 * 1024)
+        data = self.content(self.src)
+        end = len(data) - 1024 * 1024
+        f = open(self.src, 'r+b')
+        try:
+            f.seek(end - SECTOR)
+            f.write('\0' * SECTOR)
+        finally:
+            f.close()
+        self.copy()
+        self.assertEqual(data[:end], self.content(self.dst))
+
+    def test_not_a_dynamic_vhd(self):
+        f = open(self.src, 'wb')
+        try:
+            f.write('\0' * (1024 * 1024))
+        finally:
+            f.close()
+        self.assertEqual(None, vmopsSnapshot.getVhdDataRanges(self.src))
+
+
+if __name__ == "__main__":
+    unittest.main()
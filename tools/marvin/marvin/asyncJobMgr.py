@@ -40,6 +40,8 @@ class jobStatus(object):
         self.duration = None
         self.jobId = None
         self.responsecls = None
+        self.cmd = None
+        self.future = None
 
     def __str__(self):
         return '{%s}' % str(', '.join('%s : %s' % (k, repr(v)) for (k, v)
@@ -47,60 +49,59 @@ class jobStatus(object):
 
 
 class workThread(threading.Thread):
-    def __init__(self, in_queue, outqueue, apiClient, db=None, lock=None):
+    '''
+    Executes the queued commands over a connection of its own, workers
+    share nothing so requests are issued concurrently
+    '''
+    def __init__(self, in_queue, outqueue, apiClient, db=None):
         threading.Thread.__init__(self)
         self.inqueue = in_queue
         self.output = outqueue
         self.connection = apiClient.connection.__copy__()
         self.db = None
-        self.lock = lock
 
     def queryAsynJob(self, job):
-        if job.jobId is None:
+        if job.future is None:
             return job
 
         try:
-            self.lock.acquire()
-            result = self.connection.poll(job.jobId, job.responsecls).jobresult
+            result = job.future.result().jobresult
         except cloudstackException.cloudstackAPIException, e:
             result = str(e)
-        finally:
-            self.lock.release()
 
         job.result = result
+        job.endTime = datetime.datetime.now()
+        job.duration = (job.endTime - job.startTime).total_seconds()
         return job
 
     def executeCmd(self, job):
         cmd = job.cmd
 
         jobstatus = jobStatus()
-        jobId = None
+        jobstatus.cmd = cmd.__class__.__name__.replace("Cmd", "")
+        jobstatus.startTime = datetime.datetime.now()
         try:
-            self.lock.acquire()
-
             if cmd.isAsync == "false":
-                jobstatus.startTime = datetime.datetime.now()
-
-                result = self.connection.marvin_request(cmd)
+                result = self.connection.marvinRequest(cmd)
                 jobstatus.result = result
                 jobstatus.endTime = datetime.datetime.now()
                 jobstatus.duration =\
-                    time.mktime(jobstatus.endTime.timetuple()) - time.mktime(
-                        jobstatus.startTime.timetuple())
+                    (jobstatus.endTime - jobstatus.startTime).total_seconds()
             else:
-                result = self.connection.marvinRequest(cmd)
-                if result is None:
+                try:
+                    responseName =\
+                        cmd.__class__.__name__.replace("Cmd", "Response")
+                    jobstatus.responsecls =\
+                        jsonHelper.getclassFromName(cmd, responseName)
+                except:
+                    pass
+                future = self.connection.marvinRequest(
+                    cmd, response_type=jobstatus.responsecls, wait=False)
+                if future is None:
                     jobstatus.status = False
                 else:
-                    jobId = result.jobid
-                    jobstatus.jobId = jobId
-                    try:
-                        responseName =\
-                            cmd.__class__.__name__.replace("Cmd", "Response")
-                        jobstatus.responsecls =\
-                            jsonHelper.getclassFromName(cmd, responseName)
-                    except:
-                        pass
+                    jobstatus.jobId = future.jobid
+                    jobstatus.future = future
                     jobstatus.status = True
         except cloudstackException.cloudstackAPIException, e:
             jobstatus.result = str(e)
@@ -108,14 +109,15 @@ class workThread(threading.Thread):
         except:
             jobstatus.status = False
             jobstatus.result = sys.exc_info()
-        finally:
-            self.lock.release()
 
         return jobstatus
 
     def run(self):
-        while self.inqueue.qsize() > 0:
-            job = self.inqueue.get()
+        while True:
+            try:
+                job = self.inqueue.get_nowait()
+            except Queue.Empty:
+                break
             if isinstance(job, jobStatus):
                 jobstatus = self.queryAsynJob(job)
             else:
@@ -194,12 +196,15 @@ class asyncJobMgr(object):
 
     def waitForComplete(self, workers=10):
         self.inqueue.join()
-        lock = threading.Lock()
         resultQueue = Queue.Queue()
-        '''intermediate result is stored in self.outqueue'''
+        '''
+        intermediate result is stored in self.outqueue, async jobs are
+        resolved by the poller of the connection, the workers only wait
+        on their futures
+        '''
         for i in range(workers):
             worker = workThread(self.outqueue, resultQueue, self.apiClient,
-                                self.db, lock)
+                                self.db)
             worker.start()
 
         self.outqueue.join()
@@ -218,14 +223,45 @@ class asyncJobMgr(object):
             threads to execute this commands
         '''
         self.submitCmds(cmds)
-        lock = threading.Lock()
         for i in range(workers):
             worker = workThread(self.inqueue, self.outqueue, self.apiClient,
-                                self.db, lock)
+                                self.db)
             worker.start()
 
         return self.waitForComplete(workers)
 
+    def getStatistics(self, asyncJobResult):
+        '''
+        @Desc : Summarizes the results of submitCmdsAndWait per API command
+        @Output: dict of command name to a dict holding the number of
+                 jobs, jobs/sec over the wall time and p50/p99 latency in
+                 seconds
+        '''
+        byCmd = {}
+        for jobstatus in asyncJobResult:
+            if jobstatus.duration is None:
+                continue
+            byCmd.setdefault(jobstatus.cmd, []).append(jobstatus)
+
+        stats = {}
+        for cmd, jobs in byCmd.iteritems():
+            durations = sorted([job.duration for job in jobs])
+            starts = [job.startTime for job in jobs
+                      if job.startTime is not None]
+            ends = [job.endTime for job in jobs if job.endTime is not None]
+            rate = None
+            if len(starts) > 0 and len(ends) > 0:
+                wall = (max(ends) - min(starts)).total_seconds()
+                if wall > 0:
+                    rate = len(jobs) / wall
+            stats[cmd] = {
+                "jobs": len(jobs),
+                "jobsPerSec": rate,
+                "p50": durations[int(0.50 * (len(durations) - 1))],
+                "p99": durations[int(0.99 * (len(durations) - 1))],
+            }
+        return stats
+
     def submitJobExecuteNtimes(self, job, ntimes=1, nums_threads=1,
                                interval=1):
         '''
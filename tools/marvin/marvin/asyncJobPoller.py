@@ -0,0 +1,240 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import threading
+import time
+import copy
+import cloudstackException
+from cloudstackAPI import queryAsyncJobResult, listAsyncJobs
+
+
+class jobFuture(object):
+    '''
+    Pending result of an async job, resolved by the asyncJobPoller
+    once the job leaves the pending state
+    '''
+    def __init__(self, jobid, responsecls=None, timeout=3600):
+        self.jobid = jobid
+        self.responsecls = responsecls
+        self.deadline = time.time() + timeout
+        self.__event = threading.Event()
+        self.__result = None
+        self.__exception = None
+
+    def done(self):
+        return self.__event.isSet()
+
+    def setResult(self, result):
+        self.__result = result
+        self.__event.set()
+
+    def setException(self, exception):
+        self.__exception = exception
+        self.__event.set()
+
+    def result(self, timeout=None):
+        '''
+        @Desc : Blocks until the job completes, or at most until the
+                deadline of the job when no timeout is given
+        @Output: queryAsyncJobResult response of the job, raises
+                 cloudstackAPIException if the job failed or timed out
+        '''
+        if timeout is None:
+            timeout = max(self.deadline - time.time(), 0)
+        self.__event.wait(timeout)
+        if not self.__event.isSet():
+            raise cloudstackException.cloudstackAPIException(
+                "asyncquery", "Async job timeout %s" % self.jobid)
+        if self.__exception is not None:
+            raise self.__exception
+        return self.__result
+
+
+class asyncJobPoller(object):
+    '''
+    Tracks every outstanding async job of a connection and resolves the
+    jobFuture of each one from a single polling thread.
+
+    The poll interval starts at minInterval and grows by backoff on every
+    round that completes nothing, capped at maxInterval. When more than
+    one job is outstanding, the states of all of them are fetched with one
+    listAsyncJobs call and queryAsyncJobResult is only issued for the jobs
+    that finished.
+    '''
+    def __init__(self, connection, minInterval=0.2, maxInterval=5.0,
+                 backoff=1.5):
+        self.connection = connection
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.backoff = backoff
+        self.interval = minInterval
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.thread = None
+        self.apiConnection = None
+
+    def submit(self, jobid, responsecls=None):
+        '''
+        @Desc : Starts tracking jobid
+        @Output: jobFuture resolved when the job completes
+        '''
+        future = jobFuture(jobid, responsecls, self.connection.asyncTimeout)
+        self.cond.acquire()
+        try:
+            self.pending.setdefault(jobid, []).append(future)
+            self.interval = self.minInterval
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name="asyncJobPoller")
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        return future
+
+    def run(self):
+        try:
+            self.poll()
+        except Exception, e:
+            # nothing would resolve the outstanding futures anymore
+            self.log("asyncJobPoller stopped on error: %s" % e)
+            self.cond.acquire()
+            try:
+                for futures in self.pending.itervalues():
+                    for future in futures:
+                        future.setException(
+                            cloudstackException.cloudstackAPIException(
+                                "asyncquery", "Async job poller failed: %s"
+                                % e))
+                self.pending = {}
+                self.thread = None
+            finally:
+                self.cond.release()
+
+    def poll(self):
+        if self.apiConnection is None:
+            self.apiConnection = copy.copy(self.connection)
+        while True:
+            self.cond.acquire()
+            try:
+                if len(self.pending) == 0:
+                    self.thread = None
+                    return
+                jobs = dict((jobid, list(futures)) for (jobid, futures)
+                            in self.pending.iteritems())
+            finally:
+                self.cond.release()
+
+            completed = self.checkJobs(jobs)
+
+            self.cond.acquire()
+            try:
+                for future in completed:
+                    futures = self.pending.get(future.jobid, [])
+                    if future in futures:
+                        futures.remove(future)
+                    if len(futures) == 0:
+                        self.pending.pop(future.jobid, None)
+                if len(completed) > 0:
+                    self.interval = self.minInterval
+                elif len(self.pending) > 0:
+                    self.cond.wait(self.interval)
+                    self.interval = min(self.interval * self.backoff,
+                                        self.maxInterval)
+            finally:
+                self.cond.release()
+
+    def checkJobs(self, jobs):
+        '''
+        @Desc : Runs one polling round over the given jobs
+        @Output: list of the futures resolved by this round
+        '''
+        states = {}
+        if len(jobs) > 1:
+            states = self.listJobStates(jobs)
+
+        completed = []
+        now = time.time()
+        for jobid, futures in jobs.iteritems():
+            for future in futures:
+                if states.get(jobid) != 0 and self.queryJob(future):
+                    completed.append(future)
+                elif now > future.deadline:
+                    future.setException(
+                        cloudstackException.cloudstackAPIException(
+                            "asyncquery", "Async job timeout %s" % jobid))
+                    completed.append(future)
+                else:
+                    self.log("job: %s still processing, will timeout in %ds"
+                             % (jobid, future.deadline - now))
+        return completed
+
+    def listJobStates(self, jobs):
+        '''
+        @Desc : Fetches the status of the account's recent async jobs in
+                one call
+        @Output: dict of jobid to jobstatus, jobs missing from the listing
+                 are left out and get queried individually
+        '''
+        oldest = min([future.deadline - self.connection.asyncTimeout
+                      for futures in jobs.itervalues()
+                      for future in futures])
+        cmd = listAsyncJobs.listAsyncJobsCmd()
+        cmd.startdate = time.strftime("%Y-%m-%d",
+                                      time.localtime(oldest - 86400))
+        cmd.page = 1
+        cmd.pagesize = 500
+        try:
+            asyncJobs = self.apiConnection.marvinRequest(cmd)
+        except Exception, e:
+            self.log("listAsyncJobs failed, querying jobs one by one: %s"
+                     % e)
+            return {}
+        states = {}
+        if asyncJobs is not None:
+            for asyncJob in asyncJobs:
+                if asyncJob.jobid in jobs:
+                    states[asyncJob.jobid] = asyncJob.jobstatus
+        return states
+
+    def queryJob(self, future):
+        '''
+        @Desc : Queries the result of one job and resolves its future
+        @Output: True if the future got resolved, False if still pending
+        '''
+        cmd = queryAsyncJobResult.queryAsyncJobResultCmd()
+        cmd.jobid = future.jobid
+        try:
+            response = self.apiConnection.marvinRequest(
+                cmd, response_type=future.responsecls)
+        except Exception, e:
+            future.setException(e)
+            return True
+
+        if response.jobstatus == 2:
+            future.setException(cloudstackException.cloudstackAPIException(
+                "asyncquery", response.jobresult))
+            return True
+        elif response.jobstatus == 1:
+            future.setResult(response)
+            return True
+        return False
+
+    def log(self, msg):
+        if self.connection.logger is not None:
+            self.connection.logger.debug(msg)
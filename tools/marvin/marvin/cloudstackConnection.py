@@ -16,6 +16,7 @@
 # under the License.
 
 import requests
+from requests.adapters import HTTPAdapter
 import urllib
 import base64
 import hmac
@@ -24,6 +25,7 @@ import time
 import cloudstackException
 from cloudstackAPI import *
 import jsonHelper
+from asyncJobPoller import asyncJobPoller
 from requests import (
     ConnectionError,
     HTTPError,
@@ -37,7 +39,7 @@ class cloudConnection(object):
     """ Connections to make API calls to the cloudstack management server
     """
     def __init__(self, mgmtDet, asyncTimeout=3600, logger=None,
-                 path='client/api'):
+                 path='client/api', poolSize=None):
         self.apiKey = mgmtDet.apiKey
         self.securityKey = mgmtDet.securityKey
         self.mgtSvr = mgmtDet.mgtSvrIp
@@ -60,12 +62,59 @@ class cloudConnection(object):
             self.protocol = "https"
         self.baseurl = "%s://%s:%d/%s"\
                        % (self.protocol, self.mgtSvr, self.port, self.path)
+        '''
+        Keep-alive session shared by every request of this connection, so
+        consecutive API calls reuse the TCP (and TLS) connection instead of
+        opening a new one each time
+        '''
+        self.poolSize = poolSize
+        if self.poolSize is None:
+            self.poolSize = getattr(mgmtDet, "poolSize", None) or 10
+        self.session = self.__createSession()
+        '''
+        Single poller tracking the async jobs of this connection and of
+        all its copies
+        '''
+        pollMaxInterval = getattr(mgmtDet, "pollMaxInterval", None) or 5
+        self.poller = asyncJobPoller(self, maxInterval=pollMaxInterval)
+
+    def __createSession(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=int(self.poolSize))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
 
     def __copy__(self):
-        return cloudConnection(self.mgtDetails,
-                               self.asyncTimeout,
-                               self.logger,
-                               self.path)
+        '''
+        Every copy gets its own pooled session, requests.Session is not
+        safe to share across worker threads
+        '''
+        connection = cloudConnection(self.mgtDetails,
+                                     self.asyncTimeout,
+                                     self.logger,
+                                     self.path,
+                                     self.poolSize)
+        connection.poller = self.poller
+        return connection
+
+    def close(self):
+        '''
+        Releases the pooled connections held by this connection
+        '''
+        if self.session is not None:
+            self.session.close()
+
+    def pollAsync(self, jobid, response):
+        """
+        registers jobid with the shared poller
+        @param jobid:
+        @param response:
+        @return: jobFuture which resolves to the queryAsyncJobResult
+                 response of the job
+        """
+        return self.poller.submit(jobid, response)
 
     def poll(self, jobid, response):
         """
@@ -74,27 +123,7 @@ class cloudConnection(object):
         @param response:
         @return:
         """
-        cmd = queryAsyncJobResult.queryAsyncJobResultCmd()
-        cmd.jobid = jobid
-        timeout = self.asyncTimeout
-
-        while timeout > 0:
-            asyncResonse = self.marvinRequest(cmd, response_type=response)
-
-            if asyncResonse.jobstatus == 2:
-                raise cloudstackException.cloudstackAPIException(
-                    "asyncquery", asyncResonse.jobresult)
-            elif asyncResonse.jobstatus == 1:
-                return asyncResonse
-
-            time.sleep(5)
-            if self.logger is not None:
-                self.logger.debug("job: %s still processing,"
-                                  "will timeout in %ds" % (jobid, timeout))
-            timeout = timeout - 5
-
-        raise cloudstackException.cloudstackAPIException(
-            "asyncquery", "Async job timeout %s" % jobid)
+        return self.pollAsync(jobid, response).result()
 
     def sign(self, payload):
         """
@@ -151,12 +180,7 @@ class cloudConnection(object):
 
             #Verify whether protocol is "http", then call the request over http
             if self.protocol == "http":
-                if method == 'POST':
-                    response = requests.post(self.baseurl, params=payload,
-                                             verify=https_flag)
-                else:
-                    response = requests.get(self.baseurl, params=payload,
-                                            verify=https_flag)
+                response = self.__send(method, payload, verify=https_flag)
             else:
                 '''
                 If protocol is https, then create the  connection url with \
@@ -164,15 +188,8 @@ class cloudConnection(object):
                 provided as part of cert
                 '''
                 try:
-                    if method == 'POST':
-                        response = requests.post(self.baseurl,
-                                                 params=payload,
-                                                 cert=cert_path,
-                                                 verify=https_flag)
-                    else:
-                        response = requests.get(self.baseurl, params=payload,
-                                                cert=cert_path,
-                                                verify=https_flag)
+                    response = self.__send(method, payload, cert=cert_path,
+                                           verify=https_flag)
                 except Exception, e:
                     '''
                     If an exception occurs with user provided CA certs, \
@@ -182,14 +199,7 @@ class cloudConnection(object):
                     self.logger.debug("Creating CS connection over https \
                                         didnt worked with user provided certs \
                                             , so trying with no certs %s" % e)
-                    if method == 'POST':
-                        response = requests.post(self.baseurl,
-                                                 params=payload,
-                                                 verify=https_flag)
-                    else:
-                        response = requests.get(self.baseurl,
-                                                params=payload,
-                                                verify=https_flag)
+                    response = self.__send(method, payload, verify=https_flag)
         except ConnectionError, c:
             self.logger.debug("Connection refused. Reason: %s : %s" %
                               (self.baseurl, c))
@@ -204,17 +214,32 @@ class cloudConnection(object):
             self.logger.debug("RequestException from server %s" % r)
             raise r
         except Exception, e:
-            self.logger.debug("Error returned by server %s" % r)
+            self.logger.debug("Error returned by server %s" % e)
             raise e
         else:
             return response
 
+    def __send(self, method, payload, **kwargs):
+        '''
+        Issues the GET/POST over the pooled session of this connection
+        '''
+        if method == 'POST':
+            return self.session.post(self.baseurl, params=payload, **kwargs)
+        return self.session.get(self.baseurl, params=payload, **kwargs)
+
     def sanitizeCommand(self, cmd):
         """
         Removes None values, Validates all required params are present
         @param cmd: Cmd object eg: createPhysicalNetwork
         @return:
         """
+        if hasattr(cmd, "to_params"):
+            '''
+            serializer generated by codegenerator for this command
+            '''
+            cmdname = cmd.__class__.__name__.replace("Cmd", "")
+            return cmdname.strip(), cmd.isAsync, cmd.to_params()
+
         requests = {}
         required = []
         for attribute in dir(cmd):
@@ -249,12 +274,15 @@ class cloudConnection(object):
                             i = i + 1
         return cmdname.strip(), isAsync, requests
 
-    def marvinRequest(self, cmd, response_type=None, method='GET', data=''):
+    def marvinRequest(self, cmd, response_type=None, method='GET', data='',
+                      wait=True):
         """
         Requester for marvin command objects
         @param cmd: marvin's command from cloudstackAPI
         @param response_type: response type of the command in cmd
         @param method: HTTP GET/POST, defaults to GET
+        @param wait: for async commands, False returns the jobFuture of
+                     the job instead of waiting for its result
         @return:
         """
         cmdname, isAsync, payload = self.sanitizeCommand(cmd)
@@ -277,5 +305,7 @@ class cloudConnection(object):
             return response
         else:
             asyncJobId = response.jobid
-            response = self.poll(asyncJobId, response_type)
-            return response.jobresult
+            future = self.pollAsync(asyncJobId, response_type)
+            if not wait:
+                return future
+            return future.result().jobresult
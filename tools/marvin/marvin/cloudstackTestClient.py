@@ -189,8 +189,13 @@ class cloudstackTestClient(object):
             return self.userApiClient
         return None
 
-    def submitCmdsAndWait(self, cmds, workers=1):
-        '''FixME, httplib has issue if more than one thread submitted'''
+    def submitCmdsAndWait(self, cmds, workers=None):
+        '''
+        submit cmds and wait for their results, with workers threads
+        issuing the requests concurrently (defaultWorkerThreads if None)
+        '''
+        if workers is None:
+            workers = self.defaultWorkerThreads
         if self.asyncJobMgr is None:
             self.asyncJobMgr = asyncJobMgr.asyncJobMgr(self.apiClient,
                                                        self.dbConnection)
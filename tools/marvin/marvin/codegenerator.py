@@ -110,6 +110,34 @@ class codeGenerator(object):
 
         self.subclass.append(subclass)
 
+    def generateToParams(self):
+        '''
+        generate to_params(), the request serializer of the command. The
+        parameter names and required flags are known here, so the
+        generated code touches each parameter exactly once instead of
+        walking dir(cmd) on every request
+        '''
+        self.code += self.newline
+        self.code += self.space + "def to_params(self):\n"
+        self.code += self.space * 2 + "params = {}\n"
+        for req in self.cmd.request:
+            if req.required == "true":
+                self.code += self.space * 2
+                self.code += "if self.%s is None:\n" % req.name
+                self.code += self.space * 3
+                self.code += 'self._missing("%s")\n' % req.name
+            # every parameter goes through _addList, a python list set on
+            # a parameter of any type is comma joined as before
+            self.code += self.space * 2
+            if req.required != "true":
+                self.code += "if self.%s is not None:\n" % req.name
+                self.code += self.space * 3
+            self.code += 'self._addList(params, "%s", self.%s)\n'\
+                % (req.name, req.name)
+        self.code += self.space * 2 + "if self.__dict__:\n"
+        self.code += self.space * 3 + "self._addExtras(params)\n"
+        self.code += self.space * 2 + "return params\n"
+
     def generate(self, cmd):
 
         self.cmd = cmd
@@ -120,6 +148,12 @@ class codeGenerator(object):
         self.code += 'from baseCmd import *\n'
         self.code += 'from baseResponse import *\n'
         self.code += "class %sCmd (baseCmd):\n" % self.cmd.name
+        self.code += self.space + "__slots__ = ["
+        for slot in ["isAsync"] + [req.name for req in self.cmd.request] +\
+                ["required"]:
+            self.code += '"' + slot + '",'
+        self.code += "]\n"
+        self.code += self.newline
         self.code += self.space + "def __init__(self):\n"
 
         self.code += self.space + self.space
@@ -145,6 +179,7 @@ class codeGenerator(object):
             self.code += '"' + require + '",'
         self.code += "]\n"
         self.required = []
+        self.generateToParams()
 
         """generate response code"""
         subItems = {}
@@ -216,14 +251,18 @@ class codeGenerator(object):
         body += self.space*2 + 'self._id = identifier' + self.newline
         body += self.newline
 
+        # Async commands called with wait=False return the jobFuture of
+        # the job right after submission, so one thread can keep many jobs
+        # in flight and collect them later with future.result()
         for cmdName in self.cmdsName:
             body += self.space
-            body += 'def %s(self, command, method="GET"):\n' % cmdName
+            body += 'def %s(self, command, method="GET", wait=True):\n'\
+                % cmdName
             body += self.space + self.space
             body += 'response = %sResponse()\n' % cmdName
             body += self.space + self.space
             body += 'response = self.connection.marvinRequest(command,'
-            body += ' response_type=response, method=method)\n'
+            body += ' response_type=response, method=method, wait=wait)\n'
             body += self.space + self.space + 'return response\n'
             body += self.newline
 
@@ -246,8 +285,43 @@ class codeGenerator(object):
         fp = open(self.outputFolder + '/cloudstackAPI/baseCmd.py', 'w')
         basecmd = self.license
         basecmd += '"""Base Command"""\n'
-        basecmd += 'class baseCmd(object):\n'
-        basecmd += self.space + 'pass\n'
+        basecmd += 'from marvin.cloudstackException import '
+        basecmd += 'cloudstackAPIException\n'
+        basecmd += self.newline
+        basecmd += self.newline
+        basecmd += dedent('''\
+            class baseCmd(object):
+                def _missing(self, name):
+                    raise cloudstackAPIException(
+                        self.__class__.__name__.replace("Cmd", ""),
+                        "%s is required" % name)
+
+                def _addList(self, params, name, value):
+                    \'\'\'
+                    lists are comma joined, maps become name[i].key, empty
+                    lists are left out and anything else (e.g. an already
+                    joined string) is passed as is
+                    \'\'\'
+                    if not isinstance(value, list):
+                        params[name] = value
+                    elif len(value) == 0:
+                        return
+                    elif not isinstance(value[0], dict):
+                        params[name] = ",".join(value)
+                    else:
+                        i = 0
+                        for val in value:
+                            for k, v in val.iteritems():
+                                params["%s[%d].%s" % (name, i, k)] = v
+                            i = i + 1
+
+                def _addExtras(self, params):
+                    \'\'\'attributes set outside of the API parameters\'\'\'
+                    for name, value in self.__dict__.iteritems():
+                        if name.startswith('__') or value is None:
+                            continue
+                        self._addList(params, name, value)
+            ''')
         fp.write(basecmd)
         fp.close()
 
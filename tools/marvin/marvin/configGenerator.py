@@ -31,6 +31,8 @@ class managementServer(object):
         self.useHttps = None
         self.certCAPath = None
         self.certPath = None
+        self.poolSize = 10
+        self.pollMaxInterval = 5
 
 
 class dbServer(object):
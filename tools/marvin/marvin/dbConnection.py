@@ -23,38 +23,202 @@ from contextlib import closing
 import cloudstackException
 import sys
 import os
+import threading
+
+
+class pooledConnection(object):
+    '''
+    A pooled mysql connection along with the prepared statements already
+    sent to the server over it
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+        self.statements = {}
+
+    def prepared(self, sql):
+        cursor = self.statements.get(sql)
+        if cursor is None:
+            cursor = self.conn.cursor(prepared=True)
+            self.statements[sql] = cursor
+        return cursor
+
+    def close(self):
+        for cursor in self.statements.values():
+            try:
+                cursor.close()
+            except errors.Error:
+                pass
+        self.statements = {}
+        self.conn.close()
 
 
 class dbConnection(object):
     def __init__(self, host="localhost", port=3306, user='cloud',
-                 passwd='cloud', db='cloud'):
+                 passwd='cloud', db='cloud', poolSize=5):
         self.host = host
         self.port = port
         self.user = str(user)  # Workaround: http://bugs.mysql.com/?id=67306
         self.passwd = passwd
         self.database = db
+        '''
+        Bounded pool of open connections, so queries stop paying the tcp
+        handshake and authentication each time
+        '''
+        self.poolSize = poolSize
+        self.idle = []
+        self.opened = 0
+        self.cond = threading.Condition()
+
+    def __connect(self):
+        conn = mysql.connector.connect(host=str(self.host),
+                                       port=int(self.port),
+                                       user=str(self.user),
+                                       password=str(self.passwd),
+                                       db=str(self.database))
+        conn.autocommit = True
+        return pooledConnection(conn)
+
+    def __acquire(self):
+        '''
+        Takes an idle connection, opens a new one while under poolSize, or
+        waits until another thread releases or discards one
+        '''
+        self.cond.acquire()
+        try:
+            while True:
+                if self.idle:
+                    pooled = self.idle.pop()
+                    break
+                if self.opened < self.poolSize:
+                    self.opened += 1
+                    pooled = None
+                    break
+                self.cond.wait()
+        finally:
+            self.cond.release()
+        if pooled is None:
+            try:
+                return self.__connect()
+            except:
+                self.__discard(None)
+                raise
+        if not pooled.conn.is_connected():
+            pooled.statements = {}
+            try:
+                pooled.conn.reconnect()
+            except:
+                self.__discard(pooled)
+                raise
+            pooled.conn.autocommit = True
+        return pooled
+
+    def __release(self, pooled):
+        self.cond.acquire()
+        try:
+            self.idle.append(pooled)
+            self.cond.notify()
+        finally:
+            self.cond.release()
 
-    def execute(self, sql=None, params=None):
+    def __discard(self, pooled):
+        if pooled is not None:
+            try:
+                pooled.close()
+            except errors.Error:
+                pass
+        self.cond.acquire()
+        try:
+            self.opened -= 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''
+        @Desc : Borrows a connection from the pool for the with block. A
+                block left by an exception (a failed query, an abandoned
+                iterate()) may leave the connection in an unknown state,
+                so it is dropped instead of being returned to the pool
+        '''
+        pooled = self.__acquire()
+        try:
+            yield pooled
+        except:
+            self.__discard(pooled)
+            raise
+        self.__release(pooled)
+
+    def close(self):
+        '''
+        Closes the idle pooled connections
+        '''
+        self.cond.acquire()
+        try:
+            idle, self.idle = self.idle, []
+        finally:
+            self.cond.release()
+        for pooled in idle:
+            self.__discard(pooled)
+
+    def execute(self, sql=None, params=None, prepared=False):
+        '''
+        @Desc : Runs sql over a pooled connection
+        @Input: prepared : prepare sql on the server and reuse it for the
+                           next executions with other params
+        @Output: rows of the result, [] for DML
+        '''
         if sql is None:
             return None
 
         resultRow = []
-        with contextlib.\
-            closing(mysql.connector.connect(host=str(self.host),
-                                            port=int(self.port),
-                                            user=str(self.user),
-                                            password=str(self.passwd),
-                                            db=str(self.database))) as conn:
-            conn.autocommit = True
-            with contextlib.closing(conn.cursor(buffered=True)) as cursor:
+        with self.connection() as pooled:
+            if prepared:
+                cursor = pooled.prepared(sql)
                 cursor.execute(sql, params)
                 try:
                     resultRow = cursor.fetchall()
                 except errors.InterfaceError:
                     #Raised on empty result - DML
                     resultRow = []
+            else:
+                with contextlib.closing(
+                        pooled.conn.cursor(buffered=True)) as cursor:
+                    cursor.execute(sql, params)
+                    try:
+                        resultRow = cursor.fetchall()
+                    except errors.InterfaceError:
+                        #Raised on empty result - DML
+                        resultRow = []
         return resultRow
 
+    def executeMany(self, sql, seqParams):
+        '''
+        @Desc : Runs sql once per params of seqParams, the connector sends
+                multi-row INSERTs as a single statement
+        @Output: number of rows affected
+        '''
+        with self.connection() as pooled:
+            with contextlib.closing(pooled.conn.cursor()) as cursor:
+                cursor.executemany(sql, seqParams)
+                return cursor.rowcount
+
+    def iterate(self, sql, params=None, batchSize=1000):
+        '''
+        @Desc : Generator streaming the rows of a large result set from the
+                server batchSize rows at a time, instead of buffering all
+                of them on the client
+        '''
+        with self.connection() as pooled:
+            with contextlib.closing(pooled.conn.cursor()) as cursor:
+                cursor.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(batchSize)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+
     def executeSqlFromFile(self, fileName=None):
         if fileName is None:
             raise cloudstackException.\
@@ -64,8 +228,46 @@ class dbConnection(object):
             raise cloudstackException.\
                 InvalidParameterException("%s not exists" % fileName)
 
-        sqls = open(fileName, "r").read()
-        return self.execute(sqls)
+        '''
+        Statements are read and sent one at a time over a single pooled
+        connection, a statement ends with a line ending in the current
+        delimiter, ';' unless changed by a DELIMITER line as in mysql client
+        scripts defining procedures or triggers
+        '''
+        resultRow = []
+        delimiter = ";"
+        with self.connection() as pooled:
+            with contextlib.closing(
+                    pooled.conn.cursor(buffered=True)) as cursor:
+                statement = []
+                for line in open(fileName, "r"):
+                    stripped = line.strip()
+                    if not statement:
+                        if stripped == "" or stripped.startswith("--"):
+                            continue
+                        words = stripped.split()
+                        if words[0].upper() == "DELIMITER" and \
+                                len(words) == 2:
+                            delimiter = words[1]
+                            continue
+                    statement.append(line)
+                    if stripped.endswith(delimiter):
+                        sql = "".join(statement).rstrip()[:-len(delimiter)]
+                        statement = []
+                        if not sql.strip():
+                            continue
+                        cursor.execute(sql)
+                        try:
+                            resultRow.extend(cursor.fetchall())
+                        except errors.InterfaceError:
+                            pass
+                if "".join(statement).strip():
+                    cursor.execute("".join(statement))
+                    try:
+                        resultRow.extend(cursor.fetchall())
+                    except errors.InterfaceError:
+                        pass
+        return resultRow
 
 if __name__ == "__main__":
     db = dbConnection()
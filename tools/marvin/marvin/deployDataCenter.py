@@ -20,37 +20,168 @@ import configGenerator
 import cloudstackException
 import cloudstackTestClient
 import logging
+import threading
+import Queue
+import copy
+import time
 from cloudstackAPI import *
+from functools import partial
 from os import path
 from time import sleep
 from optparse import OptionParser
 
 
+class deployTask(object):
+    def __init__(self, stage, func, deps):
+        self.stage = stage
+        self.func = func
+        self.deps = deps
+        self.children = []
+        self.waiting = len(deps)
+        self.result = None
+        self.duration = None
+
+
+class deployGraph(object):
+    """
+    Runs the deployTasks of a datacenter as a dependency graph. A task is
+    started once all the tasks it depends on completed, with at most
+    workers tasks running concurrently; it is called with the results of
+    its dependencies as arguments.
+    """
+    def __init__(self, workers=10, logger=None):
+        self.workers = max(int(workers), 1)
+        self.logger = logger
+        self.tasks = []
+        self.ready = Queue.Queue()
+        self.lock = threading.Lock()
+        self.remaining = 0
+        self.error = None
+        self.done = threading.Event()
+
+    def add(self, stage, func, deps=()):
+        task = deployTask(stage, func, list(deps))
+        for dep in task.deps:
+            dep.children.append(task)
+        self.tasks.append(task)
+        return task
+
+    def __worker(self):
+        while True:
+            task = self.ready.get()
+            if task is None:
+                return
+            start = time.time()
+            try:
+                if self.error is None:
+                    task.result = task.func(*[dep.result
+                                              for dep in task.deps])
+            except Exception, e:
+                self.error = e
+                if self.logger is not None:
+                    self.logger.exception("deploy stage %s failed"
+                                          % task.stage)
+            task.duration = time.time() - start
+            self.lock.acquire()
+            try:
+                self.remaining = self.remaining - 1
+                for child in task.children:
+                    child.waiting = child.waiting - 1
+                    if child.waiting == 0:
+                        self.ready.put(child)
+                if self.remaining == 0:
+                    self.done.set()
+            finally:
+                self.lock.release()
+
+    def run(self):
+        if len(self.tasks) == 0:
+            return
+        self.remaining = len(self.tasks)
+        for task in self.tasks:
+            if task.waiting == 0:
+                self.ready.put(task)
+        start = time.time()
+        threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.__worker)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        self.done.wait()
+        for thread in threads:
+            self.ready.put(None)
+        self.report(time.time() - start)
+        if self.error is not None:
+            raise self.error
+
+    def report(self, elapsed):
+        """logs the number of tasks and time spent per deploy stage"""
+        if self.logger is None:
+            return
+        stages = {}
+        for task in self.tasks:
+            count, total, longest = stages.get(task.stage, (0, 0.0, 0.0))
+            duration = task.duration or 0.0
+            stages[task.stage] = (count + 1, total + duration,
+                                  max(longest, duration))
+        for stage, (count, total, longest) in stages.iteritems():
+            self.logger.debug("deploy stage %s: %d tasks, %.2fs total, "
+                              "%.2fs longest" % (stage, count, total,
+                                                 longest))
+        self.logger.debug("deployed %d tasks with %d workers in %.2fs"
+                          % (len(self.tasks), self.workers, elapsed))
+
+
 class deployDataCenters(object):
 
-    def __init__(self, cfg, logger=None):
+    def __init__(self, cfg, logger=None, workers=10):
         self.config = cfg
         self.tcRunLogger = logger
+        self.workers = workers
+        self.local = threading.local()
+        self.mainApiClient = None
+
+    @property
+    def apiClient(self):
+        """
+        api client of the calling thread, deployGraph workers get their own
+        copy of the main client so their requests don't share a session
+        """
+        client = getattr(self.local, "apiClient", None)
+        if client is None and self.mainApiClient is not None:
+            client = copy.copy(self.mainApiClient)
+            client.hypervisor = self.mainApiClient.hypervisor
+            self.local.apiClient = client
+        return client
+
+    @apiClient.setter
+    def apiClient(self, client):
+        self.mainApiClient = client
+        self.local.apiClient = client
 
     def addHosts(self, hosts, zoneId, podId, clusterId, hypervisor):
         if hosts is None:
             return
         for host in hosts:
-            hostcmd = addHost.addHostCmd()
-            hostcmd.clusterid = clusterId
-            hostcmd.cpunumber = host.cpunumer
-            hostcmd.cpuspeed = host.cpuspeed
-            hostcmd.hostmac = host.hostmac
-            hostcmd.hosttags = host.hosttags
-            hostcmd.hypervisor = host.hypervisor
-            hostcmd.memory = host.memory
-            hostcmd.password = host.password
-            hostcmd.podid = podId
-            hostcmd.url = host.url
-            hostcmd.username = host.username
-            hostcmd.zoneid = zoneId
-            hostcmd.hypervisor = hypervisor
-            self.apiClient.addHost(hostcmd)
+            self.addHost(host, zoneId, podId, clusterId, hypervisor)
+
+    def addHost(self, host, zoneId, podId, clusterId, hypervisor):
+        hostcmd = addHost.addHostCmd()
+        hostcmd.clusterid = clusterId
+        hostcmd.cpunumber = host.cpunumer
+        hostcmd.cpuspeed = host.cpuspeed
+        hostcmd.hostmac = host.hostmac
+        hostcmd.hosttags = host.hosttags
+        hostcmd.hypervisor = host.hypervisor
+        hostcmd.memory = host.memory
+        hostcmd.password = host.password
+        hostcmd.podid = podId
+        hostcmd.url = host.url
+        hostcmd.username = host.username
+        hostcmd.zoneid = zoneId
+        hostcmd.hypervisor = hypervisor
+        self.apiClient.addHost(hostcmd)
 
     def addVmWareDataCenter(self, vmwareDc):
         vdc = addVmwareDc.addVmwareDcCmd()
@@ -70,17 +201,7 @@ class deployDataCenters(object):
             self.addVmWareDataCenter(vmwareDc)
 
         for cluster in clusters:
-            clustercmd = addCluster.addClusterCmd()
-            clustercmd.clustername = cluster.clustername
-            clustercmd.clustertype = cluster.clustertype
-            clustercmd.hypervisor = cluster.hypervisor
-            clustercmd.password = cluster.password
-            clustercmd.podid = podId
-            clustercmd.url = cluster.url
-            clustercmd.username = cluster.username
-            clustercmd.zoneid = zoneId
-            clusterresponse = self.apiClient.addCluster(clustercmd)
-            clusterId = clusterresponse[0].id
+            clusterId = self.createCluster(cluster, zoneId, podId)
 
             if cluster.hypervisor.lower() != "vmware":
                 self.addHosts(cluster.hosts, zoneId, podId, clusterId,
@@ -89,6 +210,19 @@ class deployDataCenters(object):
             self.createPrimaryStorages(cluster.primaryStorages, zoneId, podId,
                                        clusterId)
 
+    def createCluster(self, cluster, zoneId, podId):
+        clustercmd = addCluster.addClusterCmd()
+        clustercmd.clustername = cluster.clustername
+        clustercmd.clustertype = cluster.clustertype
+        clustercmd.hypervisor = cluster.hypervisor
+        clustercmd.password = cluster.password
+        clustercmd.podid = podId
+        clustercmd.url = cluster.url
+        clustercmd.username = cluster.username
+        clustercmd.zoneid = zoneId
+        clusterresponse = self.apiClient.addCluster(clustercmd)
+        return clusterresponse[0].id
+
     def waitForHost(self, zoneId, clusterId):
         """
         Wait for the hosts in the zoneid, clusterid to be up
@@ -98,11 +232,10 @@ class deployDataCenters(object):
         retry, timeout = 2, 30
         cmd = listHosts.listHostsCmd()
         cmd.clusterid, cmd.zoneid = clusterId, zoneId
-        hosts = self.apiClient.listHosts(cmd)
         while retry != 0:
-            for host in hosts:
-                if host.state != 'Up':
-                    break
+            hosts = self.apiClient.listHosts(cmd)
+            if hosts and all(host.state == 'Up' for host in hosts):
+                return
             sleep(timeout)
             retry = retry - 1
 
@@ -110,37 +243,43 @@ class deployDataCenters(object):
         if primaryStorages is None:
             return
         for primary in primaryStorages:
-            primarycmd = createStoragePool.createStoragePoolCmd()
-            primarycmd.details = primary.details
-            primarycmd.name = primary.name
-            primarycmd.podid = podId
-            primarycmd.tags = primary.tags
-            primarycmd.url = primary.url
-            primarycmd.zoneid = zoneId
-            primarycmd.clusterid = clusterId
-            self.apiClient.createStoragePool(primarycmd)
+            self.createPrimaryStorage(primary, zoneId, podId, clusterId)
+
+    def createPrimaryStorage(self, primary, zoneId, podId, clusterId):
+        primarycmd = createStoragePool.createStoragePoolCmd()
+        primarycmd.details = primary.details
+        primarycmd.name = primary.name
+        primarycmd.podid = podId
+        primarycmd.tags = primary.tags
+        primarycmd.url = primary.url
+        primarycmd.zoneid = zoneId
+        primarycmd.clusterid = clusterId
+        self.apiClient.createStoragePool(primarycmd)
 
     def createPods(self, pods, zoneId, networkId=None):
         if pods is None:
             return
         for pod in pods:
-            createpod = createPod.createPodCmd()
-            createpod.name = pod.name
-            createpod.gateway = pod.gateway
-            createpod.netmask = pod.netmask
-            createpod.startip = pod.startip
-            createpod.endip = pod.endip
-            createpod.zoneid = zoneId
-            createpodResponse = self.apiClient.createPod(createpod)
-            podId = createpodResponse.id
-
-            if pod.guestIpRanges is not None and networkId is not None:
-                self.createVlanIpRanges("Basic", pod.guestIpRanges, zoneId,
-                                        podId, networkId)
-
+            podId = self.createPod(pod, zoneId, networkId)
             self.createClusters(pod.clusters, zoneId, podId,
                                 vmwareDc=pod.vmwaredc)
 
+    def createPod(self, pod, zoneId, networkId=None):
+        createpod = createPod.createPodCmd()
+        createpod.name = pod.name
+        createpod.gateway = pod.gateway
+        createpod.netmask = pod.netmask
+        createpod.startip = pod.startip
+        createpod.endip = pod.endip
+        createpod.zoneid = zoneId
+        createpodResponse = self.apiClient.createPod(createpod)
+        podId = createpodResponse.id
+
+        if pod.guestIpRanges is not None and networkId is not None:
+            self.createVlanIpRanges("Basic", pod.guestIpRanges, zoneId,
+                                    podId, networkId)
+        return podId
+
     def createVlanIpRanges(self, mode, ipranges, zoneId, podId=None,
                            networkId=None, forvirtualnetwork=None):
         if ipranges is None:
@@ -369,109 +508,208 @@ class deployDataCenters(object):
         return self.apiClient.updateZone(zoneCmd)
 
     def createZones(self, zones):
+        """
+        Deploys the zones as a deployGraph: zone -> pod -> cluster ->
+        host/primary storage, with the independent pods, clusters, hosts
+        and storages of all zones created concurrently by self.workers
+        threads
+        """
+        graph = deployGraph(self.workers, self.tcRunLogger)
         for zone in zones:
-            createzone = createZone.createZoneCmd()
-            createzone.dns1 = zone.dns1
-            createzone.dns2 = zone.dns2
-            createzone.internaldns1 = zone.internaldns1
-            createzone.internaldns2 = zone.internaldns2
-            createzone.name = zone.name
-            createzone.securitygroupenabled = zone.securitygroupenabled
-            createzone.localstorageenabled = zone.localstorageenabled
-            createzone.networktype = zone.networktype
-            if zone.securitygroupenabled != "true":
-                createzone.guestcidraddress = zone.guestcidraddress
-
-            zoneresponse = self.apiClient.createZone(createzone)
-            zoneId = zoneresponse.id
-
-            for pnet in zone.physical_networks:
-                phynetwrk = self.createPhysicalNetwork(pnet, zoneId)
-                self.configureProviders(phynetwrk, pnet.providers)
-                self.updatePhysicalNetwork(phynetwrk.id, "Enabled",
-                                           vlan=pnet.vlan)
-
-            if zone.networktype == "Basic":
-                listnetworkoffering =\
-                    listNetworkOfferings.listNetworkOfferingsCmd()
-                listnetworkoffering.name =\
-                    "DefaultSharedNetscalerEIPandELBNetworkOffering" \
-                    if len(filter(lambda x:
-                                  x.typ == 'Public',
-                                  zone.physical_networks[0].
-                                  traffictypes)) > 0 \
-                    else "DefaultSharedNetworkOfferingWithSGService"
-                if zone.networkofferingname is not None:
-                    listnetworkoffering.name = zone.networkofferingname
-
-                listnetworkofferingresponse = \
-                    self.apiClient.listNetworkOfferings(listnetworkoffering)
-
-                guestntwrk = configGenerator.network()
-                guestntwrk.displaytext = "guestNetworkForBasicZone"
-                guestntwrk.name = "guestNetworkForBasicZone"
-                guestntwrk.zoneid = zoneId
-                guestntwrk.networkofferingid = \
-                    listnetworkofferingresponse[0].id
-
-                networkid = self.createNetworks([guestntwrk], zoneId)
-                self.createPods(zone.pods, zoneId, networkid)
-                if self.isEipElbZone(zone):
-                    self.createVlanIpRanges(zone.networktype, zone.ipranges,
-                                            zoneId, forvirtualnetwork=True)
-
-            isPureAdvancedZone = (zone.networktype == "Advanced"
-                                  and zone.securitygroupenabled != "true")
-            if isPureAdvancedZone:
-                self.createPods(zone.pods, zoneId)
-                self.createVlanIpRanges(zone.networktype, zone.ipranges,
-                                        zoneId)
-            elif (zone.networktype == "Advanced"
-                  and zone.securitygroupenabled == "true"):
-                listnetworkoffering =\
-                    listNetworkOfferings.listNetworkOfferingsCmd()
-                listnetworkoffering.name =\
-                    "DefaultSharedNetworkOfferingWithSGService"
-                if zone.networkofferingname is not None:
-                    listnetworkoffering.name = zone.networkofferingname
-
-                listnetworkofferingresponse = \
-                    self.apiClient.listNetworkOfferings(listnetworkoffering)
-
-                networkcmd = createNetwork.createNetworkCmd()
-                networkcmd.displaytext = "Shared SG enabled network"
-                networkcmd.name = "Shared SG enabled network"
-                networkcmd.networkofferingid =\
-                    listnetworkofferingresponse[0].id
-                networkcmd.zoneid = zoneId
-
-                ipranges = zone.ipranges
-                if ipranges:
-                    iprange = ipranges.pop()
-                    networkcmd.startip = iprange.startip
-                    networkcmd.endip = iprange.endip
-                    networkcmd.gateway = iprange.gateway
-                    networkcmd.netmask = iprange.netmask
-                    networkcmd.vlan = iprange.vlan
-
-                networkcmdresponse = self.apiClient.createNetwork(networkcmd)
-                networkId = networkcmdresponse.id
-                self.createPods(zone.pods, zoneId, networkId)
-
-            '''Note: Swift needs cache storage first'''
-            self.createCacheStorages(zone.cacheStorages, zoneId)
-            self.createSecondaryStorages(zone.secondaryStorages, zoneId)
-
-            enabled = getattr(zone, 'enabled', 'True')
-            if enabled == 'True' or enabled is None:
-                self.enableZone(zoneId, "Enabled")
-            details = getattr(zone, 'details')
-            if details is not None:
-                det = [d.__dict__ for d in details]
-                self.updateZoneDetails(zoneId, det)
-
+            self.addZoneTasks(graph, zone)
+        graph.run()
         return
 
+    def addZoneTasks(self, graph, zone):
+        zoneTask = graph.add("zone", partial(self.createZone, zone))
+        zoneTasks = [zoneTask]
+        podTasks = []
+        for pod in (zone.pods or []):
+            podTask = graph.add("pod", partial(self.createZonePod, pod),
+                                [zoneTask])
+            podTasks.append(podTask)
+            zoneTasks.append(podTask)
+            for cluster in (pod.clusters or []):
+                zoneTasks.extend(self.addClusterTasks(graph, zoneTask,
+                                                      podTask, cluster))
+
+        isPureAdvancedZone = (zone.networktype == "Advanced"
+                              and zone.securitygroupenabled != "true")
+        if self.isEipElbZone(zone) or isPureAdvancedZone:
+            zoneTasks.append(graph.add(
+                "ipRange", partial(self.createZoneIpRanges, zone),
+                [zoneTask] + podTasks))
+
+        '''Note: Swift needs cache storage first'''
+        cacheTask = graph.add(
+            "cacheStorage",
+            partial(self.createZoneStorages, zone.cacheStorages,
+                    self.createCacheStorages),
+            [zoneTask])
+        secondaryTask = graph.add(
+            "secondaryStorage",
+            partial(self.createZoneStorages, zone.secondaryStorages,
+                    self.createSecondaryStorages),
+            [zoneTask, cacheTask])
+        zoneTasks.extend([cacheTask, secondaryTask])
+
+        graph.add("enableZone", partial(self.finalizeZone, zone), zoneTasks)
+
+    def addClusterTasks(self, graph, zoneTask, podTask, cluster):
+        clusterTask = graph.add("cluster",
+                                partial(self.createZoneCluster, cluster),
+                                [zoneTask, podTask])
+        deps = [zoneTask, podTask, clusterTask]
+
+        hostTasks = []
+        if cluster.hypervisor.lower() != "vmware":
+            for host in (cluster.hosts or []):
+                hostTasks.append(graph.add(
+                    "host",
+                    partial(self.addZoneHost, host, cluster.hypervisor),
+                    deps))
+        waitTask = graph.add("waitForHost", self.waitForZoneHost,
+                             deps + hostTasks)
+
+        storageTasks = []
+        for primary in (cluster.primaryStorages or []):
+            storageTasks.append(graph.add(
+                "primaryStorage",
+                partial(self.createZonePrimaryStorage, primary),
+                deps + [waitTask]))
+        return [clusterTask, waitTask] + hostTasks + storageTasks
+
+    '''
+    deployGraph tasks, called with the results of the tasks they depend
+    on: the (zoneId, networkId) of the zone first, then the pod and
+    cluster ids where relevant
+    '''
+    def createZonePod(self, pod, zoneInfo):
+        zoneId, networkId = zoneInfo
+        podId = self.createPod(pod, zoneId, networkId)
+        if pod.vmwaredc:
+            pod.vmwaredc.zoneid = zoneId
+            self.addVmWareDataCenter(pod.vmwaredc)
+        return podId
+
+    def createZoneCluster(self, cluster, zoneInfo, podId):
+        return self.createCluster(cluster, zoneInfo[0], podId)
+
+    def addZoneHost(self, host, hypervisor, zoneInfo, podId, clusterId):
+        self.addHost(host, zoneInfo[0], podId, clusterId, hypervisor)
+
+    def waitForZoneHost(self, zoneInfo, podId, clusterId, *hosts):
+        self.waitForHost(zoneInfo[0], clusterId)
+
+    def createZonePrimaryStorage(self, primary, zoneInfo, podId, clusterId,
+                                 *deps):
+        self.createPrimaryStorage(primary, zoneInfo[0], podId, clusterId)
+
+    def createZoneIpRanges(self, zone, zoneInfo, *pods):
+        if self.isEipElbZone(zone):
+            self.createVlanIpRanges(zone.networktype, zone.ipranges,
+                                    zoneInfo[0], forvirtualnetwork=True)
+        else:
+            self.createVlanIpRanges(zone.networktype, zone.ipranges,
+                                    zoneInfo[0])
+
+    def createZoneStorages(self, storages, createStorages, zoneInfo, *deps):
+        createStorages(storages, zoneInfo[0])
+
+    def finalizeZone(self, zone, zoneInfo, *deps):
+        zoneId = zoneInfo[0]
+        enabled = getattr(zone, 'enabled', 'True')
+        if enabled == 'True' or enabled is None:
+            self.enableZone(zoneId, "Enabled")
+        details = getattr(zone, 'details')
+        if details is not None:
+            det = [d.__dict__ for d in details]
+            self.updateZoneDetails(zoneId, det)
+
+    def createZone(self, zone):
+        """
+        Creates the zone with its physical networks and guest network
+        @return: (zoneId, networkId), networkId is None for pure advanced
+                 zones
+        """
+        createzone = createZone.createZoneCmd()
+        createzone.dns1 = zone.dns1
+        createzone.dns2 = zone.dns2
+        createzone.internaldns1 = zone.internaldns1
+        createzone.internaldns2 = zone.internaldns2
+        createzone.name = zone.name
+        createzone.securitygroupenabled = zone.securitygroupenabled
+        createzone.localstorageenabled = zone.localstorageenabled
+        createzone.networktype = zone.networktype
+        if zone.securitygroupenabled != "true":
+            createzone.guestcidraddress = zone.guestcidraddress
+
+        zoneresponse = self.apiClient.createZone(createzone)
+        zoneId = zoneresponse.id
+
+        for pnet in zone.physical_networks:
+            phynetwrk = self.createPhysicalNetwork(pnet, zoneId)
+            self.configureProviders(phynetwrk, pnet.providers)
+            self.updatePhysicalNetwork(phynetwrk.id, "Enabled",
+                                       vlan=pnet.vlan)
+
+        networkId = None
+        if zone.networktype == "Basic":
+            listnetworkoffering =\
+                listNetworkOfferings.listNetworkOfferingsCmd()
+            listnetworkoffering.name =\
+                "DefaultSharedNetscalerEIPandELBNetworkOffering" \
+                if len(filter(lambda x:
+                              x.typ == 'Public',
+                              zone.physical_networks[0].
+                              traffictypes)) > 0 \
+                else "DefaultSharedNetworkOfferingWithSGService"
+            if zone.networkofferingname is not None:
+                listnetworkoffering.name = zone.networkofferingname
+
+            listnetworkofferingresponse = \
+                self.apiClient.listNetworkOfferings(listnetworkoffering)
+
+            guestntwrk = configGenerator.network()
+            guestntwrk.displaytext = "guestNetworkForBasicZone"
+            guestntwrk.name = "guestNetworkForBasicZone"
+            guestntwrk.zoneid = zoneId
+            guestntwrk.networkofferingid = \
+                listnetworkofferingresponse[0].id
+
+            networkId = self.createNetworks([guestntwrk], zoneId)
+        elif (zone.networktype == "Advanced"
+              and zone.securitygroupenabled == "true"):
+            listnetworkoffering =\
+                listNetworkOfferings.listNetworkOfferingsCmd()
+            listnetworkoffering.name =\
+                "DefaultSharedNetworkOfferingWithSGService"
+            if zone.networkofferingname is not None:
+                listnetworkoffering.name = zone.networkofferingname
+
+            listnetworkofferingresponse = \
+                self.apiClient.listNetworkOfferings(listnetworkoffering)
+
+            networkcmd = createNetwork.createNetworkCmd()
+            networkcmd.displaytext = "Shared SG enabled network"
+            networkcmd.name = "Shared SG enabled network"
+            networkcmd.networkofferingid =\
+                listnetworkofferingresponse[0].id
+            networkcmd.zoneid = zoneId
+
+            ipranges = zone.ipranges
+            if ipranges:
+                iprange = ipranges.pop()
+                networkcmd.startip = iprange.startip
+                networkcmd.endip = iprange.endip
+                networkcmd.gateway = iprange.gateway
+                networkcmd.netmask = iprange.netmask
+                networkcmd.vlan = iprange.vlan
+
+            networkcmdresponse = self.apiClient.createNetwork(networkcmd)
+            networkId = networkcmdresponse.id
+        return zoneId, networkId
+
     def isEipElbZone(self, zone):
         if (zone.networktype == "Basic"
             and len(filter(lambda x: x.typ == 'Public',
@@ -562,13 +800,16 @@ if __name__ == "__main__":
                       default="./datacenterCfg", dest="input", help="the path \
                       where the json config file generated, by default is \
                       ./datacenterCfg")
+    parser.add_option("-w", "--workers", action="store", type="int",
+                      default=10, dest="workers", help="number of api \
+                      calls issued concurrently while deploying")
 
     (options, args) = parser.parse_args()
     from marvin.marvinLog import MarvinLog
     cfg = configGenerator.getSetupConfig(options.input)
     log_obj = MarvinLog("CSLog")
     tcRunLogger = log_obj.setLogHandler("/tmp/debug.log")
-    deploy = deployDataCenters(cfg, tcRunLogger)
+    deploy = deployDataCenters(cfg, tcRunLogger, options.workers)
     deploy.deploy()
 
     """
@@ -20,7 +20,7 @@
 """
 
 import marvin
-from utils import is_server_ssh_ready, random_gen
+from utils import is_server_ssh_ready, random_gen, streamable
 from marvin.cloudstackAPI import *
 # Import System modules
 import time
@@ -73,6 +73,7 @@ class Domain:
         apiclient.deleteDomain(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists domains"""
         cmd = listDomains.listDomainsCmd()
@@ -123,6 +124,7 @@ class Account:
         apiclient.deleteAccount(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists accounts and provides detailed account information for
         listed accounts"""
@@ -171,6 +173,7 @@ class User:
         apiclient.deleteUser(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists users and provides detailed account information for
         listed users"""
@@ -605,6 +608,7 @@ class VirtualMachine:
         return apiclient.changeServiceForVirtualMachine(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all VMs matching criteria"""
 
@@ -757,6 +761,7 @@ class Volume:
         apiclient.deleteVolume(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all volumes matching criteria"""
 
@@ -858,6 +863,7 @@ class Snapshot:
         apiclient.deleteSnapshot(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all snapshots matching criteria"""
 
@@ -1065,6 +1071,7 @@ class Template:
         return(apiclient.updateTemplatePermissions(cmd))
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all templates matching criteria"""
 
@@ -1164,6 +1171,7 @@ class Iso:
         return
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists all available ISO files."""
 
@@ -1220,6 +1228,7 @@ class PublicIPAddress:
         return
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all Public IPs matching criteria"""
 
@@ -1280,6 +1289,7 @@ class NATRule:
         return
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all NAT rules matching criteria"""
 
@@ -1328,6 +1338,7 @@ class StaticNATRule:
         return
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all IP forwarding rules matching criteria"""
 
@@ -1391,6 +1402,7 @@ class EgressFireWallRule:
         return
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all Egress Firewall Rules matching criteria"""
 
@@ -1436,6 +1448,7 @@ class FireWallRule:
         return
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all Firewall Rules matching criteria"""
 
@@ -1495,6 +1508,7 @@ class ServiceOffering:
         return
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists all available service offerings."""
 
@@ -1536,6 +1550,7 @@ class DiskOffering:
         return
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists all available disk offerings."""
 
@@ -1612,6 +1627,7 @@ class NetworkOffering:
         return(apiclient.updateNetworkOffering(cmd))
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists all available network offerings."""
 
@@ -1645,6 +1661,7 @@ class SnapshotPolicy:
         return
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists snapshot policies."""
 
@@ -1765,6 +1782,7 @@ class LoadBalancerRule:
         return apiclient.listLBStickinessPolicies(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all Load balancing rules matching criteria"""
 
@@ -1815,6 +1833,7 @@ class Cluster:
         return
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all Clusters matching criteria"""
 
@@ -1905,6 +1924,7 @@ class Host:
         return apiclient.cancelHostMaintenance(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all Hosts matching criteria"""
 
@@ -1982,6 +2002,7 @@ class StoragePool:
         return apiclient.enableStorageMaintenance(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all storage pools matching criteria"""
 
@@ -2080,6 +2101,7 @@ class Network:
         return(apiclient.restartNetwork(cmd))
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all Networks matching criteria"""
 
@@ -2154,6 +2176,7 @@ class NetworkACL:
         return apiclient.deleteNetworkACL(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List Network ACLs"""
 
@@ -2198,6 +2221,7 @@ class NetworkACLList:
         return apiclient.deleteNetworkACLList(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List Network ACL lists"""
 
@@ -2238,6 +2262,7 @@ class Vpn:
         apiclient.deleteRemoteAccessVpn(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all VPN matching criteria"""
 
@@ -2282,6 +2307,7 @@ class VpnUser:
         apiclient.removeVpnUser(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all VPN Users matching criteria"""
 
@@ -2332,6 +2358,7 @@ class Zone:
         return apiclient.updateZone(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all Zones matching criteria"""
 
@@ -2367,6 +2394,7 @@ class Pod:
         apiclient.deletePod(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         "Returns a default pod for specified zone"
 
@@ -2405,6 +2433,7 @@ class PublicIpRange:
         apiclient.deleteVlanIpRange(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists all VLAN IP ranges."""
 
@@ -2461,6 +2490,7 @@ class PortablePublicIpRange:
         apiclient.deletePortableIpRange(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists all portable public IP ranges."""
 
@@ -2497,6 +2527,7 @@ class SecondaryStagingStore:
         apiclient.deleteSecondaryStagingStore(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         cmd = listSecondaryStagingStores.listSecondaryStagingStoresCmd()
         [setattr(cmd, k, v) for k, v in kwargs.items()]
@@ -2532,6 +2563,7 @@ class ImageStore:
         apiclient.deleteImageStore(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         cmd = listImageStores.listImageStoresCmd()
         [setattr(cmd, k, v) for k, v in kwargs.items()]
@@ -2606,6 +2638,7 @@ class PhysicalNetwork:
         return apiclient.listDedicatedGuestVlanRanges(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists all physical networks"""
 
@@ -2720,6 +2753,7 @@ class SecurityGroup:
         return apiclient.revokeSecurityGroupEgress(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists all security groups."""
 
@@ -2805,6 +2839,7 @@ class Project:
         return(apiclient.listProjectAccounts(cmd))
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists all projects."""
 
@@ -2841,6 +2876,7 @@ class ProjectInvitation:
         return apiclient.deleteProjectInvitation(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists project invitations"""
 
@@ -2862,6 +2898,7 @@ class Configurations:
         apiclient.updateConfiguration(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists configurations"""
 
@@ -2925,6 +2962,7 @@ class NetScaler:
         return(apiclient.configureNetscalerLoadBalancer(cmd))
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List already registered netscaler devices"""
 
@@ -2974,6 +3012,7 @@ class NetworkServiceProvider:
         return apiclient.updateNetworkServiceProvider(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List network service providers"""
 
@@ -3027,6 +3066,7 @@ class Router:
         return apiclient.changeServiceForRouter(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List routers"""
 
@@ -3071,6 +3111,7 @@ class Tag:
         apiclient.deleteTags(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all tags matching the criteria"""
 
@@ -3124,6 +3165,7 @@ class VpcOffering:
         return apiclient.updateVPCOffering(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List the VPC offerings based on criteria specified"""
 
@@ -3192,6 +3234,7 @@ class VPC:
         return apiclient.restartVPC(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List VPCs"""
 
@@ -3230,6 +3273,7 @@ class PrivateGateway:
         return apiclient.deletePrivateGateway(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List private gateways"""
 
@@ -3263,6 +3307,7 @@ class AffinityGroup:
         return apiclient.deleteAffinityGroup(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         cmd = listAffinityGroups.listAffinityGroupsCmd()
         [setattr(cmd, k, v) for k, v in kwargs.items()]
@@ -3290,6 +3335,7 @@ class StaticRoute:
         return apiclient.deleteStaticRoute(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List static route"""
 
@@ -3321,6 +3367,7 @@ class VNMC:
         return apiclient.deleteCiscoVnmcResource(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List VNMC appliances"""
 
@@ -3356,6 +3403,7 @@ class SSHKeyPair:
         apiclient.deleteSSHKeyPair(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all SSH key pairs"""
         cmd = listSSHKeyPairs.listSSHKeyPairsCmd()
@@ -3367,6 +3415,7 @@ class Capacities:
     """Manage Capacities"""
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists capacities"""
 
@@ -3379,6 +3428,7 @@ class Alert:
     """Manage alerts"""
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists alerts"""
 
@@ -3424,6 +3474,7 @@ class InstanceGroup:
         return (apiclient.updateInstanceGroup(cmd))
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all instance groups"""
         cmd = listInstanceGroups.listInstanceGroupsCmd()
@@ -3493,6 +3544,7 @@ class ASA1000V:
         return apiclient.deleteCiscoAsa1000vResource(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List ASA 1000v appliances"""
 
@@ -3518,6 +3570,7 @@ class VmSnapshot:
         return VmSnapshot(apiclient.createVMSnapshot(cmd).__dict__)
     
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         cmd = listVMSnapshot.listVMSnapshotCmd()
         [setattr(cmd, k, v) for k, v in kwargs.items()]
@@ -3556,6 +3609,7 @@ class Region:
             raise e
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         cmd = listRegions.listRegionsCmd()
         [setattr(cmd, k, v) for k, v in kwargs.items()]
@@ -3652,6 +3706,7 @@ class ApplicationLoadBalancer:
         return
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List all appln load balancers"""
         cmd = listLoadBalancers.listLoadBalancersCmd()
@@ -3665,6 +3720,7 @@ class Resources:
         self.__dict__.update(items)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """Lists resource limits"""
 
@@ -3710,6 +3766,7 @@ class NIC:
         return(apiclient.addIpToNic(cmd))
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         """List NICs belonging to a virtual machine"""
 
@@ -3741,6 +3798,7 @@ class IAMGroup:
         return apiclient.deleteIAMGroup(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         cmd = listIAMGroups.listIAMGroupsCmd()
         [setattr(cmd, k, v) for k, v in kwargs.items()]
@@ -3802,6 +3860,7 @@ class IAMPolicy:
         return apiclient.deleteIAMPolicy(cmd)
 
     @classmethod
+    @streamable
     def list(cls, apiclient, **kwargs):
         cmd = listIAMPolicies.listIAMPoliciesCmd()
         [setattr(cmd, k, v) for k, v in kwargs.items()]
@@ -68,7 +68,8 @@ from marvin.integration.lib.base import (Configurations,
                                          Network)
 from marvin.integration.lib.utils import (get_process_status,
                                           xsplit,
-                                          validateList)
+                                          validateList,
+                                          streamable)
 
 from marvin.sshClient import SshClient
 from marvin.codes import PASS, ISOLATED_NETWORK, VPC_NETWORK, BASIC_ZONE, FAIL
@@ -423,6 +424,7 @@ def update_resource_limit(apiclient, resourcetype, account=None,
     return
 
 
+@streamable
 def list_os_types(apiclient, **kwargs):
     """List all os types matching criteria"""
 
@@ -431,6 +433,7 @@ def list_os_types(apiclient, **kwargs):
     return(apiclient.listOsTypes(cmd))
 
 
+@streamable
 def list_routers(apiclient, **kwargs):
     """List all Routers matching criteria"""
 
@@ -439,6 +442,7 @@ def list_routers(apiclient, **kwargs):
     return(apiclient.listRouters(cmd))
 
 
+@streamable
 def list_zones(apiclient, **kwargs):
     """List all Zones matching criteria"""
 
@@ -447,6 +451,7 @@ def list_zones(apiclient, **kwargs):
     return(apiclient.listZones(cmd))
 
 
+@streamable
 def list_networks(apiclient, **kwargs):
     """List all Networks matching criteria"""
 
@@ -455,6 +460,7 @@ def list_networks(apiclient, **kwargs):
     return(apiclient.listNetworks(cmd))
 
 
+@streamable
 def list_clusters(apiclient, **kwargs):
     """List all Clusters matching criteria"""
 
@@ -463,6 +469,7 @@ def list_clusters(apiclient, **kwargs):
     return(apiclient.listClusters(cmd))
 
 
+@streamable
 def list_ssvms(apiclient, **kwargs):
     """List all SSVMs matching criteria"""
 
@@ -471,6 +478,7 @@ def list_ssvms(apiclient, **kwargs):
     return(apiclient.listSystemVms(cmd))
 
 
+@streamable
 def list_storage_pools(apiclient, **kwargs):
     """List all storage pools matching criteria"""
 
@@ -479,6 +487,7 @@ def list_storage_pools(apiclient, **kwargs):
     return(apiclient.listStoragePools(cmd))
 
 
+@streamable
 def list_virtual_machines(apiclient, **kwargs):
     """List all VMs matching criteria"""
 
@@ -487,6 +496,7 @@ def list_virtual_machines(apiclient, **kwargs):
     return(apiclient.listVirtualMachines(cmd))
 
 
+@streamable
 def list_hosts(apiclient, **kwargs):
     """List all Hosts matching criteria"""
 
@@ -495,6 +505,7 @@ def list_hosts(apiclient, **kwargs):
     return(apiclient.listHosts(cmd))
 
 
+@streamable
 def list_configurations(apiclient, **kwargs):
     """List configuration with specified name"""
 
@@ -503,6 +514,7 @@ def list_configurations(apiclient, **kwargs):
     return(apiclient.listConfigurations(cmd))
 
 
+@streamable
 def list_publicIP(apiclient, **kwargs):
     """List all Public IPs matching criteria"""
 
@@ -511,6 +523,7 @@ def list_publicIP(apiclient, **kwargs):
     return(apiclient.listPublicIpAddresses(cmd))
 
 
+@streamable
 def list_nat_rules(apiclient, **kwargs):
     """List all NAT rules matching criteria"""
 
@@ -519,6 +532,7 @@ def list_nat_rules(apiclient, **kwargs):
     return(apiclient.listPortForwardingRules(cmd))
 
 
+@streamable
 def list_lb_rules(apiclient, **kwargs):
     """List all Load balancing rules matching criteria"""
 
@@ -527,6 +541,7 @@ def list_lb_rules(apiclient, **kwargs):
     return(apiclient.listLoadBalancerRules(cmd))
 
 
+@streamable
 def list_lb_instances(apiclient, **kwargs):
     """List all Load balancing instances matching criteria"""
 
@@ -535,6 +550,7 @@ def list_lb_instances(apiclient, **kwargs):
     return(apiclient.listLoadBalancerRuleInstances(cmd))
 
 
+@streamable
 def list_firewall_rules(apiclient, **kwargs):
     """List all Firewall Rules matching criteria"""
 
@@ -543,6 +559,7 @@ def list_firewall_rules(apiclient, **kwargs):
     return(apiclient.listFirewallRules(cmd))
 
 
+@streamable
 def list_volumes(apiclient, **kwargs):
     """List all volumes matching criteria"""
 
@@ -551,6 +568,7 @@ def list_volumes(apiclient, **kwargs):
     return(apiclient.listVolumes(cmd))
 
 
+@streamable
 def list_isos(apiclient, **kwargs):
     """Lists all available ISO files."""
 
@@ -559,6 +577,7 @@ def list_isos(apiclient, **kwargs):
     return(apiclient.listIsos(cmd))
 
 
+@streamable
 def list_snapshots(apiclient, **kwargs):
     """List all snapshots matching criteria"""
 
@@ -567,6 +586,7 @@ def list_snapshots(apiclient, **kwargs):
     return(apiclient.listSnapshots(cmd))
 
 
+@streamable
 def list_templates(apiclient, **kwargs):
     """List all templates matching criteria"""
 
@@ -575,6 +595,7 @@ def list_templates(apiclient, **kwargs):
     return(apiclient.listTemplates(cmd))
 
 
+@streamable
 def list_domains(apiclient, **kwargs):
     """Lists domains"""
 
@@ -583,6 +604,7 @@ def list_domains(apiclient, **kwargs):
     return(apiclient.listDomains(cmd))
 
 
+@streamable
 def list_accounts(apiclient, **kwargs):
     """Lists accounts and provides detailed account information for
     listed accounts"""
@@ -592,6 +614,7 @@ def list_accounts(apiclient, **kwargs):
     return(apiclient.listAccounts(cmd))
 
 
+@streamable
 def list_users(apiclient, **kwargs):
     """Lists users and provides detailed account information for
     listed users"""
@@ -601,6 +624,7 @@ def list_users(apiclient, **kwargs):
     return(apiclient.listUsers(cmd))
 
 
+@streamable
 def list_snapshot_policy(apiclient, **kwargs):
     """Lists snapshot policies."""
 
@@ -609,6 +633,7 @@ def list_snapshot_policy(apiclient, **kwargs):
     return(apiclient.listSnapshotPolicies(cmd))
 
 
+@streamable
 def list_events(apiclient, **kwargs):
     """Lists events"""
 
@@ -617,6 +642,7 @@ def list_events(apiclient, **kwargs):
     return(apiclient.listEvents(cmd))
 
 
+@streamable
 def list_disk_offering(apiclient, **kwargs):
     """Lists all available disk offerings."""
 
@@ -625,6 +651,7 @@ def list_disk_offering(apiclient, **kwargs):
     return(apiclient.listDiskOfferings(cmd))
 
 
+@streamable
 def list_service_offering(apiclient, **kwargs):
     """Lists all available service offerings."""
 
@@ -633,6 +660,7 @@ def list_service_offering(apiclient, **kwargs):
     return(apiclient.listServiceOfferings(cmd))
 
 
+@streamable
 def list_vlan_ipranges(apiclient, **kwargs):
     """Lists all VLAN IP ranges."""
 
@@ -641,6 +669,7 @@ def list_vlan_ipranges(apiclient, **kwargs):
     return(apiclient.listVlanIpRanges(cmd))
 
 
+@streamable
 def list_usage_records(apiclient, **kwargs):
     """Lists usage records for accounts"""
 
@@ -649,6 +678,7 @@ def list_usage_records(apiclient, **kwargs):
     return(apiclient.listUsageRecords(cmd))
 
 
+@streamable
 def list_nw_service_prividers(apiclient, **kwargs):
     """Lists Network service providers"""
 
@@ -657,6 +687,7 @@ def list_nw_service_prividers(apiclient, **kwargs):
     return(apiclient.listNetworkServiceProviders(cmd))
 
 
+@streamable
 def list_virtual_router_elements(apiclient, **kwargs):
     """Lists Virtual Router elements"""
 
@@ -665,6 +696,7 @@ def list_virtual_router_elements(apiclient, **kwargs):
     return(apiclient.listVirtualRouterElements(cmd))
 
 
+@streamable
 def list_network_offerings(apiclient, **kwargs):
     """Lists network offerings"""
 
@@ -673,6 +705,7 @@ def list_network_offerings(apiclient, **kwargs):
     return(apiclient.listNetworkOfferings(cmd))
 
 
+@streamable
 def list_resource_limits(apiclient, **kwargs):
     """Lists resource limits"""
 
@@ -680,6 +713,7 @@ def list_resource_limits(apiclient, **kwargs):
     [setattr(cmd, k, v) for k, v in kwargs.items()]
     return(apiclient.listResourceLimits(cmd))
 
+@streamable
 def list_vpc_offerings(apiclient, **kwargs):
     """ Lists VPC offerings """
 
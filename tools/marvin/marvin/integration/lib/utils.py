@@ -28,6 +28,9 @@ import email
 import socket
 import urlparse
 import datetime
+import copy
+import threading
+from functools import wraps
 from marvin.cloudstackAPI import cloudstackAPIClient, listHosts
 from marvin.sshClient import SshClient
 from marvin.codes import (FAIL,
@@ -116,10 +119,12 @@ def cleanup_resources(api_client, resources):
         obj.delete(api_client)
 
 
-def is_server_ssh_ready(ipaddress, port, username, password, retries=20, retryinterv=30, timeout=10.0, keyPairFileLocation=None):
+def is_server_ssh_ready(ipaddress, port, username, password, retries=20, retryinterv=30, timeout=10.0, keyPairFileLocation=None, reuse=False):
     '''
     @Name: is_server_ssh_ready
     @Input: timeout: tcp connection timeout flag,
+            reuse: take the connection from the process wide ssh cache,
+                   leave False when the test checks ssh access itself
             others information need to be added
     @Output:object for SshClient
     Name of the function is little misnomer and is not
@@ -135,7 +140,8 @@ def is_server_ssh_ready(ipaddress, port, username, password, retries=20, retryin
             keyPairFiles=keyPairFileLocation,
             retries=retries,
             delay=retryinterv,
-            timeout=timeout)
+            timeout=timeout,
+            reuse=reuse)
     except Exception, e:
         raise Exception("SSH connection has Failed. Waited %ss. Error is %s" % (retries * retryinterv, str(e)))
     else:
@@ -189,8 +195,8 @@ def get_host_credentials(config, hostip):
 def get_process_status(hostip, port, username, password, linklocalip, process, hypervisor=None):
     """Double hop and returns a process status"""
 
-    #SSH to the machine
-    ssh = SshClient(hostip, port, username, password)
+    #SSH to the machine, over the cached connection of the host if any
+    ssh = SshClient(hostip, port, username, password, reuse=True)
     if (str(hypervisor).lower() == 'vmware'
 		or str(hypervisor).lower() == 'hyperv'):
         ssh_command = "ssh -i /var/cloudstack/management/.ssh/id_rsa -ostricthostkeychecking=no "
@@ -429,3 +435,66 @@ def verifyElementInList(inp, toverify, responsevar=None,  pos=0):
     else:
         return [FAIL, MATCH_NOT_FOUND]
 
+
+def stream_list(list_func, *args, **kwargs):
+    """
+    @Desc : Generator paging through the results of list_func, one of the
+            list helpers of base.py/common.py, with page/pagesize. The next
+            page is fetched in the background while the caller consumes
+            the current one, so at most one page is held besides the one
+            being iterated.
+    @Input: list_func : the undecorated list helper
+            args : its positional arguments, the api client last unless
+                   it is passed as the apiclient keyword argument
+            kwargs : criteria of the list call, pagesize defaults to 500
+    """
+    pagesize = kwargs.pop("pagesize", 500)
+    page = kwargs.pop("page", 1)
+    # The prefetching thread must not share the caller's http session
+    if kwargs.get("apiclient") is not None:
+        kwargs["apiclient"] = copy.copy(kwargs["apiclient"])
+    else:
+        args = args[:-1] + (copy.copy(args[-1]),)
+
+    def fetch(page, out):
+        try:
+            out.append(list_func(*args, page=page, pagesize=pagesize,
+                                 **kwargs) or [])
+        except Exception as e:
+            out.append(e)
+
+    current = list_func(*args, page=page, pagesize=pagesize, **kwargs) or []
+    while len(current) > 0:
+        prefetch = None
+        if len(current) >= pagesize:
+            nextPage = []
+            prefetch = threading.Thread(target=fetch,
+                                        args=(page + 1, nextPage))
+            prefetch.setDaemon(True)
+            prefetch.start()
+
+        for item in current:
+            yield item
+
+        if prefetch is None:
+            return
+        current = None
+        prefetch.join()
+        if isinstance(nextPage[0], Exception):
+            raise nextPage[0]
+        current = nextPage[0]
+        page = page + 1
+
+
+def streamable(list_func):
+    """
+    @Desc : Decorator for list helpers, list(..., stream=True) returns a
+            stream_list generator instead of the result of a single
+            unpaged call
+    """
+    @wraps(list_func)
+    def wrapper(*args, **kwargs):
+        if kwargs.pop("stream", False):
+            return stream_list(list_func, *args, **kwargs)
+        return list_func(*args, **kwargs)
+    return wrapper
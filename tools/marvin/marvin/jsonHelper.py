@@ -51,6 +51,79 @@ class jsonLoader(object):
                                       in self.__dict__.iteritems()))
 
 
+class jsonLazyLoader(object):
+    '''
+    Lazy counterpart of jsonLoader for API responses. It only keeps a
+    reference to the decoded json dict; nested dicts and lists of dicts
+    are wrapped on first access, and the wrapper replaces the raw value in
+    place so each one is built at most once. Instances carry a single
+    slot, which keeps large list responses cheap.
+    '''
+    __slots__ = ('_data',)
+
+    def __init__(self, obj):
+        object.__setattr__(self, '_data', obj)
+
+    @staticmethod
+    def wrap(v):
+        if isinstance(v, dict):
+            return jsonLazyLoader(v)
+        elif isinstance(v, (list, tuple)):
+            if len(v) > 0 and isinstance(v[0], dict):
+                return [jsonLazyLoader(elem) for elem in v]
+        return v
+
+    def __getattr__(self, val):
+        if val.startswith('__'):
+            raise AttributeError(val)
+        data = self._data
+        if val not in data:
+            return None
+        v = data[val]
+        if isinstance(v, (dict, list, tuple)):
+            v = jsonLazyLoader.wrap(v)
+            data[val] = v
+        return v
+
+    def __setattr__(self, k, v):
+        self._data[k] = v
+
+    def __delattr__(self, k):
+        del self._data[k]
+
+    @property
+    def __dict__(self):
+        '''
+        materializes one level and hands out the backing dict, so code
+        doing Resource(response.__dict__) keeps working
+        '''
+        data = self._data
+        for k, v in data.iteritems():
+            if isinstance(v, (dict, list, tuple)):
+                data[k] = jsonLazyLoader.wrap(v)
+        return data
+
+    def __getstate__(self):
+        return dict(self.__dict__)
+
+    def __setstate__(self, state):
+        object.__setattr__(self, '_data', state)
+
+    def __repr__(self):
+        return '{%s}' % str(', '.join('%s : %s' % (k, repr(v)) for (k, v)
+                                      in self.__dict__.iteritems()))
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def getFields(obj):
+    '''names of the fields of a response object, without materializing'''
+    if isinstance(obj, jsonLazyLoader):
+        return obj._data
+    return obj.__dict__
+
+
 class jsonDump(object):
     @staticmethod
     def __serialize(obj):
@@ -107,19 +180,20 @@ def finalizeResultObj(result, responseName, responsecls):
                                              responsecls)
         return result
     elif responsecls is not None:
-        for k, v in result.__dict__.iteritems():
-            if k in responsecls.__dict__:
+        fields = responsecls.__dict__
+        for k in getFields(result):
+            if k in fields:
                 return result
 
-        attr = result.__dict__.keys()[0]
+        attr = getFields(result).keys()[0]
 
         value = getattr(result, attr)
-        if not isinstance(value, jsonLoader):
+        if not isinstance(value, (jsonLoader, jsonLazyLoader)):
             return result
 
         findObj = False
-        for k, v in value.__dict__.iteritems():
-            if k in responsecls.__dict__:
+        for k in getFields(value):
+            if k in fields:
                 findObj = True
                 break
         if findObj:
@@ -140,7 +214,7 @@ def getResultObj(returnObj, responsecls=None):
     if len(response) == 0:
         return None
 
-    result = jsonLoader(response)
+    result = jsonLazyLoader(response)
     if result.errorcode is not None:
         errMsg = "errorCode: %s, errorText:%s" % (result.errorcode,
                                                   result.errortext)
@@ -148,7 +222,7 @@ def getResultObj(returnObj, responsecls=None):
         raise cloudstackException.cloudstackAPIException(respname, errMsg)
 
     if result.count is not None:
-        for key in result.__dict__.iterkeys():
+        for key in getFields(result).iterkeys():
             if key == "count":
                 continue
             else:
@@ -0,0 +1,181 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+'''
+Local stand-in of the management server API for the marvin benchmarks.
+It answers a handful of commands with canned json over keep-alive
+HTTP/1.1, async jobs complete jobDuration seconds after submission.
+'''
+import BaseHTTPServer
+import SocketServer
+import json
+import logging
+import threading
+import time
+import urlparse
+from marvin.configGenerator import managementServer
+
+
+def virtualMachine(i):
+    return {"id": "vm-%d" % i, "name": "i-2-%d-VM" % i,
+            "displayname": "vm%d" % i, "account": "admin",
+            "domainid": "domain-1", "domain": "ROOT",
+            "created": "2013-10-01T10:00:00+0000", "state": "Running",
+            "haenable": False, "zoneid": "zone-1", "zonename": "zone1",
+            "templateid": "template-1", "templatename": "CentOS 5.6",
+            "serviceofferingid": "offering-1",
+            "serviceofferingname": "Small Instance", "cpunumber": 1,
+            "cpuspeed": 500, "memory": 512, "hypervisor": "Simulator",
+            "securitygroup": [{"id": "sg-1", "name": "default",
+                               "description": "Default Security Group"}],
+            "nic": [{"id": "nic-%d" % i, "networkid": "network-1",
+                     "netmask": "255.255.0.0", "gateway": "10.1.0.1",
+                     "ipaddress": "10.1.%d.%d" % (i / 256, i % 256),
+                     "traffictype": "Guest", "type": "Shared",
+                     "isdefault": True,
+                     "macaddress": "06:00:00:00:%02x:%02x"
+                     % (i / 256 % 256, i % 256)}],
+            "tags": []}
+
+
+def listResponse(name, key, items):
+    return {name: {"count": len(items), key: items}}
+
+
+class apiStubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, vms=100, jobDuration=0.1):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           apiStubHandler)
+        self.vms = vms
+        self.jobDuration = jobDuration
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.requests = {}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # clients dropping their keep-alive connections
+        pass
+
+    def managementServer(self):
+        '''details of the stub for cloudConnection'''
+        mgmt = managementServer()
+        mgmt.mgtSvrIp = self.server_address[0]
+        mgmt.port = self.server_address[1]
+        mgmt.user = None
+        mgmt.passwd = None
+        mgmt.pollMaxInterval = 0.5
+        return mgmt
+
+    def submitJob(self, result):
+        self.lock.acquire()
+        try:
+            jobid = "job-%d" % len(self.jobs)
+            self.jobs[jobid] = (time.time() + self.jobDuration, result)
+        finally:
+            self.lock.release()
+        return jobid
+
+    def jobStatus(self, jobid):
+        done, result = self.jobs[jobid]
+        if time.time() < done:
+            return {"jobid": jobid, "jobstatus": 0}
+        return {"jobid": jobid, "jobstatus": 1, "jobresultcode": 0,
+                "jobresulttype": "object", "jobresult": result}
+
+    def answer(self, command, params):
+        if command == "listVirtualMachines":
+            page = int(params.get("page", 1))
+            pagesize = int(params.get("pagesize", self.vms))
+            start = (page - 1) * pagesize
+            return listResponse("listvirtualmachinesresponse",
+                                "virtualmachine",
+                                [virtualMachine(i) for i in
+                                 range(start, min(start + pagesize,
+                                                  self.vms))])
+        if command == "listZones":
+            return listResponse("listzonesresponse", "zone",
+                                [{"id": "zone-1", "name": "zone1",
+                                  "networktype": "Basic",
+                                  "allocationstate": "Enabled"}])
+        if command == "deployVirtualMachine":
+            jobid = self.submitJob({"virtualmachine": virtualMachine(0)})
+            return {"deployvirtualmachineresponse": {"id": "vm-0",
+                                                     "jobid": jobid}}
+        if command == "startVirtualMachine":
+            jobid = self.submitJob({"virtualmachine": virtualMachine(0)})
+            return {"startvirtualmachineresponse": {"jobid": jobid}}
+        if command == "queryAsyncJobResult":
+            return {"queryasyncjobresultresponse":
+                    self.jobStatus(params["jobid"])}
+        if command == "listAsyncJobs":
+            return listResponse("listasyncjobsresponse", "asyncjobs",
+                                [self.jobStatus(jobid) for jobid
+                                 in self.jobs.keys()])
+        return {"errorresponse": {"errorcode": 432,
+                                  "errortext": "unknown command %s"
+                                  % command}}
+
+
+class apiStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        query = urlparse.urlparse(self.path).query
+        params = dict(urlparse.parse_qsl(query))
+        command = params.get("command")
+        server = self.server
+        server.lock.acquire()
+        try:
+            server.requests[command] = server.requests.get(command, 0) + 1
+        finally:
+            server.lock.release()
+        body = json.dumps(server.answer(command, params))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+
+def quietLogger():
+    logger = logging.getLogger("marvin.perf")
+    logger.setLevel(logging.WARNING)
+    return logger
+
+
+def percentile(values, p):
+    '''p-th fraction of the sorted values'''
+    return values[int(p * (len(values) - 1))]
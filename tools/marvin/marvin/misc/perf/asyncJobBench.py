@@ -0,0 +1,84 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+'''
+Load test of asyncJobMgr against the API stub: submits a mix of async
+deployVirtualMachine and sync listZones commands through
+submitCmdsAndWait and prints the jobs/sec and p50/p99 latency of each
+command from getStatistics.
+
+    python asyncJobBench.py [-n jobs] [-w workers] [-d jobDuration]
+'''
+import time
+from optparse import OptionParser
+from marvin import cloudstackConnection
+from marvin.asyncJobMgr import asyncJobMgr
+from marvin.cloudstackAPI import (cloudstackAPIClient, deployVirtualMachine,
+                                  listZones)
+from apiStub import apiStubServer, quietLogger
+
+
+def commands(jobs):
+    cmds = []
+    for i in range(jobs):
+        if i % 2 == 0:
+            cmd = deployVirtualMachine.deployVirtualMachineCmd()
+            cmd.serviceofferingid = "offering-1"
+            cmd.templateid = "template-1"
+            cmd.zoneid = "zone-1"
+        else:
+            cmd = listZones.listZonesCmd()
+        cmds.append(cmd)
+    return cmds
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--jobs", dest="jobs", type="int", default=1000,
+                      help="number of commands submitted, default 1000")
+    parser.add_option("-w", "--workers", dest="workers", type="int",
+                      default=10, help="worker threads, default 10")
+    parser.add_option("-d", "--duration", dest="duration", type="float",
+                      default=0.5, help="seconds an async job takes on the\
+ stub, default 0.5")
+    (options, args) = parser.parse_args()
+
+    server = apiStubServer(jobDuration=options.duration)
+    server.start()
+    try:
+        connection = cloudstackConnection.cloudConnection(
+            server.managementServer(), logger=quietLogger())
+        apiClient = cloudstackAPIClient.CloudStackAPIClient(connection)
+        mgr = asyncJobMgr(apiClient, None)
+
+        start = time.time()
+        results = mgr.submitCmdsAndWait(commands(options.jobs),
+                                        options.workers)
+        wall = time.time() - start
+        connection.close()
+
+        failed = len([r for r in results if r.status is False])
+        print "%d commands in %.2fs (%.1f/s), %d failed, %d workers"\
+            % (len(results), wall, len(results) / wall, failed,
+               options.workers)
+        stats = mgr.getStatistics(results)
+        for cmd in sorted(stats.keys()):
+            s = stats[cmd]
+            print "%-24s %6d jobs %8.1f jobs/s  p50 %.3fs  p99 %.3fs"\
+                % (cmd, s["jobs"], s["jobsPerSec"] or 0, s["p50"], s["p99"])
+        print "requests per command:", server.requests
+    finally:
+        server.stop()
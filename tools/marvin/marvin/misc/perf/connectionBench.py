@@ -0,0 +1,85 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+'''
+API calls per second of cloudConnection against the API stub, over the
+keep-alive session of the connection and, for comparison, with a new
+TCP connection per call as before the session was pooled. Each thread
+works on its own copy of the connection like the asyncJobMgr workers.
+
+    python connectionBench.py [-n calls] [-t threads]
+'''
+import copy
+import threading
+import time
+from optparse import OptionParser
+from marvin import cloudstackConnection
+from marvin.cloudstackAPI import listZones
+from apiStub import apiStubServer, quietLogger, percentile
+
+
+def worker(connection, calls, keepAlive, latencies):
+    connection = copy.copy(connection)
+    cmd = listZones.listZonesCmd()
+    try:
+        for i in range(calls):
+            start = time.time()
+            connection.marvinRequest(cmd)
+            latencies.append(time.time() - start)
+            if not keepAlive:
+                # drops the pooled connection, the next call opens one
+                connection.session.close()
+    finally:
+        connection.close()
+
+
+def run(connection, calls, threads, keepAlive):
+    latencies = []
+    workers = []
+    for i in range(threads):
+        workers.append(threading.Thread(
+            target=worker,
+            args=(connection, calls / threads, keepAlive, latencies)))
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    wall = time.time() - start
+    latencies.sort()
+    print "%-12s %6d calls in %.2fs: %7.1f calls/s  p50 %.2fms  p99 %.2fms"\
+        % (keepAlive and "keep-alive" or "per call", len(latencies), wall,
+           len(latencies) / wall, percentile(latencies, 0.5) * 1000,
+           percentile(latencies, 0.99) * 1000)
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--calls", dest="calls", type="int",
+                      default=2000, help="number of API calls, default 2000")
+    parser.add_option("-t", "--threads", dest="threads", type="int",
+                      default=1, help="calling threads, default 1")
+    (options, args) = parser.parse_args()
+
+    server = apiStubServer()
+    server.start()
+    try:
+        connection = cloudstackConnection.cloudConnection(
+            server.managementServer(), logger=quietLogger())
+        run(connection, options.calls, options.threads, False)
+        run(connection, options.calls, options.threads, True)
+    finally:
+        server.stop()
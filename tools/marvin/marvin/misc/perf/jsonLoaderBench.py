@@ -0,0 +1,94 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+'''
+Memory and time of turning a synthetic listVirtualMachines response into
+response objects, with the eager jsonLoader and with the jsonLazyLoader
+getResultObj uses. Every variant runs in a child process, so its peak RSS
+is measured on its own; the json decoding alone is the baseline.
+
+    python jsonLoaderBench.py [-n vms]
+'''
+import json
+import os
+import resource
+import time
+from optparse import OptionParser
+from marvin import jsonHelper
+from apiStub import listResponse, virtualMachine
+
+
+def ids(vms):
+    return [vm.id for vm in vms]
+
+
+def nics(vms):
+    return [vm.nic[0].ipaddress for vm in vms]
+
+
+def eager(response):
+    return jsonHelper.jsonLoader(
+        response["listvirtualmachinesresponse"]).virtualmachine
+
+
+def lazy(response):
+    return jsonHelper.getResultObj(response)
+
+
+def measure(body, load, access):
+    '''
+    Runs load and access in a child
+    @Output: (load seconds, access seconds, peak RSS in KB of the child)
+    '''
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        response = json.loads(body)
+        start = time.time()
+        vms = load(response)
+        loaded = time.time()
+        if access is not None:
+            access(vms)
+        os.write(w, "%f %f" % (loaded - start, time.time() - loaded))
+        os._exit(0)
+    os.close(w)
+    out = os.read(r, 100)
+    os.close(r)
+    status, rusage = os.wait4(pid, 0)[1:]
+    loadTime, accessTime = [float(t) for t in out.split()]
+    return loadTime, accessTime, rusage.ru_maxrss
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--vms", dest="vms", type="int", default=10000,
+                      help="number of VMs in the response, default 10000")
+    (options, args) = parser.parse_args()
+
+    body = json.dumps(listResponse("listvirtualmachinesresponse",
+                                   "virtualmachine",
+                                   [virtualMachine(i)
+                                    for i in range(options.vms)]))
+    print "response of %d vms, %d bytes" % (options.vms, len(body))
+    base = measure(body, lambda response: None, None)[2]
+    for loaderName, load in [("jsonLoader", eager),
+                             ("jsonLazyLoader", lazy)]:
+        for accessName, access in [("ids", ids), ("nic ips", nics)]:
+            loadTime, accessTime, rss = measure(body, load, access)
+            print "%-15s %-8s load %7.1fms  access %7.1fms  +%6.1fMB"\
+                % (loaderName, accessName, loadTime * 1000,
+                   accessTime * 1000, (rss - base) / 1024.0)
@@ -17,6 +17,8 @@
 
 import paramiko
 import time
+import socket
+import threading
 import cloudstackException
 import contextlib
 import logging
@@ -25,20 +27,47 @@ from marvin.codes import (
     )
 from contextlib import closing
 
+'''
+Process wide cache of authenticated connections, used by the SshClient
+instances created with reuse=True. Keyed by host, port, user and the
+credentials, so a changed password or key never rides on a connection
+authenticated with the old one
+'''
+sshConnections = {}
+sshConnectionsLock = threading.Lock()
+
+
+def closeCachedConnections():
+    '''
+    @Desc: Closes every cached ssh connection
+    '''
+    sshConnectionsLock.acquire()
+    try:
+        for ssh in sshConnections.values():
+            ssh.close()
+        sshConnections.clear()
+    finally:
+        sshConnectionsLock.release()
+
 
 class SshClient(object):
     '''
     Added timeout flag for ssh connect calls.Default to 3.0 seconds
+    With reuse=True the transport is taken from/added to the process wide
+    cache: commands of every client of the same host and credentials run
+    as channels multiplexed over one transport, and close() leaves the
+    transport open for the next client
     '''
     def __init__(self, host, port, user, passwd, retries=20, delay=30,
-                 log_lvl=logging.INFO, keyPairFiles=None, timeout=10.0):
+                 log_lvl=logging.INFO, keyPairFiles=None, timeout=10.0,
+                 reuse=False):
         self.host = None
         self.port = 22
         self.user = user
         self.passwd = passwd
         self.keyPairFiles = keyPairFiles
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.reuse = reuse
+        self.ssh = None
         self.logger = logging.getLogger('sshClient')
         self.retryCnt = 0
         self.delay = 0
@@ -63,8 +92,58 @@ class SshClient(object):
             raise cloudstackException.\
                 internalError("Connection Failed")
 
+    def __cacheKey(self):
+        keyPairFiles = self.keyPairFiles
+        if isinstance(keyPairFiles, list):
+            keyPairFiles = tuple(keyPairFiles)
+        return (self.host, self.port, self.user, self.passwd,
+                keyPairFiles)
+
+    def __getCachedConnection(self):
+        sshConnectionsLock.acquire()
+        try:
+            ssh = sshConnections.get(self.__cacheKey())
+            if ssh is None:
+                return None
+            transport = ssh.get_transport()
+            if transport is not None and transport.is_active():
+                return ssh
+            sshConnections.pop(self.__cacheKey(), None)
+            return None
+        finally:
+            sshConnectionsLock.release()
+
+    def __cacheConnection(self):
+        sshConnectionsLock.acquire()
+        try:
+            sshConnections[self.__cacheKey()] = self.ssh
+        finally:
+            sshConnectionsLock.release()
+
+    def __execCommand(self, command):
+        '''
+        Opens a channel for command on the transport, a cached transport
+        found dead is replaced once by a fresh connection
+        '''
+        try:
+            return self.ssh.exec_command(command)
+        except (paramiko.SSHException, socket.error), e:
+            if not self.reuse:
+                raise e
+            self.logger.debug("Cached SSH connection to %s is gone, "
+                              "reconnecting: %s" % (self.host, e))
+            sshConnectionsLock.acquire()
+            try:
+                if sshConnections.get(self.__cacheKey()) is self.ssh:
+                    sshConnections.pop(self.__cacheKey())
+            finally:
+                sshConnectionsLock.release()
+            if self.createConnection() == FAIL:
+                raise e
+            return self.ssh.exec_command(command)
+
     def execute(self, command):
-        stdin, stdout, stderr = self.ssh.exec_command(command)
+        stdin, stdout, stderr = self.__execCommand(command)
         output = stdout.readlines()
         errors = stderr.readlines()
         results = []
@@ -84,12 +163,24 @@ class SshClient(object):
         '''
         @Name: createConnection
         @Desc: Creates an ssh connection for
-               retries mentioned,along with sleep mentioned
+               retries mentioned, sleeping between attempts with an
+               exponential backoff from 1s up to the delay mentioned,
+               and for as long as retries sleeps of delay would take
         @Output: SUCCESS on successful connection
                  FAIL If connection through ssh failed
         '''
+        if self.reuse:
+            self.ssh = self.__getCachedConnection()
+            if self.ssh is not None:
+                return SUCCESS
+        self.ssh = paramiko.SSHClient()
+        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         ret = FAIL
-        while self.retryCnt >= 0:
+        backoff = min(1, self.delay)
+        # the backoff retries sooner at first, attempts go on until the
+        # window the fixed delay gave (retries - 1 sleeps) has passed
+        deadline = time.time() + max(self.retryCnt - 1, 0) * self.delay
+        while True:
             try:
                 self.logger.debug("SSH Connection: Host:%s User:%s\
                                    Port:%s" %
@@ -114,9 +205,16 @@ class SshClient(object):
                 break
             except Exception as se:
                 self.retryCnt = self.retryCnt - 1
-                if self.retryCnt == 0:
+                now = time.time()
+                if self.retryCnt <= 0 and now >= deadline:
                     break
-                time.sleep(self.delay)
+                if self.retryCnt <= 0:
+                    time.sleep(min(backoff, deadline - now))
+                else:
+                    time.sleep(backoff)
+                backoff = min(backoff * 2, self.delay)
+        if ret == SUCCESS and self.reuse:
+            self.__cacheConnection()
         return ret
 
     def runCommand(self, command):
@@ -141,7 +239,7 @@ class SshClient(object):
             return ret
         try:
             status_check = 1
-            stdin, stdout, stderr = self.ssh.exec_command(command)
+            stdin, stdout, stderr = self.__execCommand(command)
             output = stdout.readlines()
             errors = stderr.readlines()
             inp = stdin.readlines()
@@ -163,16 +261,19 @@ class SshClient(object):
             return ret
 
     def scp(self, srcFile, destPath):
-        transport = paramiko.Transport((self.host, int(self.port)))
-        transport.connect(username=self.user, password=self.passwd)
-        sftp = paramiko.SFTPClient.from_transport(transport)
+        '''
+        Copies srcFile over an sftp channel of the existing transport
+        '''
+        sftp = self.ssh.open_sftp()
         try:
             sftp.put(srcFile, destPath)
         except IOError, e:
             raise e
+        finally:
+            sftp.close()
 
     def close(self):
-            if self.ssh is not None:
+            if self.ssh is not None and not self.reuse:
                 self.ssh.close()
 
 